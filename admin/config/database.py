@@ -1,19 +1,114 @@
-
 import os
+import time
 import asyncio
 from motor.motor_asyncio import AsyncIOMotorClient
 from pymongo.server_api import ServerApi
+from admin.config.logging_config import get_stage_logger
+
+# Connection pool bounds per process
+MONGO_MAX_POOL_SIZE = int(os.environ.get("MONGO_MAX_POOL_SIZE", "100"))
+MONGO_MIN_POOL_SIZE = int(os.environ.get("MONGO_MIN_POOL_SIZE", "10"))
+
+# Close pooled connections idle for this long (0 keeps them)
+MONGO_MAX_IDLE_TIME_MS = int(os.environ.get("MONGO_MAX_IDLE_TIME_MS", "0"))
+
+# Timeouts in milliseconds (0 means no timeout for socket and wait queue)
+MONGO_CONNECT_TIMEOUT_MS = int(os.environ.get("MONGO_CONNECT_TIMEOUT_MS", "10000"))
+MONGO_SERVER_SELECTION_TIMEOUT_MS = int(os.environ.get("MONGO_SERVER_SELECTION_TIMEOUT_MS", "10000"))
+MONGO_SOCKET_TIMEOUT_MS = int(os.environ.get("MONGO_SOCKET_TIMEOUT_MS", "0"))
+MONGO_WAIT_QUEUE_TIMEOUT_MS = int(os.environ.get("MONGO_WAIT_QUEUE_TIMEOUT_MS", "0"))
+
+# Connections opened at startup, before the app starts serving
+MONGO_WARMUP_CONNECTIONS = int(os.environ.get("MONGO_WARMUP_CONNECTIONS", str(MONGO_MIN_POOL_SIZE)))
+
+BOXES_DB_NAME = "Boxes"
+
+# Module attributes resolved on access once connect_database() has run
+COLLECTIONS = {
+    "all_snacks_collection": "snacks",
+    "all_customers_collection": "customers",
+    "monthly_base_box_collection": "monthly_base_box",
+    "monthly_draft_box_collection": "draftboxes",
+    "internal_orders_collection": "internal_orders",
+}
+
+startup_log = get_stage_logger("startup")
+
+_client = None
+
+
+def client_options():
+    """
+    Pool and timeout options for AsyncIOMotorClient from the MONGO_* settings.
+    """
+    options = {
+        "maxPoolSize": MONGO_MAX_POOL_SIZE,
+        "minPoolSize": MONGO_MIN_POOL_SIZE,
+        "connectTimeoutMS": MONGO_CONNECT_TIMEOUT_MS,
+        "serverSelectionTimeoutMS": MONGO_SERVER_SELECTION_TIMEOUT_MS,
+    }
+    if MONGO_MAX_IDLE_TIME_MS:
+        options["maxIdleTimeMS"] = MONGO_MAX_IDLE_TIME_MS
+    if MONGO_SOCKET_TIMEOUT_MS:
+        options["socketTimeoutMS"] = MONGO_SOCKET_TIMEOUT_MS
+    if MONGO_WAIT_QUEUE_TIMEOUT_MS:
+        options["waitQueueTimeoutMS"] = MONGO_WAIT_QUEUE_TIMEOUT_MS
+    return options
+
+
+def connect_database(connection_string=None):
+    """
+    Create the process-wide Motor client (once). Called from the app lifespan and scripts, so
+    importing the routes or services doesn't need a database.
+
+    Args:
+        connection_string (str): Defaults to the MONGO_BOXES_URI environment variable.
+
+    Returns:
+        AsyncIOMotorClient: The client.
+    """
+    global _client
+    if _client is None:
+        connection_string = connection_string or os.environ.get('MONGO_BOXES_URI')
+        if not connection_string:
+            raise ValueError("MONGO_BOXES_URI environment variable is not set")
+        _client = AsyncIOMotorClient(connection_string, server_api=ServerApi('1'), **client_options())
+    return _client
+
+
+async def warm_up_connection_pool(connections=MONGO_WARMUP_CONNECTIONS):
+    """
+    Select a server and open `connections` pooled connections with concurrent pings, so the
+    first requests don't pay for TCP, TLS and auth handshakes.
+    """
+    database = get_boxes_db()
+    started = time.perf_counter()
+    await database.command("ping")
+    if connections > 1:
+        await asyncio.gather(*(database.command("ping") for _ in range(connections)))
+    startup_log.info("Mongo connection pool warmed: %s connections in %.0fms", max(connections, 1), (time.perf_counter() - started) * 1000)
+
+
+def close_database():
+    global _client
+    if _client is not None:
+        _client.close()
+        _client = None
 
-connection_string = os.environ.get('MONGO_BOXES_URI')
-if not connection_string:
-    raise ValueError("MONGO_BOXES_URI environment variable is not set")
 
-client = AsyncIOMotorClient(connection_string, server_api=ServerApi('1'))
+def get_boxes_db():
+    if _client is None:
+        raise RuntimeError("The database isn't connected: call connect_database() first (the app lifespan does)")
+    return _client[BOXES_DB_NAME]
 
-boxes_db = client["Boxes"]
 
-all_snacks_collection = boxes_db["snacks"]
-all_customers_collection = boxes_db["customers"]
-monthly_base_box_collection = boxes_db["monthly_base_box"]
-monthly_draft_box_collection = boxes_db["draftboxes"]
-internal_orders_collection = boxes_db["internal_orders"]
+def __getattr__(name):
+    # boxes_db and the collections, e.g. `from admin.config.database import all_snacks_collection`
+    if name == "client":
+        get_boxes_db()
+        return _client
+    if name == "boxes_db":
+        return get_boxes_db()
+    if name in COLLECTIONS:
+        return get_boxes_db()[COLLECTIONS[name]]
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -0,0 +1,156 @@
+import os
+from functools import partial
+from pymongo import IndexModel, ASCENDING, DESCENDING
+from pymongo.errors import OperationFailure
+from admin.config.logging_config import get_stage_logger
+from admin.services.build_starting_box_service import box_history_pipeline, idempotent_build_filter
+
+# Set to "false" to skip creating indexes at startup (e.g. when the app user can't create them)
+MONGO_ENSURE_INDEXES = os.environ.get("MONGO_ENSURE_INDEXES", "true").lower() == "true"
+
+# Set to "false" to skip explaining the canonical queries at startup
+MONGO_CHECK_QUERY_PLANS = os.environ.get("MONGO_CHECK_QUERY_PLANS", "true").lower() == "true"
+
+# Placeholder used to explain the canonical queries; it never matches a real customer
+EXPLAIN_CUSTOMER_ID = "__explain__"
+
+# Indexes the box build depends on, by collection name
+REQUIRED_INDEXES = {
+    # fetch_box_history: $match on customerID, newest box by createdAt.
+    # Idempotent build lookup: customerID and a createdAt window, then idempotencyKey
+    "draftboxes": [
+        IndexModel([("customerID", ASCENDING), ("createdAt", DESCENDING)], name="customerID_createdAt"),
+    ],
+    # get_customer_by_customerID and the batch $in lookup
+    "customers": [
+        IndexModel(
+            [("customerID", ASCENDING)],
+            name="customerID",
+            partialFilterExpression={"customerID": {"$exists": True}},
+        ),
+    ],
+    # Catalog edits and change events look snacks up by SnackID
+    "snacks": [
+        IndexModel(
+            [("SnackID", ASCENDING)],
+            name="SnackID",
+            partialFilterExpression={"SnackID": {"$exists": True}},
+        ),
+    ],
+}
+
+startup_log = get_stage_logger("startup")
+
+
+async def ensure_indexes(database):
+    """
+    Create REQUIRED_INDEXES. Existing indexes are left alone; a conflicting index with the
+    same keys is reported instead of failing startup.
+    """
+    for collection_name, indexes in REQUIRED_INDEXES.items():
+        try:
+            created = await database[collection_name].create_indexes(indexes)
+            startup_log.info("Indexes ensured on %s: %s", collection_name, created)
+        except OperationFailure as e:
+            startup_log.warning("Could not create indexes on %s (an equivalent index may already exist): %s", collection_name, e)
+        except Exception as e:
+            startup_log.error("An error occurred while creating indexes on %s: %s", collection_name, e)
+
+
+def canonical_queries(database):
+    """
+    The hot queries of a box build, as (description, explain) pairs: calling explain()
+    returns an awaitable explain document.
+
+    The snacks catalog is loaded with a full find({}) and filtered in memory, so it is
+    expected to scan and isn't listed.
+    """
+    customer_ids = [EXPLAIN_CUSTOMER_ID]
+    return [
+        (
+            "draftboxes history $match/$facet by customerID",
+            partial(
+                database.command,
+                {
+                    "explain": {"aggregate": "draftboxes", "pipeline": box_history_pipeline(EXPLAIN_CUSTOMER_ID, {"_id": 0}), "cursor": {}},
+                    "verbosity": "queryPlanner",
+                },
+            ),
+        ),
+        (
+            "draftboxes by customerID and idempotencyKey",
+            database["draftboxes"].find(idempotent_build_filter(EXPLAIN_CUSTOMER_ID, EXPLAIN_CUSTOMER_ID), {"_id": 0, "snacks": 1}).limit(1).explain,
+        ),
+        (
+            "customers by customerID",
+            database["customers"].find({"customerID": EXPLAIN_CUSTOMER_ID}).limit(1).explain,
+        ),
+        (
+            "customers by customerID $in (batch)",
+            database["customers"].find({"customerID": {"$in": customer_ids}}).explain,
+        ),
+    ]
+
+
+def _plan_stages(plan):
+    """
+    Every "stage" name in an explain() document, however deeply nested.
+    """
+    if isinstance(plan, dict):
+        if "stage" in plan:
+            yield plan["stage"]
+        for value in plan.values():
+            yield from _plan_stages(value)
+    elif isinstance(plan, list):
+        for value in plan:
+            yield from _plan_stages(value)
+
+
+def _winning_plans(explanation):
+    """
+    Every "winningPlan" in an explain() document. An aggregation nests them in its $cursor
+    stage (per shard on a sharded cluster); rejected plans are left out.
+    """
+    if isinstance(explanation, dict):
+        for key, value in explanation.items():
+            if key == "winningPlan":
+                yield value
+            elif key != "rejectedPlans":
+                yield from _winning_plans(value)
+    elif isinstance(explanation, list):
+        for value in explanation:
+            yield from _winning_plans(value)
+
+
+async def check_query_plans(database):
+    """
+    explain() each canonical query and warn when its winning plan is a collection scan.
+
+    Returns:
+        List[str]: Descriptions of the queries that scan.
+    """
+    scanning = []
+    for description, explain in canonical_queries(database):
+        try:
+            explanation = await explain()
+        except Exception as e:
+            startup_log.warning("Could not explain query '%s': %s", description, e)
+            continue
+
+        winning_plans = list(_winning_plans(explanation)) or [explanation]
+        if "COLLSCAN" in set(_plan_stages(winning_plans)):
+            scanning.append(description)
+            startup_log.warning("!!! QUERY PLAN: '%s' runs as a COLLECTION SCAN. Check REQUIRED_INDEXES in admin/config/indexes.py.", description)
+        else:
+            startup_log.info("Query plan OK: '%s'", description)
+    return scanning
+
+
+async def bootstrap_indexes(database):
+    """
+    Startup step: ensure REQUIRED_INDEXES, then check the canonical query plans.
+    """
+    if MONGO_ENSURE_INDEXES:
+        await ensure_indexes(database)
+    if MONGO_CHECK_QUERY_PLANS:
+        await check_query_plans(database)
@@ -0,0 +1,172 @@
+import os
+import zlib
+import atexit
+import logging
+import logging.handlers
+import queue
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+# Default level for every box-building stage
+BOX_LOG_LEVEL = os.environ.get("BOX_LOG_LEVEL", "INFO").upper()
+
+# Per-stage overrides, e.g. "filter=DEBUG,select=WARNING"
+BOX_LOG_STAGE_LEVELS = os.environ.get("BOX_LOG_STAGE_LEVELS", "")
+
+# Fraction of customers whose builds log a full decision trace (0 disables sampling)
+BOX_TRACE_SAMPLE_RATE = float(os.environ.get("BOX_TRACE_SAMPLE_RATE", "0"))
+
+# Comma-separated customerIDs that always log a full decision trace
+BOX_TRACE_CUSTOMER_IDS = {customer_id.strip() for customer_id in os.environ.get("BOX_TRACE_CUSTOMER_IDS", "").split(",") if customer_id.strip()}
+
+
+LOG_FORMAT = "%(asctime)s level=%(levelname)s stage=%(stage)s customerID=%(customerID)s %(message)s"
+
+_customer_id = ContextVar("box_log_customer_id", default="-")
+_trace_enabled = ContextVar("box_log_trace_enabled", default=False)
+
+_listener = None
+
+
+class _BoxContextFilter(logging.Filter):
+    """
+    Adds the stage and the customerID being built to every record.
+    """
+
+    def filter(self, record):
+        record.stage = record.name.rsplit(".", 1)[-1]
+        record.customerID = _customer_id.get()
+        return True
+
+
+def _snapshot_arg(arg):
+    if isinstance(arg, (list, dict, set)):
+        return arg.copy()
+    return arg
+
+
+class _DeferredFormatQueueHandler(logging.handlers.QueueHandler):
+    """
+    QueueHandler that enqueues records unformatted, so the listener thread formats them.
+
+    The stock prepare() formats every record in the calling thread. Arguments are copied
+    (shallowly) here instead, so a list the build keeps mutating is logged as it was.
+    """
+
+    def prepare(self, record):
+        if isinstance(record.args, dict):
+            record.args = _snapshot_arg(record.args)
+        elif record.args:
+            record.args = tuple(_snapshot_arg(arg) for arg in record.args)
+        if record.exc_info:
+            # Don't keep the traceback's frames alive in the queue
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+class StageLogger:
+    """
+    Logger for one stage of a box build.
+
+    Messages use lazy %-style arguments. Debug messages are emitted when the stage is at
+    DEBUG, or regardless of level when the current customer is being traced.
+    Guard expensive arguments with is_debug().
+    """
+
+    __slots__ = ("logger",)
+
+    def __init__(self, stage):
+        self.logger = logging.getLogger(f"admin.box.{stage}")
+
+    def is_debug(self):
+        return _trace_enabled.get() or self.logger.isEnabledFor(logging.DEBUG)
+
+    def debug(self, msg, *args):
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug(msg, *args, stacklevel=2)
+        elif _trace_enabled.get():
+            # Bypass the level check so traced builds log their decisions
+            self.logger.handle(self.logger.makeRecord(self.logger.name, logging.DEBUG, "", 0, msg, args, None))
+
+    def info(self, msg, *args):
+        self.logger.info(msg, *args, stacklevel=2)
+
+    def warning(self, msg, *args):
+        self.logger.warning(msg, *args, stacklevel=2)
+
+    def error(self, msg, *args):
+        self.logger.error(msg, *args, stacklevel=2)
+
+
+def get_stage_logger(stage):
+    return StageLogger(stage)
+
+
+@contextmanager
+def trace_customer(customer_id, force=False, sample=True):
+    """
+    Tag log records with customer_id and decide whether this build logs a full decision trace.
+
+    A trace is logged when forced (e.g. by the X-Box-Trace header), when the customer is listed
+    in BOX_TRACE_CUSTOMER_IDS, or for a BOX_TRACE_SAMPLE_RATE fraction of customers (always the
+    same ones, so a sampled customer's builds are all traced). Pass sample=False when the
+    sampling decision was already made (e.g. in a worker process).
+    """
+    traced = (
+        force or
+        customer_id in BOX_TRACE_CUSTOMER_IDS or
+        (sample and _sampled(customer_id))
+    )
+    customer_token = _customer_id.set(customer_id)
+    trace_token = _trace_enabled.set(traced)
+    try:
+        yield traced
+    finally:
+        _trace_enabled.reset(trace_token)
+        _customer_id.reset(customer_token)
+
+
+def _sampled(customer_id):
+    # Stable across requests and processes, unlike hash() or random()
+    if BOX_TRACE_SAMPLE_RATE <= 0:
+        return False
+    return zlib.crc32(str(customer_id).encode()) < BOX_TRACE_SAMPLE_RATE * 2 ** 32
+
+
+def _parse_stage_levels(value):
+    levels = {}
+    for entry in value.split(","):
+        if "=" not in entry:
+            continue
+        stage, level = entry.split("=", 1)
+        levels[stage.strip()] = level.strip().upper()
+    return levels
+
+
+def configure_logging():
+    """
+    Route admin.box logs through a queue so formatting and stdout writes happen on a
+    background thread instead of the event loop.
+    """
+    global _listener
+    if _listener is not None:
+        return
+
+    box_logger = logging.getLogger("admin.box")
+    box_logger.setLevel(BOX_LOG_LEVEL)
+    box_logger.propagate = False
+    for stage, level in _parse_stage_levels(BOX_LOG_STAGE_LEVELS).items():
+        logging.getLogger(f"admin.box.{stage}").setLevel(level)
+
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(logging.Formatter(LOG_FORMAT))
+
+    log_queue = queue.SimpleQueue()
+    queue_handler = _DeferredFormatQueueHandler(log_queue)
+    queue_handler.addFilter(_BoxContextFilter())
+    box_logger.addHandler(queue_handler)
+
+    _listener = logging.handlers.QueueListener(log_queue, stream_handler)
+    _listener.start()
+    atexit.register(_listener.stop)
@@ -1,11 +1,68 @@
+import asyncio
+from contextlib import asynccontextmanager
+
 from fastapi import FastAPI
-from fastapi.responses import RedirectResponse
+from fastapi.responses import RedirectResponse, PlainTextResponse
 from fastapi.middleware.cors import CORSMiddleware
 
+from admin.config.logging_config import configure_logging
+from admin.config import database
+from admin.config.indexes import bootstrap_indexes
+from admin.services.metrics_service import render_metrics, monitor_event_loop_lag
+from admin.services.draft_box_writer_service import replay_spooled_draft_boxes, close_draft_box_writers
+from admin.services.box_selection_pool_service import shutdown_selection_pool
+from admin.services.build_capture_service import build_capture
+from admin.services.snack_catalog_service import stop_snack_catalog_watchers
 from admin.routes.build_starting_box_routes import router as build_starting_box_router
+from admin.routes.build_starting_box_batch_routes import router as build_starting_box_batch_router
+from admin.routes.customer_profile_cache_routes import router as customer_profile_cache_router
+from admin.routes.box_profile_routes import router as box_profile_router
+
+# Send box-building logs through a background thread
+configure_logging()
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Create the Mongo client and open the pool's connections before serving any request
+    database.connect_database()
+    await database.warm_up_connection_pool()
+
+    # Declare the indexes the hot queries need and warn about collection scans
+    await bootstrap_indexes(database.boxes_db)
+
+    # Write draft boxes spooled to disk by a previous shutdown or failed write-behind batch
+    await replay_spooled_draft_boxes(database.monthly_draft_box_collection)
+
+    # Sample event loop lag for the /metrics endpoint
+    lag_monitor = asyncio.create_task(monitor_event_loop_lag())
+    try:
+        yield
+    finally:
+        # Flush write-behind draft boxes (spooling anything that can't be written)
+        await close_draft_box_writers()
+
+        # Stop the box selection worker processes
+        shutdown_selection_pool()
+
+        # Write out captured builds still queued for the capture file
+        build_capture.close()
+
+        lag_monitor.cancel()
+        try:
+            await lag_monitor
+        except asyncio.CancelledError:
+            pass
+
+        # Stop the snack catalog change stream watchers, or they fall back to polling a closed client
+        await stop_snack_catalog_watchers()
+
+        # Close the pool last: the draft box writers above still need it
+        database.close_database()
+
 
 # Initialize FastAPI app
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
 
 allowed_origins = [
     "https://88560556-a900-47e6-8007-e359b7ed3fd3-00-l5rqe8vdo9vu.picard.replit.dev",
@@ -28,6 +85,13 @@ app.add_middleware(
 
 # Include box-related routes
 app.include_router(build_starting_box_router, prefix="/api/v1")
+app.include_router(build_starting_box_batch_router, prefix="/api/v1")
+
+# Include customer profile cache routes
+app.include_router(customer_profile_cache_router, prefix="/api/v1")
+
+# Include build profile routes
+app.include_router(box_profile_router, prefix="/api/v1")
 
 
 # Root endpoint to redirect to Swagger UI
@@ -36,3 +100,7 @@ async def root():
     return RedirectResponse(url="/docs")
 
 
+# Prometheus scrape endpoint
+@app.get("/metrics", include_in_schema=False)
+async def metrics():
+    return PlainTextResponse(render_metrics(), media_type="text/plain; version=0.0.4")
@@ -1,5 +1,5 @@
 from pydantic import BaseModel, Field, EmailStr
-from typing import List, Optional, Dict
+from typing import List, Optional, Dict, Literal
 from uuid import uuid4
 
 
@@ -37,6 +37,16 @@ class BuildStartingBoxRequest(BaseModel):
     reset_total: int = 0
     repeat_monthly: List[SnackItem] = Field(default_factory=list)  # Default to []
 
+class PreferenceChange(BaseModel):  # One preference the customer just changed
+    kind: Literal["staple", "allergen"]
+    category: Optional[str] = Field(None, description="staple: the primary category whose staple amount changed")
+    amount: Optional[str] = Field(None, description="staple: the new amount ('one', 'a few' or 'many'), or None if it's no longer a staple")
+    previous_amount: Optional[str] = Field(None, description="staple: the amount before the change, or None if it wasn't a staple")
+    allergen: Optional[str] = Field(None, description="allergen: the allergen that was added")
+
+class RebuildStartingBoxRequest(BuildStartingBoxRequest):
+    change: PreferenceChange
+
 
 class Customer(BaseModel):
     customerID: str = Field(default_factory=lambda: str(uuid4()), unique=True)
@@ -0,0 +1,96 @@
+import sys
+
+
+def _intern(value):
+    return sys.intern(value) if isinstance(value, str) else value
+
+
+def _as_tuple(value):
+    if value is None:
+        return ()
+    if isinstance(value, (list, tuple)):
+        return tuple(_intern(item) for item in value)
+    return (_intern(value),)
+
+
+class SnackRecord:
+    """
+    Compact, immutable view of a snack document used by the box selection engine.
+
+    Records are built once per catalog load and shared by every request, so they can't be
+    modified. Category, brand, form and flavor strings are interned.
+    """
+
+    __slots__ = (
+        "snack_id",
+        "primary_category",
+        "secondary_category",
+        "form",
+        "brand",
+        "flavor_tags",
+        "allergens",
+        "product_line",
+        "premium",
+        "replacement_only",
+        "in_stock",
+        "approved",
+        "active",
+        "item_of_month_boost",
+        "total_score",
+        "high_protein_boost",
+        "low_carb_boost",
+        "low_calorie_boost",
+        "protein",
+        "carbs",
+        "calories",
+    )
+
+    def __init__(self, *values):
+        # Slot descriptors write directly, bypassing the immutable __setattr__
+        for descriptor, value in zip(_SLOT_DESCRIPTORS, values):
+            descriptor.__set__(self, value)
+
+    @classmethod
+    def from_document(cls, snack):
+        """
+        Build a record from a snacks collection document, applying the defaults the
+        selection engine has always used for missing fields.
+        """
+        return cls(
+            snack.get("SnackID"),
+            _intern(snack.get("primaryCategory")),
+            _intern(snack.get("secondaryCategory")),
+            _intern(snack.get("form")),
+            _intern(snack.get("brand")),
+            _as_tuple(snack.get("flavorTags")),
+            _as_tuple(snack.get("allergens")),
+            snack.get("productLine"),
+            snack.get("premium"),
+            snack.get("replacementOnly") is True,
+            snack.get("inStock") is True,
+            snack.get("approved") is True,
+            snack.get("active") is True,
+            snack.get("itemOfMonthBoost", 0),
+            snack.get("totalScore") or 0,
+            snack.get("highProteinBoost") or 0,
+            snack.get("lowCarbBoost") or 0,
+            snack.get("lowCalorieBoost") or 0,
+            snack.get("protein", 0),
+            snack.get("carbs", float('inf')),
+            snack.get("calories", float('inf')),
+        )
+
+    def __setattr__(self, name, value):
+        raise AttributeError("SnackRecord is immutable")
+
+    def __delattr__(self, name):
+        raise AttributeError("SnackRecord is immutable")
+
+    def __reduce__(self):
+        return (SnackRecord, tuple(getattr(self, slot) for slot in self.__slots__))
+
+    def __repr__(self):
+        return f"SnackRecord(SnackID={self.snack_id!r}, primaryCategory={self.primary_category!r}, secondaryCategory={self.secondary_category!r})"
+
+
+_SLOT_DESCRIPTORS = [getattr(SnackRecord, slot) for slot in SnackRecord.__slots__]
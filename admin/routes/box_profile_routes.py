@@ -0,0 +1,22 @@
+from fastapi import APIRouter, HTTPException
+from admin.services.box_profiling_service import list_profiles, summarize_profile, BOX_PROFILE_SUMMARY_TOP
+from admin.config.logging_config import get_stage_logger
+
+router = APIRouter()
+
+route_log = get_stage_logger("route")
+
+# Builds profiled with X-Box-Profile or ?profile=true on /build-starting-box, newest first
+@router.get("/box-profiles")
+async def list_box_profiles_endpoint():
+    return {"success": True, "data": list_profiles()}
+
+
+# Stage timings, hottest functions and largest allocation sites of one profiled build
+@router.get("/box-profiles/{profile_id}")
+async def box_profile_summary_endpoint(profile_id: str, top: int = BOX_PROFILE_SUMMARY_TOP):
+    route_log.info("Request received for the summary of build profile: %s", profile_id)
+    summary = summarize_profile(profile_id, top=top)
+    if summary is None:
+        raise HTTPException(status_code=404, detail=f"No build profile found with ID: {profile_id}")
+    return {"success": True, "data": summary}
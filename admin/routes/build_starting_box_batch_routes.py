@@ -0,0 +1,26 @@
+from typing import List
+from fastapi import APIRouter, HTTPException
+from admin.models.customers_model import BuildStartingBoxRequest
+from admin.services.build_starting_box_service import build_starting_boxes
+from admin.config.logging_config import get_stage_logger
+from admin.config import database
+
+router = APIRouter()
+
+route_log = get_stage_logger("route")
+
+@router.post("/build-starting-box/batch")
+async def build_starting_box_batch_endpoint(
+    requests: List[BuildStartingBoxRequest]  # One entry per customer box
+):
+    route_log.info("Request received for /build-starting-box/batch with %s customers", len(requests))
+    try:
+        results = await build_starting_boxes(
+            requests=requests,
+            monthly_draft_box_collection=database.monthly_draft_box_collection,
+            all_customers_collection=database.all_customers_collection,
+            all_snacks_collection=database.all_snacks_collection
+        )
+        return {"success": True, "data": results}
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"An error occurred: {str(e)}")
@@ -1,20 +1,27 @@
-from fastapi import APIRouter, HTTPException
+import asyncio
+from typing import Optional
+from fastapi import APIRouter, HTTPException, Header, Query
 from pydantic import BaseModel
-from admin.models.customers_model import BuildStartingBoxRequest  # Import from models.py
-from admin.services.build_starting_box_service import build_starting_box  # Import the service
-from admin.config.database import (
-    monthly_draft_box_collection,
-    all_customers_collection,
-    all_snacks_collection,
-)
+from admin.models.customers_model import BuildStartingBoxRequest, RebuildStartingBoxRequest  # Import from models.py
+from admin.services.build_starting_box_service import build_starting_box, rebuild_starting_box  # Import the service
+from admin.services.box_profiling_service import BoxProfile
+from admin.config.logging_config import get_stage_logger
+from admin.config import database
 
 router = APIRouter()
 
+route_log = get_stage_logger("route")
+
 @router.post("/build-starting-box")
 async def build_starting_box_endpoint(
-    request: BuildStartingBoxRequest  # Use the model to parse the body
+    request: BuildStartingBoxRequest,  # Use the model to parse the body
+    x_box_trace: bool = Header(False),  # Log this build's full decision trace
+    idempotency_key: Optional[str] = Header(None),  # Retries with the same key get the same box
+    x_box_profile: bool = Header(False),  # Save cProfile and tracemalloc data for this build
+    profile: bool = Query(False),  # Same as X-Box-Profile
 ):
-    print(f"Request received for /build-starting-box with ID: {request.customerID} and new_signup: {request.new_signup} and off_cycle: {request.off_cycle}")
+    route_log.info("Request received for /build-starting-box with ID: %s and new_signup: %s and off_cycle: %s", request.customerID, request.new_signup, request.off_cycle)
+    box_profile = BoxProfile(request.customerID) if x_box_profile or profile else None
     try:
         result = await build_starting_box(
             customerID=request.customerID, 
@@ -24,10 +31,50 @@ async def build_starting_box_endpoint(
             is_reset_box=request.is_reset_box,  # Include optional field
             reset_total=request.reset_total,  # Include optional field
             repeat_monthly=request.repeat_monthly,
-            monthly_draft_box_collection=monthly_draft_box_collection,
-            all_customers_collection=all_customers_collection,
-            all_snacks_collection=all_snacks_collection
+            trace=x_box_trace,
+            idempotency_key=idempotency_key,
+            monthly_draft_box_collection=database.monthly_draft_box_collection,
+            all_customers_collection=database.all_customers_collection,
+            all_snacks_collection=database.all_snacks_collection,
+            profile=box_profile,
         )
+        if box_profile is not None:
+            return {"success": True, "data": result, "profile": await save_profile(box_profile)}
         return {"success": True, "data": result}
     except Exception as e:
-        raise HTTPException(status_code=500, detail=f"An error occurred: {str(e)}")
\ No newline at end of file
+        if box_profile is not None:
+            await save_profile(box_profile)
+        raise HTTPException(status_code=500, detail=f"An error occurred: {str(e)}")
+
+
+# Called by the web app after a customer changes one staple or adds one allergen
+@router.post("/build-starting-box/rebuild")
+async def rebuild_starting_box_endpoint(request: RebuildStartingBoxRequest):
+    route_log.info("Request received for /build-starting-box/rebuild with ID: %s and change: %s", request.customerID, request.change.kind)
+    try:
+        result = await rebuild_starting_box(
+            customerID=request.customerID,
+            change=request.change,
+            new_signup=request.new_signup,
+            repeat_customer=request.repeat_customer,
+            off_cycle=request.off_cycle,
+            is_reset_box=request.is_reset_box,
+            reset_total=request.reset_total,
+            repeat_monthly=request.repeat_monthly,
+            monthly_draft_box_collection=database.monthly_draft_box_collection,
+            all_customers_collection=database.all_customers_collection,
+            all_snacks_collection=database.all_snacks_collection,
+        )
+        return {"success": True, "data": result}
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"An error occurred: {str(e)}")
+
+
+async def save_profile(box_profile):
+    # Profiling must not fail the build it describes
+    try:
+        metadata = await asyncio.to_thread(box_profile.save)
+        return metadata["profileID"]
+    except Exception as e:
+        route_log.error("Could not save build profile %s: %s", box_profile.profile_id, e)
+        return None
\ No newline at end of file
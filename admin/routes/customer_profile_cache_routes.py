@@ -0,0 +1,28 @@
+from fastapi import APIRouter, HTTPException
+from admin.services.customer_profile_cache_service import customer_profile_cache
+from admin.services.idempotency_service import forget_idempotent_builds
+from admin.config.logging_config import get_stage_logger
+from admin.config import database
+
+router = APIRouter()
+
+route_log = get_stage_logger("route")
+
+# Called by the web app whenever a customer edits their preferences
+@router.delete("/customer-profile-cache/{customerID}")
+async def invalidate_customer_profile_endpoint(customerID: str):
+    """
+    Drop a customer's cached profile and the builds that can be replayed for them.
+
+    The profile cache lives in each worker process, so this only clears the cache of the worker
+    that handled the call. Other workers keep serving their copy until it expires
+    (CUSTOMER_PROFILE_CACHE_TTL_SECONDS).
+    """
+    route_log.info("Request received to invalidate the cached profile of customer: %s", customerID)
+    removed = customer_profile_cache.invalidate(customerID)
+    try:
+        # A retried build must not return the box built from the old profile
+        await forget_idempotent_builds(customerID, database.monthly_draft_box_collection)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"An error occurred: {str(e)}")
+    return {"success": True, "data": {"customerID": customerID, "invalidated": removed}}
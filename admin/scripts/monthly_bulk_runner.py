@@ -0,0 +1,234 @@
+"""
+Build the monthly draft boxes for every eligible customer from the command line.
+
+    python -m admin.scripts.monthly_bulk_runner --concurrency 32 --batch-size 500
+
+Customers are streamed from the customers collection with a cursor and built against the
+shared in-memory snack catalog, at most --concurrency at a time, with their repeatMonthly
+snacks. Boxes are written with unordered bulk_write batches. Every customer whose box was
+written (or came out empty) is appended to the checkpoint file, so rerunning after a crash
+skips them. The default checkpoint file is named after the month being built, so next
+month's run starts from scratch.
+"""
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+from pymongo import InsertOne
+from pymongo.errors import BulkWriteError
+from admin.config.logging_config import configure_logging, get_stage_logger
+from admin.models.customers_model import SnackItem
+from admin.services.snack_catalog_service import get_snack_catalog
+from admin.services.build_starting_box_service import build_starting_box_document, draft_box_month, CUSTOMER_PROFILE_PROJECTION
+
+# Default number of boxes built at the same time
+BULK_RUN_CONCURRENCY = int(os.environ.get("BULK_RUN_CONCURRENCY", "32"))
+
+# Default number of boxes per bulk_write
+BULK_RUN_BATCH_SIZE = int(os.environ.get("BULK_RUN_BATCH_SIZE", "500"))
+
+# Customers that get a monthly box (override with --query)
+ELIGIBLE_CUSTOMERS_QUERY = {"customerID": {"$exists": True}, "subscription_type": {"$gt": 0}}
+
+bulk_log = get_stage_logger("bulk")
+
+
+def default_checkpoint_path(off_cycle=False):
+    """
+    Checkpoint file for the month (and cycle) a run started now builds boxes for.
+    """
+    return f"monthly_bulk_run_{draft_box_month(off_cycle):04d}{'_off_cycle' if off_cycle else ''}.checkpoint"
+
+
+def repeat_monthly_items(customer_document, snapshot):
+    """
+    The customer's repeatMonthly snacks as SnackItems, as the per-customer endpoint receives them.
+    Stored snacks without a premium flag take it from the catalog.
+    """
+    items = []
+    for snack in customer_document.get("repeatMonthly") or []:
+        premium = snack.get("premium")
+        if premium is None:
+            positions = snapshot.index.snack_positions.get(snack["SnackID"])
+            premium = snapshot.snacks[positions[0]].premium if positions else False
+        items.append(SnackItem(SnackID=snack["SnackID"], count=snack["count"], primaryCategory=snack["primaryCategory"], premium=premium))
+    return items
+
+
+def load_checkpoint(checkpoint_path):
+    """
+    customerIDs recorded as done by a previous run (one per line).
+    """
+    if not checkpoint_path or not os.path.exists(checkpoint_path):
+        return set()
+    with open(checkpoint_path) as checkpoint_file:
+        return {line.strip() for line in checkpoint_file if line.strip()}
+
+
+def append_checkpoint(checkpoint_path, customer_ids):
+    if not checkpoint_path or not customer_ids:
+        return
+    with open(checkpoint_path, "a") as checkpoint_file:
+        checkpoint_file.write("".join(f"{customer_id}\n" for customer_id in customer_ids))
+        checkpoint_file.flush()
+        os.fsync(checkpoint_file.fileno())
+
+
+async def run_monthly_bulk(
+    monthly_draft_box_collection,
+    all_customers_collection,
+    all_snacks_collection,
+    query=None,
+    concurrency=BULK_RUN_CONCURRENCY,
+    batch_size=BULK_RUN_BATCH_SIZE,
+    checkpoint_path=None,
+    off_cycle=False,
+):
+    """
+    Build and save a box for every customer matching `query`.
+
+    Args:
+        query (dict): Customers to build for. Defaults to ELIGIBLE_CUSTOMERS_QUERY.
+        concurrency (int): Boxes built at the same time.
+        batch_size (int): Boxes per bulk_write.
+        checkpoint_path (str): File of finished customerIDs, read on start and appended after every batch.
+        off_cycle (bool): Build off-cycle boxes.
+
+    Returns:
+        dict: Throughput report.
+    """
+    started = time.perf_counter()
+    catalog = await get_snack_catalog(all_snacks_collection)
+    done = load_checkpoint(checkpoint_path)
+    bulk_log.info("Bulk run: catalog version %s, %s customers already done", catalog.version, len(done))
+
+    report = {"customers": 0, "skipped": 0, "written": 0, "empty": 0, "failed": 0, "write_failed": 0}
+    build_seconds = []
+    pending = []  # (customerID, document) waiting for the next bulk_write
+    semaphore = asyncio.Semaphore(concurrency)
+    write_lock = asyncio.Lock()
+    tasks = set()
+
+    async def flush():
+        async with write_lock:
+            if not pending:
+                return
+            batch = pending[:]
+            del pending[:]
+            failed_ids = set()
+            try:
+                await monthly_draft_box_collection.bulk_write([InsertOne(document) for _, document in batch], ordered=False)
+            except BulkWriteError as e:
+                for write_error in e.details.get("writeErrors", []):
+                    customer_id = batch[write_error["index"]][0]
+                    failed_ids.add(customer_id)
+                    bulk_log.error("Could not save the box for customer %s: %s", customer_id, write_error.get("errmsg"))
+            written_ids = [customer_id for customer_id, _ in batch if customer_id not in failed_ids]
+            report["written"] += len(written_ids)
+            report["write_failed"] += len(failed_ids)
+            append_checkpoint(checkpoint_path, written_ids)
+            bulk_log.info("Bulk run: saved %s boxes (%s written so far)", len(written_ids), report["written"])
+
+    async def build_one(customer_document):
+        customer_id = customer_document["customerID"]
+        try:
+            build_started = time.perf_counter()
+            document = await build_starting_box_document(
+                customerID=customer_id,
+                new_signup=False,
+                repeat_customer=True,
+                off_cycle=off_cycle,
+                is_reset_box=False,
+                reset_total=0,
+                monthly_draft_box_collection=monthly_draft_box_collection,
+                all_customers_collection=all_customers_collection,
+                all_snacks_collection=all_snacks_collection,
+                repeat_monthly=repeat_monthly_items(customer_document, catalog.snapshot),
+                customer_document=customer_document,
+            )
+            build_seconds.append(time.perf_counter() - build_started)
+            if document:
+                pending.append((customer_id, document))
+                if len(pending) >= batch_size:
+                    await flush()
+            else:
+                report["empty"] += 1
+                append_checkpoint(checkpoint_path, [customer_id])
+        except Exception as e:
+            report["failed"] += 1
+            bulk_log.error("An error occurred while building the box for customer %s: %s", customer_id, e)
+        finally:
+            semaphore.release()
+
+    cursor = all_customers_collection.find(
+        query if query is not None else ELIGIBLE_CUSTOMERS_QUERY,
+        {**CUSTOMER_PROFILE_PROJECTION, "customerID": 1, "repeatMonthly": 1},
+        batch_size=batch_size,
+    )
+    async for customer_document in cursor:
+        report["customers"] += 1
+        if not customer_document.get("customerID") or customer_document["customerID"] in done:
+            report["skipped"] += 1
+            continue
+        # Backpressure: don't read further ahead than the builds in flight
+        await semaphore.acquire()
+        task = asyncio.create_task(build_one(customer_document))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+
+    if tasks:
+        await asyncio.gather(*tasks)
+    await flush()
+    await catalog.stop_watching()
+
+    elapsed = time.perf_counter() - started
+    built = len(build_seconds)
+    build_seconds.sort()
+    report.update({
+        "built": built,
+        "elapsed_seconds": round(elapsed, 3),
+        "boxes_per_second": round(report["written"] / elapsed, 2) if elapsed else 0.0,
+        "build_p50_ms": round(build_seconds[built // 2] * 1000, 2) if built else None,
+        "build_p99_ms": round(build_seconds[min(built - 1, int(built * 0.99))] * 1000, 2) if built else None,
+    })
+    return report
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Build monthly draft boxes for all eligible customers.")
+    parser.add_argument("--concurrency", type=int, default=BULK_RUN_CONCURRENCY, help="Boxes built at the same time.")
+    parser.add_argument("--batch-size", type=int, default=BULK_RUN_BATCH_SIZE, help="Boxes per bulk_write.")
+    parser.add_argument("--checkpoint", default=None, help="File of finished customerIDs used to resume a run (default: one per target month).")
+    parser.add_argument("--query", type=json.loads, default=None, help="JSON filter for eligible customers.")
+    parser.add_argument("--off-cycle", action="store_true", help="Build off-cycle boxes.")
+    return parser.parse_args(argv)
+
+
+async def main(argv=None):
+    args = parse_args(argv)
+    configure_logging()
+    from admin.config import database
+
+    database.connect_database()
+    try:
+        report = await run_monthly_bulk(
+            database.monthly_draft_box_collection,
+            database.all_customers_collection,
+            database.all_snacks_collection,
+            query=args.query,
+            concurrency=args.concurrency,
+            batch_size=args.batch_size,
+            checkpoint_path=args.checkpoint or default_checkpoint_path(args.off_cycle),
+            off_cycle=args.off_cycle,
+        )
+    finally:
+        database.close_database()
+    bulk_log.info("Bulk run finished: %s", report)
+    print(json.dumps(report, indent=2))
+    return 0 if report["failed"] == 0 and report["write_failed"] == 0 else 1
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main()))
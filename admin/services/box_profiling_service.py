@@ -0,0 +1,182 @@
+import os
+import re
+import json
+import time
+import uuid
+import pstats
+import cProfile
+import tracemalloc
+from datetime import datetime
+from admin.config.logging_config import get_stage_logger
+
+# Directory for profiles of builds requested with X-Box-Profile or ?profile=true
+BOX_PROFILE_DIR = os.environ.get("BOX_PROFILE_DIR", "box_profiles")
+
+# Profiles kept on disk (the oldest are removed first)
+BOX_PROFILE_KEEP = int(os.environ.get("BOX_PROFILE_KEEP", "50"))
+
+# Functions and allocation sites listed in a profile summary
+BOX_PROFILE_SUMMARY_TOP = 20
+
+# Profile IDs are file name stems: timestamp, sanitized customerID and a random suffix
+PROFILE_ID_PATTERN = re.compile(r"^[A-Za-z0-9_.-]+$")
+
+profile_log = get_stage_logger("profile")
+
+
+class BoxProfile:
+    """
+    Profile of one build: the wall time of its stages, plus cProfile stats and a tracemalloc
+    snapshot of its box selection.
+
+    Only the selection is run under the profilers. It's synchronous (a profiled build runs it
+    inline, even with a selection pool), so no other request's work ends up in the stats;
+    the awaited stages around it are only timed.
+    """
+
+    def __init__(self, customer_id):
+        self.customer_id = customer_id
+        self.profile_id = "{}_{}_{}".format(
+            datetime.utcnow().strftime("%Y%m%dT%H%M%S"),
+            re.sub(r"[^A-Za-z0-9_.-]", "_", str(customer_id))[:64],
+            uuid.uuid4().hex[:8],
+        )
+        self.started = time.perf_counter()
+        self.stage_seconds = {}
+        self.selection_stage_seconds = {}
+        self.profiler = None
+        self.snapshot = None
+        self.traced_peak_bytes = None
+        self.box_size = None
+
+    def record_stage(self, stage, seconds):
+        self.stage_seconds[stage] = self.stage_seconds.get(stage, 0.0) + seconds
+
+    def run_selection(self, select, stats):
+        """
+        Run `select()` under cProfile and tracemalloc.
+
+        Args:
+            select (callable): Zero-argument function selecting the box.
+            stats (SelectionStats): The selection's stats, for its stage timings.
+        """
+        was_tracing = tracemalloc.is_tracing()
+        if was_tracing:
+            tracemalloc.reset_peak()
+        else:
+            tracemalloc.start()
+        self.profiler = cProfile.Profile()
+        started = time.perf_counter()
+        self.profiler.enable()
+        try:
+            return select()
+        finally:
+            self.profiler.disable()
+            self.record_stage("select", time.perf_counter() - started)
+            _, self.traced_peak_bytes = tracemalloc.get_traced_memory()
+            self.snapshot = tracemalloc.take_snapshot().filter_traces((tracemalloc.Filter(False, tracemalloc.__file__),))
+            if not was_tracing:
+                tracemalloc.stop()
+            for stage, seconds in stats.stage_seconds:
+                self.selection_stage_seconds[stage] = self.selection_stage_seconds.get(stage, 0.0) + seconds
+
+    def save(self, directory=BOX_PROFILE_DIR):
+        """
+        Write the profile's files (blocking: call it off the event loop) and prune old profiles.
+
+        Returns:
+            dict: The profile's metadata, as listed by list_profiles.
+        """
+        os.makedirs(directory, exist_ok=True)
+        base = os.path.join(directory, self.profile_id)
+        if self.profiler is not None:
+            self.profiler.dump_stats(f"{base}.prof")
+        if self.snapshot is not None:
+            self.snapshot.dump(f"{base}.tracemalloc")
+        metadata = {
+            "profileID": self.profile_id,
+            "customerID": self.customer_id,
+            "capturedAt": datetime.utcnow().isoformat(),
+            "total_ms": round((time.perf_counter() - self.started) * 1000, 3),
+            "stages_ms": {stage: round(seconds * 1000, 3) for stage, seconds in self.stage_seconds.items()},
+            "selection_stages_ms": {stage: round(seconds * 1000, 3) for stage, seconds in self.selection_stage_seconds.items()},
+            "traced_peak_bytes": self.traced_peak_bytes,
+            "box_size": self.box_size,
+        }
+        with open(f"{base}.json", "w") as metadata_file:
+            json.dump(metadata, metadata_file, indent=2)
+        _prune_profiles(directory)
+        profile_log.info("Saved build profile %s (%sms)", self.profile_id, metadata["total_ms"])
+        return metadata
+
+
+def _metadata_paths(directory):
+    if not os.path.isdir(directory):
+        return []
+    paths = [os.path.join(directory, name) for name in os.listdir(directory) if name.endswith(".json")]
+    return sorted(paths, key=os.path.getmtime, reverse=True)
+
+
+def _prune_profiles(directory, keep=BOX_PROFILE_KEEP):
+    for path in _metadata_paths(directory)[keep:]:
+        base = path[:-len(".json")]
+        for suffix in (".json", ".prof", ".tracemalloc"):
+            try:
+                os.remove(base + suffix)
+            except FileNotFoundError:
+                pass
+
+
+def list_profiles(directory=BOX_PROFILE_DIR):
+    """
+    Metadata of the saved profiles, newest first.
+    """
+    profiles = []
+    for path in _metadata_paths(directory):
+        try:
+            with open(path) as metadata_file:
+                profiles.append(json.load(metadata_file))
+        except (OSError, ValueError):
+            continue  # Removed or still being written
+    return profiles
+
+
+def summarize_profile(profile_id, directory=BOX_PROFILE_DIR, top=BOX_PROFILE_SUMMARY_TOP):
+    """
+    A saved profile's metadata with its most expensive functions (by cumulative time) and the
+    allocation sites holding the most memory when the selection finished.
+
+    Returns:
+        dict: The summary, or None if there is no such profile.
+    """
+    if not PROFILE_ID_PATTERN.match(profile_id):
+        return None
+    base = os.path.join(directory, profile_id)
+    try:
+        with open(f"{base}.json") as metadata_file:
+            summary = json.load(metadata_file)
+    except FileNotFoundError:
+        return None
+
+    summary["functions"] = []
+    if os.path.exists(f"{base}.prof"):
+        stats = pstats.Stats(f"{base}.prof")
+        rows = sorted(stats.stats.items(), key=lambda item: item[1][3], reverse=True)[:top]
+        summary["functions"] = [
+            {
+                "function": f"{filename}:{line}({name})",
+                "calls": calls,
+                "tottime_ms": round(tottime * 1000, 3),
+                "cumtime_ms": round(cumtime * 1000, 3),
+            }
+            for (filename, line, name), (_, calls, tottime, cumtime, _) in rows
+        ]
+
+    summary["allocations"] = []
+    if os.path.exists(f"{base}.tracemalloc"):
+        snapshot = tracemalloc.Snapshot.load(f"{base}.tracemalloc")
+        summary["allocations"] = [
+            {"location": str(statistic.traceback[0]), "size_bytes": statistic.size, "count": statistic.count}
+            for statistic in snapshot.statistics("lineno")[:top]
+        ]
+    return summary
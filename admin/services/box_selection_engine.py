@@ -0,0 +1,611 @@
+import time
+from collections import defaultdict
+from admin.services.snack_candidates_service import CategoryCandidates, UsageTracker
+from admin.services.flavor_stem_service import flavor_stem
+from admin.services.staple_planner_service import plan_staples
+from admin.config.logging_config import get_stage_logger
+from admin.services.metrics_service import (
+    BUILD_STAGE_SECONDS,
+    SAFE_SNACKS,
+    CANDIDATES_SCANNED,
+    RELAXATION_TIERS,
+    SECONDARY_CATEGORY_MISSES,
+    EXTEND4_FALLBACKS,
+)
+
+# One logger per build stage (levels and per-customer traces are set in admin.config.logging_config)
+filter_log = get_stage_logger("filter")
+score_log = get_stage_logger("score")
+staples_log = get_stage_logger("staples")
+select_log = get_stage_logger("select")
+extend_log = get_stage_logger("extend")
+
+
+class SelectionStats:
+    """
+    Metrics collected while selecting one box.
+
+    The engine may run in a worker process whose metrics are never scraped, so it records
+    into this (picklable) object and the caller publishes it with record().
+    """
+
+    def __init__(self):
+        self.stage_seconds = []
+        self.safe_snacks = None
+        self.candidates_scanned = None
+        self.relaxation_tiers = defaultdict(int)
+        self.secondary_category_misses = 0
+        self.extend4_fallbacks = 0
+
+    def stage(self, stage):
+        return _StageTimer(self, stage)
+
+    def record(self):
+        for stage, seconds in self.stage_seconds:
+            BUILD_STAGE_SECONDS.observe(seconds, stage=stage)
+        if self.safe_snacks is not None:
+            SAFE_SNACKS.observe(self.safe_snacks)
+        if self.candidates_scanned is not None:
+            CANDIDATES_SCANNED.observe(self.candidates_scanned)
+        for tier, count in self.relaxation_tiers.items():
+            RELAXATION_TIERS.inc(count, tier=tier)
+        if self.secondary_category_misses:
+            SECONDARY_CATEGORY_MISSES.inc(self.secondary_category_misses)
+        if self.extend4_fallbacks:
+            EXTEND4_FALLBACKS.inc(self.extend4_fallbacks)
+
+
+class _StageTimer:
+    __slots__ = ("stats", "stage", "started")
+
+    def __init__(self, stats, stage):
+        self.stats = stats
+        self.stage = stage
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.stats.stage_seconds.append((self.stage, time.perf_counter() - self.started))
+        return False
+
+
+# ========================================================================================================================== 1. FILTER SNACKS
+
+def fetch_snacks_filtered(catalog, allergens=None, vetoedFlavors=None, dislikedCategories=None, off_cycle=False, previous_snack_ids=None, repeat_monthly=None):
+    try:
+        filter_log.debug("FILTERING SNACKS")
+        # Filters are applied in memory against the catalog snapshot (replacementOnly snacks are always excluded)
+
+        # Combine all SnackID exclusions
+        excluded_snack_ids = set()
+
+        # Add repeat_monthly SnackIDs to excluded list
+        if repeat_monthly and isinstance(repeat_monthly, list):
+            filter_log.debug("d. Adding Repeat Monthly SnackIDs to filters")
+            repeat_snack_ids = [str(item["SnackID"]).strip().upper() for item in repeat_monthly if isinstance(item, dict) and "SnackID" in item]
+            excluded_snack_ids.update(repeat_snack_ids)
+            filter_log.debug("Repeat SnackIDs: %s", repeat_snack_ids)
+        else:
+            filter_log.debug("repeat_monthly is empty or invalid")
+
+        # Add most_recent_snack_ids to excluded list
+        if previous_snack_ids:
+            filter_log.debug("d. Adding Most Recent SnackID exclusion to filters")
+            recent_snack_ids = [str(id).strip().upper() for id in previous_snack_ids]
+            excluded_snack_ids.update(recent_snack_ids)
+            filter_log.debug("Most Recent SnackIDs: %s", recent_snack_ids)
+
+        # Apply combined SnackID filter
+        if excluded_snack_ids:
+            filter_log.debug("Excluded SnackIDs: %s", excluded_snack_ids)
+
+        # Filter by allergens if provided
+        if allergens:
+            filter_log.debug("a. Adding Allergens to filters")
+
+        # Filter by vetoed flavors if provided
+        if vetoedFlavors:
+            filter_log.debug("b. Adding Vetoed Flavors to filters")
+            # Matched against the catalog's flavor stem index (every inflection of each flavor)
+            if filter_log.is_debug():
+                filter_log.debug("Vetoed flavor stems: %s", [flavor_stem(flavor) for flavor in vetoedFlavors])
+
+        # Filter by disliked categories if provided
+        if dislikedCategories:
+            filter_log.debug("c. Adding Disliked Categories to filters")
+
+        # Filter by off-cycle if provided
+        if off_cycle:
+            filter_log.debug("c. Adding Off-Cycle to filters")
+
+        # Filter the catalog snapshot with the combined filters
+        positions = catalog.filter_positions(
+            allergens=allergens,
+            vetoed_flavors=vetoedFlavors,
+            disliked_categories=dislikedCategories,
+            off_cycle=off_cycle,
+            excluded_snack_ids=excluded_snack_ids,
+        )
+        filter_log.debug("Catalog version: %s", catalog.version)
+
+        # Log returned SnackIDs for debugging
+        if filter_log.is_debug():
+            returned_snack_ids = [catalog.snacks[position].snack_id for position in positions]
+            filter_log.debug("Returned SnackIDs: %s", returned_snack_ids)
+
+            # Check if any excluded SnackIDs are in results
+            if excluded_snack_ids and any(snack_id in excluded_snack_ids for snack_id in returned_snack_ids):
+                filter_log.warning("Excluded SnackIDs found in results: %s", set(returned_snack_ids) & excluded_snack_ids)
+
+        # Print the count of snacks returned
+        filter_log.debug("e. Number of snacks returned: %s", len(positions))
+
+        return positions
+
+    except Exception as e:
+        filter_log.error("An error occurred while retrieving snacks: %s", e)
+        return []
+
+
+# ============================================================================================ PREPARE: GROUP INTO CATEGORIES
+
+def group_snacks_by_primary_category(snacks, priority_setting):
+    grouped_snacks = defaultdict(list)
+
+    for rank, snack in enumerate(snacks):
+        # Check if snack has a primaryCategory
+        primary_category = snack.primary_category
+
+        if not primary_category:
+            score_log.warning("Skipping snack with missing primaryCategory: %s", snack)
+            continue
+
+        # Use the category as is (no normalization)
+        grouped_snacks[primary_category.strip()].append((rank, snack))
+
+    # Index each category's candidates for add_snacks_loop
+    return {
+        category: CategoryCandidates(ranked_snacks, priority_setting)
+        for category, ranked_snacks in grouped_snacks.items()
+    }
+
+
+# ============================================================================================ 3. ADD SNACKS
+
+def add_snacks_loop(category, desired_count, grouped_snacks, context, previous_snack_ids, stats):
+    """
+    Loops through the snacks in a single category and adds snacks to the context's month_start_box
+    until either the desired count is reached or the secondary category increment exceeds 15.
+
+    Parameters:
+    - category: The category of snacks to process (string).
+    - desired_count: Integer specifying the number of snacks to add for the category.
+    - grouped_snacks: CategoryCandidates holding the remaining snacks for the specific category.
+    - context: Dict to hold the output, specifically the 'month_start_box'.
+    - previous_snack_ids: Set of SnackIDs to avoid reusing.
+    - stats: SelectionStats collecting this build's metrics.
+
+    Returns:
+    - None (modifies the context in place).
+    """
+
+    next_snacks = []
+    secondary_category_increment = 0
+    most_recent_saved_secondary_category = 0
+
+    # Extract unique values for secondary categories, forms, brands, and flavor tags
+    secondary_category_values = list(set(snack.secondary_category for snack in grouped_snacks))
+    form_values = set(snack.form for snack in grouped_snacks)
+    brand_values = set(snack.brand for snack in grouped_snacks)
+    flavor_tag_values = set(tag for snack in grouped_snacks for tag in snack.flavor_tags)
+
+    # Print the unique values
+    select_log.debug(
+        "Unique Secondary Categories: %s, Forms: %s, Brands: %s, Flavor Tags: %s",
+        secondary_category_values, form_values, brand_values, flavor_tag_values
+    )
+
+    # Initialize usage count (least used values are tracked incrementally)
+    brand_usage = UsageTracker(brand_values)
+    flavor_tag_usage = UsageTracker(flavor_tag_values)
+    form_usage = UsageTracker(form_values)
+
+    # Build the box
+    while len(next_snacks) < desired_count:
+        if secondary_category_increment > 15:
+            select_log.warning("Secondary category increment exceeded limit for category '%s'. Breaking loop.", category)
+            break
+
+        # Determine the current category and form
+        current_category = secondary_category_values[(secondary_category_increment + most_recent_saved_secondary_category) % len(secondary_category_values)]
+
+        # Find the best snack, relaxing flavor tags, then brand, then form if nothing matches
+        tier, rank, selected_snack = grouped_snacks.find(
+            current_category,
+            secondary_category_increment,
+            least_used_forms=form_usage.least_used(),
+            least_used_brands=brand_usage.least_used(),
+            least_used_flavor_tags=flavor_tag_usage.least_used(),
+            previous_snack_ids=previous_snack_ids,
+        )
+
+        # If still no matches, increment secondary category and continue
+        if selected_snack is None:
+            stats.secondary_category_misses += 1
+            select_log.debug("No matches found for category '%s', secondary category '%s'. Incrementing.", category, current_category)
+            secondary_category_increment += 1
+            continue
+
+        next_snacks.append(selected_snack)
+        stats.relaxation_tiers[tier] += 1
+
+        # Log the SnackID of the added snack
+        select_log.debug("Added to next_snacks: %s (secondary category: %s, tier: %s)", selected_snack.snack_id, current_category, tier)
+
+        # Update usage counts
+        brand_usage.increment(selected_snack.brand)
+        for tag in selected_snack.flavor_tags:
+            flavor_tag_usage.increment(tag)
+        form_usage.increment(selected_snack.form)
+
+        # Remove selected snack from the category candidates
+        grouped_snacks.remove(rank)
+
+        # Reset increment and rotate form
+        most_recent_saved_secondary_category += 1
+        secondary_category_increment = 0
+
+    # Add results to the context
+    context["month_start_box"].extend(
+        {
+            "SnackID": snack.snack_id,
+            "primaryCategory": category,
+            "productLine": snack.product_line,
+            "count": 1,
+            "premium": snack.premium,
+        }
+        for snack in next_snacks
+    )
+
+    if select_log.is_debug():
+        select_log.debug("Final snacks added for category '%s': %s", category, [snack.snack_id for snack in next_snacks])
+
+
+### STAPLES
+
+def process_staples(transformed_staples, grouped_snacks, context, previous_snack_ids, stats):
+    """
+    Processes each category in transformed_staples by calling add_snacks_loop
+    to add snacks to the context's month_start_box.
+
+    Parameters:
+    - transformed_staples: Dict of staples with their respective counts.
+    - grouped_snacks: Dict where keys are categories, and values are CategoryCandidates.
+    - context: Dict to hold the output, specifically the 'month_start_box'.
+
+    Returns:
+    - None (modifies the context in place).
+    """
+    for category, count in transformed_staples.items():
+        staples_log.debug("Processing category: %s with desired count: %s", category, count)
+
+        # Pass only the snacks for the current category
+        snacks_for_category = grouped_snacks.get(category, [])
+
+        # Print the length of snacks for the current category
+        staples_log.debug("Number of snacks available for category '%s': %s", category, len(snacks_for_category))
+
+        if not snacks_for_category:
+            staples_log.warning("No snacks found for category '%s'. Skipping...", category)
+            continue
+
+        # Call add_snacks_loop with the filtered snacks
+        add_snacks_loop(
+            category=category,
+            desired_count=count,
+            grouped_snacks=snacks_for_category,
+            context=context,
+            previous_snack_ids=previous_snack_ids,
+            stats=stats
+        )
+
+
+### REMAINING CATEGORIES
+
+def process_remaining_categories(remaining_categories, count_to_fill, grouped_snacks, context, previous_snack_ids, stats):
+    """
+    Processes each category in remaining_categories by calling add_snacks_loop
+    to dynamically distribute snacks across categories and add them to the context's month_start_box.
+
+    Parameters:
+    - remaining_categories (list): A list of category names to process.
+    - count_to_fill (int): Total number of snacks to be added across all categories.
+    - grouped_snacks (dict): A dictionary where keys are category names and values are CategoryCandidates.
+    - context (dict): A dictionary to hold the output, specifically the 'month_start_box'.
+    - previous_snack_ids (list): List of previously selected snack IDs to avoid duplicates.
+
+    Returns:
+    - None: Modifies the context in place.
+    """
+    # Validate inputs
+    if not isinstance(remaining_categories, list):
+        raise ValueError("remaining_categories must be a list.")
+    if not isinstance(grouped_snacks, dict):
+        raise ValueError("grouped_snacks must be a dictionary.")
+    if not isinstance(count_to_fill, int) or count_to_fill <= 0:
+        raise ValueError("count_to_fill must be a positive integer.")
+
+    # Filter out categories in context["category_dislikes"]
+    disliked_categories = context.get("category_dislikes", [])
+    select_log.debug("Disliked categories: %s", disliked_categories)
+    valid_categories = [category for category in remaining_categories if category not in disliked_categories]
+
+    # Calculate the dynamic count for each category
+    num_categories = len(valid_categories)
+    if num_categories == 0:
+        select_log.debug("No valid categories to process after filtering dislikes.")
+        return
+
+    # Distribute counts evenly and handle any remainder
+    base_count = count_to_fill // num_categories
+    remainder = count_to_fill % num_categories
+
+    for idx, category in enumerate(valid_categories):
+        # Get the snacks for the current category
+        snacks_for_category = grouped_snacks.get(category, [])
+
+        # Process only if snacks are available
+        if len(snacks_for_category) > 0:
+            # Add 1 to the base count for the first 'remainder' categories
+            dynamic_count = base_count + (1 if idx < remainder else 0)
+
+            select_log.debug("** PROCESSING CATEGORY: %s, Available: %s, Selecting: %s", category, len(snacks_for_category), dynamic_count)
+
+            # Call add_snacks_loop with the calculated dynamic count
+            add_snacks_loop(
+                category=category,
+                desired_count=dynamic_count,
+                grouped_snacks=snacks_for_category,
+                context=context,
+                previous_snack_ids=previous_snack_ids,
+                stats=stats
+            )
+        else:
+            select_log.debug("Skipping category '%s' as no snacks are available.", category)
+
+
+# ========================================================================================================================== BUILD
+
+def select_month_start_box(catalog, context, off_cycle, previous_snack_ids, stats):
+    """
+    Pick the snacks of a customer's box. Pure CPU work over one catalog snapshot, so it can
+    run inline or in a worker process.
+
+    Args:
+        catalog (CatalogSnapshot): The snack catalog to pick from.
+        context (dict): The customer's profile fields and repeat_monthly snacks (see build_starting_box_document).
+        off_cycle (bool): Only keep snacks that are in stock or approved.
+        previous_snack_ids (list): SnackIDs from the customer's previous boxes (excluded and penalized).
+        stats (SelectionStats): Collects this build's metrics.
+
+    Returns:
+        List[dict]: The box's snacks (month_start_box).
+    """
+
+    context["month_start_box"].extend(context["repeat_monthly"] or [])
+
+    # LOGGING
+    extend_log.debug("START: BUILDING DRAFT BOX")
+    extend_log.debug("EXTEND 1: %s", context["month_start_box"])
+
+    total_repeat_count = sum(item['count'] for item in context["repeat_monthly"])
+    extend_log.debug("REPEAT COUNT: %s", total_repeat_count)
+
+    adjusted_subscription_type = context["subscription_type"] - total_repeat_count
+
+    # Check if adjusted_subscription_type is negative
+    if adjusted_subscription_type < 0:
+        extend_log.debug("Adjusted subscription type is negative (%s). Skipping snack selection and proceeding to save.", adjusted_subscription_type)
+        return context["month_start_box"]  # Exit early to skip to saving
+
+    with stats.stage("plan_staples"):
+        transformed_staples = plan_staples(context["staples"], context["subscription_type"], context["category_dislikes"], adjusted_subscription_type)
+    extend_log.debug("Transformed Staples: %s", transformed_staples)
+
+    # Fetch the safe snacks (previous_snack_ids are prefetched for the penalty)
+    with stats.stage("filter"):
+        safe_positions = fetch_snacks_filtered(catalog, context["customer_allergens"], context["vetoed_flavors"], context["category_dislikes"], off_cycle, previous_snack_ids, context["repeat_monthly"])
+    stats.safe_snacks = len(safe_positions)
+
+    # Get priority_setting from context
+    priority_setting = context.get("priority_setting", 0)  # Default to 0 if not set
+    extend_log.debug("PRIORITY SETTING: %s", priority_setting)
+
+    # CALCULATE SCORE (boost by priority setting, penalty for previously received snacks)
+    with stats.stage("score"):
+        ranked_positions = catalog.rank_positions(safe_positions, priority_setting, previous_snack_ids)
+        sorted_safe_snacks = [catalog.snacks[position] for position in ranked_positions]
+        grouped_snacks = group_snacks_by_primary_category(sorted_safe_snacks, priority_setting)
+
+# ======= 2. ADD STAPLES
+
+    # Call the function
+    with stats.stage("select_staples"):
+        process_staples(transformed_staples, grouped_snacks, context, previous_snack_ids, stats)
+
+    # Print the remaining categories in the month_start_box
+    extend_log.debug("EXTEND 2 (STAPLES): %s", context["month_start_box"])
+
+# ======= 3. COMPLETE BOX WITH REMAINING CATEGORIES
+
+    # ADD REMAINING CATEGORIES
+    remaining_categories = [
+        cat for cat in grouped_snacks if cat not in transformed_staples and cat not in (context["category_dislikes"] or [])
+    ]
+
+    extend_log.debug("Remaining categories to fill: %s", remaining_categories)
+
+    # Calculate running tally of 'count' fields in month_start_box
+    month_start_box_count = sum(item.get('count', 0) for item in context["month_start_box"])
+    extend_log.debug("Running tally of count fields in month_start_box: %s", month_start_box_count)
+
+    # Calculate count_to_fill using the sum of 'count' fields
+    count_to_fill = context["subscription_type"] - month_start_box_count
+    extend_log.debug("Count to fill: %s", count_to_fill)
+
+
+    # Only process remaining categories if count_to_fill is greater than 0
+    if count_to_fill > 0:
+        with stats.stage("select_remaining"):
+            process_remaining_categories(remaining_categories, count_to_fill, grouped_snacks, context, previous_snack_ids, stats)
+
+    # CHECK: BOX IS FULL
+    if len(context["month_start_box"]) != context["subscription_type"]:
+        extend_log.debug("EXTEND 3 (REMAINING CATEGORIES): Box still not full: %s/%s. Adding remaining snacks.", len(context['month_start_box']), context['subscription_type'])
+
+        # RECALCULATE count_to_fill
+        month_start_box_count = sum(item.get('count', 0) for item in context["month_start_box"])
+        extend_log.debug("Running tally of count fields in month_start_box: %s", month_start_box_count)
+        count_to_fill = context["subscription_type"] - month_start_box_count
+        extend_log.debug("Count to fill: %s", count_to_fill)
+
+        # Only process remaining categories if count_to_fill is greater than 0
+        if count_to_fill > 0:
+            with stats.stage("select_remaining"):
+                process_remaining_categories(remaining_categories, count_to_fill, grouped_snacks, context, previous_snack_ids, stats)
+
+    # Print the extended list
+    extend_log.debug("EXTEND 3 (REMAINING CATEGORIES): %s", context["month_start_box"])
+
+    # NEW: EXTEND 4 (CATCH-ALL)
+    month_start_box_count = sum(item.get('count', 0) for item in context["month_start_box"])
+    if month_start_box_count != context["subscription_type"]:
+        stats.extend4_fallbacks += 1
+        count_to_fill = context["subscription_type"] - month_start_box_count
+        extend_log.debug("EXTEND 4 (CATCH-ALL): Box still not full: %s/%s. Adding %s snacks with highest total score.", month_start_box_count, context['subscription_type'], count_to_fill)
+
+        # Get SnackIDs already in the box to avoid duplicates
+        current_snack_ids = {item["SnackID"] for item in context["month_start_box"]}
+
+        # Filter sorted_safe_snacks to exclude already selected snacks and ensure inStock and active are True
+        available_snacks = [
+            snack for snack in sorted_safe_snacks 
+            if snack.snack_id not in current_snack_ids and
+               snack.in_stock and  # Added inStock condition
+               snack.active        # Added active condition
+        ]
+
+        extend_log.debug("Available snacks for EXTEND 4: %s", len(available_snacks))
+
+        # Add highest-scoring snacks until the box is full or no snacks remain
+        added_snacks = 0
+        for snack in available_snacks:
+            if added_snacks >= count_to_fill:
+                break
+            context["month_start_box"].append({
+                "SnackID": snack.snack_id,
+                "primaryCategory": snack.primary_category,
+                "productLine": snack.product_line,
+                "count": 1,
+                "premium": snack.premium,
+            })
+            added_snacks += 1
+            extend_log.debug("Added snack in EXTEND 4: %s (Score: %s)", snack.snack_id, snack.total_score)
+
+        if added_snacks < count_to_fill:
+            extend_log.warning("Could only add %s snacks in EXTEND 4. Insufficient snacks available.", added_snacks)
+
+    extend_log.debug("EXTEND 4 (FINAL BOX): %s", context["month_start_box"])
+    stats.candidates_scanned = sum(candidates.candidates_scanned for candidates in grouped_snacks.values())
+    month_start_box_count = sum(item.get('count', 0) for item in context["month_start_box"])
+    extend_log.info("Final box size: %s/%s", month_start_box_count, context['subscription_type'])
+
+    return context["month_start_box"]
+
+
+# ========================================================================================================================== REBUILD
+
+def reselect_snacks(catalog, context, off_cycle, previous_snack_ids, month_start_box, dropped_snack_ids, stats):
+    """
+    Replace some snacks of an existing box, keeping every other selection: each dropped snack
+    is replaced in place by add_snacks_loop picks from its own primary category, and any
+    shortfall is filled with the highest scoring snacks (as in EXTEND 4).
+
+    Args:
+        catalog (CatalogSnapshot): The snack catalog to pick from.
+        context (dict): The customer's updated profile fields and repeat_monthly snacks.
+        off_cycle (bool): Only keep snacks that are in stock or approved.
+        previous_snack_ids (list): SnackIDs from the customer's previous boxes (excluded and penalized).
+        month_start_box (List[dict]): The box's current snacks.
+        dropped_snack_ids (set): SnackIDs to replace.
+        stats (SelectionStats): Collects this rebuild's metrics.
+
+    Returns:
+        List[dict]: The box's new snacks.
+    """
+    dropped_counts = defaultdict(int)
+    for item in month_start_box:
+        if item["SnackID"] in dropped_snack_ids:
+            dropped_counts[item.get("primaryCategory")] += item.get("count", 1)
+    extend_log.debug("Reselecting %s", dict(dropped_counts))
+
+    # Nothing already in the box (dropped snacks included) can be picked again
+    excluded_snack_ids = list(previous_snack_ids or []) + [item["SnackID"] for item in month_start_box]
+    with stats.stage("filter"):
+        safe_positions = fetch_snacks_filtered(catalog, context["customer_allergens"], context["vetoed_flavors"], context["category_dislikes"], off_cycle, excluded_snack_ids, context["repeat_monthly"])
+    stats.safe_snacks = len(safe_positions)
+
+    priority_setting = context.get("priority_setting", 0)
+    with stats.stage("score"):
+        ranked_positions = catalog.rank_positions(safe_positions, priority_setting, previous_snack_ids)
+        sorted_safe_snacks = [catalog.snacks[position] for position in ranked_positions]
+        grouped_snacks = group_snacks_by_primary_category(sorted_safe_snacks, priority_setting)
+
+    # Re-run only the affected categories
+    replacements = {}
+    with stats.stage("reselect"):
+        for category, count in dropped_counts.items():
+            picked = {"month_start_box": []}
+            if grouped_snacks.get(category):
+                add_snacks_loop(category, count, grouped_snacks[category], picked, previous_snack_ids, stats)
+            else:
+                select_log.warning("No snacks found for category '%s'. Skipping...", category)
+            replacements[category] = picked["month_start_box"]
+
+    # Slots without a same-category replacement stay as None until the EXTEND 4 fill
+    rebuilt_box = []
+    for item in month_start_box:
+        if item["SnackID"] not in dropped_snack_ids:
+            rebuilt_box.append(item)
+            continue
+        category_replacements = replacements[item.get("primaryCategory")]
+        for _ in range(item.get("count", 1)):
+            rebuilt_box.append(category_replacements.pop(0) if category_replacements else None)
+
+    shortfall = rebuilt_box.count(None)
+    if shortfall:
+        stats.extend4_fallbacks += 1
+        current_snack_ids = {item["SnackID"] for item in rebuilt_box if item is not None}
+        available_snacks = iter([
+            snack for snack in sorted_safe_snacks
+            if snack.snack_id not in current_snack_ids and snack.in_stock and snack.active
+        ][:shortfall])
+        for slot, item in enumerate(rebuilt_box):
+            snack = next(available_snacks, None) if item is None else None
+            if snack is not None:
+                rebuilt_box[slot] = {
+                    "SnackID": snack.snack_id,
+                    "primaryCategory": snack.primary_category,
+                    "productLine": snack.product_line,
+                    "count": 1,
+                    "premium": snack.premium,
+                }
+        if None in rebuilt_box:
+            extend_log.warning("Could only add %s snacks in EXTEND 4. Insufficient snacks available.", shortfall - rebuilt_box.count(None))
+            rebuilt_box = [item for item in rebuilt_box if item is not None]
+
+    stats.candidates_scanned = sum(candidates.candidates_scanned for candidates in grouped_snacks.values())
+    extend_log.info("Rebuilt box size: %s/%s", sum(item.get('count', 0) for item in rebuilt_box), context['subscription_type'])
+    return rebuilt_box
@@ -0,0 +1,140 @@
+import os
+import pickle
+import asyncio
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from admin.config.logging_config import configure_logging, get_stage_logger, trace_customer
+from admin.services.box_selection_engine import select_month_start_box, SelectionStats
+from admin.services.snack_catalog_service import CatalogSnapshot
+from admin.services.snack_catalog_file_service import CatalogFilePin
+
+# Worker processes running the selection engine (0 runs it inline on the event loop)
+BOX_SELECTION_WORKERS = int(os.environ.get("BOX_SELECTION_WORKERS", "0"))
+
+pool_log = get_stage_logger("pool")
+
+# Set in each worker process by _init_worker
+_worker_snapshot = None
+
+
+def _init_worker(snapshot_source, version):
+    """
+    Worker initializer: map the catalog snapshot file, or unpickle the snapshot, once per process.
+    """
+    global _worker_snapshot
+    configure_logging()
+    if isinstance(snapshot_source, str):
+        _worker_snapshot = CatalogSnapshot.from_file(snapshot_source, version=version)
+    else:
+        _worker_snapshot = pickle.loads(snapshot_source)
+
+
+def _select_in_worker(context, off_cycle, previous_snack_ids, customer_id, traced):
+    stats = SelectionStats()
+    with trace_customer(customer_id, force=traced, sample=False):
+        month_start_box = select_month_start_box(_worker_snapshot, context, off_cycle, previous_snack_ids, stats)
+    return month_start_box, stats
+
+
+class SelectionPool:
+    """
+    Process pool running the box selection engine, so scoring and the add_snacks_loop scans
+    don't block the event loop and use every core.
+
+    Each worker holds the catalog snapshot it was started with: it maps the snapshot's file
+    when there is one (sharing its pages), otherwise the snapshot is pickled once per catalog
+    version. When the version changes a new pool is started and the old one finishes its
+    queued builds and exits.
+
+    Workers are spawned as builds come in, so a pool pins its snapshot file (CatalogFilePin)
+    until all of its workers have exited: pruning old snapshots can't remove a file a worker
+    has yet to map.
+    """
+
+    def __init__(self, workers=BOX_SELECTION_WORKERS):
+        self.workers = workers
+        self.executor = None
+        self.snapshot_key = None
+        self.pin = None
+
+    def executor_for(self, catalog):
+        snapshot = catalog.snapshot
+        snapshot_key = (catalog.collection.full_name, snapshot.version)
+        if self.executor is None or self.snapshot_key != snapshot_key:
+            snapshot_source = snapshot.path or pickle.dumps(snapshot, protocol=pickle.HIGHEST_PROTOCOL)
+            previous, previous_pin = self.executor, self.pin
+            self.pin = CatalogFilePin(snapshot.path) if snapshot.path else None
+            self.executor = ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_init_worker,
+                initargs=(snapshot_source, snapshot.version),
+            )
+            self.snapshot_key = snapshot_key
+            if previous is not None:
+                previous.shutdown(wait=False)
+                # Unpin the old file once the old pool's workers are gone
+                threading.Thread(target=_shutdown_and_unpin, args=(previous, previous_pin), daemon=True).start()
+            pool_log.info(
+                "Selection pool started: %s workers, catalog version %s (%s)",
+                self.workers,
+                snapshot.version,
+                snapshot.path or f"{len(snapshot_source)} bytes pickled",
+            )
+        return self.executor
+
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=True, cancel_futures=True)
+            self.executor = None
+            self.snapshot_key = None
+        if self.pin is not None:
+            self.pin.release()
+            self.pin = None
+
+
+def _shutdown_and_unpin(executor, pin):
+    executor.shutdown(wait=True)
+    if pin is not None:
+        pin.release()
+
+
+selection_pool = SelectionPool()
+
+
+async def run_box_selection(catalog, context, off_cycle, previous_snack_ids, customer_id, traced, profile=None):
+    """
+    Run select_month_start_box on the catalog's current snapshot, in the selection pool when
+    BOX_SELECTION_WORKERS > 0 and inline otherwise, and publish its metrics.
+
+    Args:
+        profile (BoxProfile): Profile the selection (always run inline, so the profilers see it).
+
+    Returns:
+        List[dict]: The box's snacks (month_start_box).
+    """
+    if profile is not None:
+        stats = SelectionStats()
+        snapshot = catalog.snapshot
+        month_start_box = profile.run_selection(
+            lambda: select_month_start_box(snapshot, context, off_cycle, previous_snack_ids, stats),
+            stats,
+        )
+    elif selection_pool.workers <= 0:
+        stats = SelectionStats()
+        month_start_box = select_month_start_box(catalog.snapshot, context, off_cycle, previous_snack_ids, stats)
+    else:
+        executor = selection_pool.executor_for(catalog)
+        month_start_box, stats = await asyncio.get_running_loop().run_in_executor(
+            executor, _select_in_worker, context, off_cycle, previous_snack_ids, customer_id, traced
+        )
+    stats.record()
+    return month_start_box
+
+
+def shutdown_selection_pool():
+    """
+    Lifespan shutdown step: stop the selection worker processes.
+    """
+    selection_pool.shutdown()
@@ -0,0 +1,132 @@
+import os
+import queue
+import atexit
+import random
+import shutil
+import asyncio
+import logging
+import logging.handlers
+from datetime import datetime
+from bson import json_util
+from admin.services.snack_catalog_file_service import write_catalog_file
+from admin.config.logging_config import get_stage_logger
+
+# Directory that captured builds are written to, for offline replay with
+# benchmarks/replay_builds.py (unset disables capturing)
+BOX_CAPTURE_DIR = os.environ.get("BOX_CAPTURE_DIR", "")
+
+# Fraction of builds captured
+BOX_CAPTURE_SAMPLE_RATE = float(os.environ.get("BOX_CAPTURE_SAMPLE_RATE", "1.0"))
+
+# Captured builds, one Extended JSON record per line, next to the catalog files they reference
+CAPTURE_FILE_NAME = "builds.jsonl"
+
+capture_log = get_stage_logger("capture")
+
+
+class BuildCapture:
+    """
+    Records what the selection engine saw and chose for each build: the request, the customer
+    context, the previous SnackIDs, the catalog snapshot (as a snapshot file, written once per
+    catalog version and never pruned) and the selected SnackIDs.
+
+    Selection breaks ties in set iteration order, so a capture can only be replayed exactly
+    when the service runs with PYTHONHASHSEED set; the seed is recorded with each build.
+
+    Records are encoded on the caller (so later changes to the box don't leak in) and appended
+    to the capture file by a QueueListener thread, as admin.box logs are.
+    """
+
+    def __init__(self, directory=BOX_CAPTURE_DIR, sample_rate=BOX_CAPTURE_SAMPLE_RATE):
+        self.directory = directory
+        self.sample_rate = sample_rate
+        self.catalog_files = {}  # (namespace, version) -> task returning the file name
+        self._queue = None
+        self._listener = None
+
+    def sample(self):
+        """
+        Whether to capture the next build.
+        """
+        return bool(self.directory) and (self.sample_rate >= 1 or random.random() < self.sample_rate)
+
+    def _write_catalog(self, snapshot, namespace):
+        if snapshot.path:
+            # Already a snapshot file: copy it under its content-addressed name
+            path = os.path.join(self.directory, os.path.basename(snapshot.path))
+            if not os.path.exists(path):
+                temporary_path = f"{path}.{os.getpid()}.tmp"
+                shutil.copyfile(snapshot.path, temporary_path)
+                os.replace(temporary_path, path)
+        else:
+            path = write_catalog_file(self.directory, namespace, snapshot.snacks, snapshot.version, prune=False, make_current=False)
+        capture_log.info("Captured snack catalog version %s to %s", snapshot.version, path)
+        return os.path.basename(path)
+
+    async def catalog_file(self, snapshot, namespace):
+        """
+        Name of the capture's file for a catalog snapshot, written on first use.
+        """
+        key = (namespace, snapshot.version)
+        task = self.catalog_files.get(key)
+        if task is None:
+            os.makedirs(self.directory, exist_ok=True)
+            # Encoding a large catalog takes a while: keep it off the event loop
+            task = asyncio.ensure_future(asyncio.to_thread(self._write_catalog, snapshot, namespace))
+            self.catalog_files[key] = task
+        try:
+            return await asyncio.shield(task)
+        except Exception:
+            self.catalog_files.pop(key, None)
+            raise
+
+    def _append(self, line):
+        if self._listener is None:
+            file_handler = logging.FileHandler(os.path.join(self.directory, CAPTURE_FILE_NAME), mode="a", delay=True)
+            file_handler.setFormatter(logging.Formatter("%(message)s"))
+            self._queue = queue.SimpleQueue()
+            self._listener = logging.handlers.QueueListener(self._queue, file_handler)
+            self._listener.start()
+            atexit.register(self.close)
+        self._queue.put_nowait(logging.makeLogRecord({"msg": line}))
+
+    def close(self):
+        """
+        Write out the queued records and stop the writer thread.
+        """
+        if self._listener is not None:
+            self._listener.stop()
+            for handler in self._listener.handlers:
+                handler.close()
+            self._listener = None
+
+    async def record(self, snapshot, namespace, request, context, previous_snack_ids, month_start_box):
+        """
+        Append one build to the capture. Never raises: a failed capture is only logged.
+
+        Args:
+            snapshot (CatalogSnapshot): The catalog snapshot the box was selected from.
+            namespace (str): The snacks collection's full name.
+            request (dict): The build's BuildStartingBoxRequest fields.
+            context (dict): The customer context as it was before selection.
+            previous_snack_ids (list): SnackIDs from the customer's previous boxes.
+            month_start_box (List[dict]): The selected snacks.
+        """
+        try:
+            catalog_file = await self.catalog_file(snapshot, namespace)
+            line = json_util.dumps({
+                "capturedAt": datetime.utcnow(),
+                "pythonHashSeed": os.environ.get("PYTHONHASHSEED"),
+                "catalog": catalog_file,
+                "catalogVersion": snapshot.version,
+                "request": request,
+                "context": context,
+                "previousSnackIDs": previous_snack_ids,
+                "snackIDs": [snack["SnackID"] for snack in month_start_box],
+            })
+            self._append(line)
+        except Exception as e:
+            capture_log.warning("Could not capture the build: %s", e)
+
+
+build_capture = BuildCapture()
@@ -1,10 +1,58 @@
+import time
+import asyncio
 from datetime import datetime, timedelta
 from typing import List, Optional  # Import Optional
-from collections import defaultdict
 from motor.motor_asyncio import AsyncIOMotorClient
 from pprint import pprint
-from collections import Counter
-from admin.models.customers_model import SnackItem 
+from pymongo.errors import BulkWriteError
+from admin.models.customers_model import SnackItem, BuildStartingBoxRequest, PreferenceChange
+from admin.services.snack_catalog_service import get_snack_catalog
+from admin.services.customer_profile_cache_service import customer_profile_cache
+from admin.services.box_selection_pool_service import run_box_selection
+from admin.services.box_selection_engine import reselect_snacks, SelectionStats
+from admin.services.staple_planner_service import plan_staples, STAPLE_VALUES
+from admin.services.draft_box_writer_service import save_draft_box
+from admin.services.build_capture_service import build_capture
+from admin.services.box_profiling_service import BoxProfile
+from admin.services.single_flight_service import SingleFlight
+from admin.services.idempotency_service import (
+    box_idempotency_cache,
+    request_fingerprint,
+    idempotency_key_for,
+    forget_idempotent_builds,
+    BOX_IDEMPOTENCY_WINDOW_SECONDS,
+)
+from admin.config.logging_config import get_stage_logger, trace_customer
+from admin.services.metrics_service import (
+    time_stage,
+    BUILD_SECONDS,
+    IDEMPOTENT_REPLAYS,
+    REBUILDS,
+)
+
+# Fields of the customer document used to build a box
+CUSTOMER_PROFILE_PROJECTION = {
+    "_id": 0,
+    "allergens": 1,
+    "dislikes": 1,
+    "staples": 1,
+    "vetoedFlavors": 1,
+    "prioritySetting": 1,
+    "subscription_type": 1
+}
+
+# Number of boxes built concurrently by build_starting_boxes
+BATCH_BUILD_CONCURRENCY = 16
+
+# Concurrent identical build_starting_box calls share one build
+box_build_flights = SingleFlight("build_starting_box")
+
+# One logger per build stage (levels and per-customer traces are set in admin.config.logging_config;
+# the selection stages log from admin.services.box_selection_engine)
+customer_log = get_stage_logger("customer")
+history_log = get_stage_logger("history")
+save_log = get_stage_logger("save")
+
 
 async def build_starting_box(
     customerID: str,
@@ -17,7 +65,487 @@ async def build_starting_box(
     all_customers_collection,
     all_snacks_collection,
     repeat_monthly: List[SnackItem] = [],  
+    trace: bool = False,
+    idempotency_key: Optional[str] = None,
+    profile: Optional[BoxProfile] = None,
+):
+    """
+    Build and save a customer's draft box.
+
+    A request retried with the same Idempotency-Key within BOX_IDEMPOTENCY_WINDOW_SECONDS
+    returns the box that was already built. Identical requests arriving while a build for the
+    same customer and mode is in flight share that build instead of running their own.
+
+    Args:
+        idempotency_key (str): The client's Idempotency-Key. Without one every request builds a new box.
+        profile (BoxProfile): Profile this build. A profiled build always runs: it isn't
+            answered from an earlier build or shared with an identical one in flight.
+
+    Returns:
+        List[dict]: The box's snacks, or None when the box is empty.
+    """
+    if idempotency_key:
+        request_key = idempotency_key_for(customerID, idempotency_key)
+    else:
+        request_key = request_fingerprint(customerID, new_signup, repeat_customer, off_cycle, is_reset_box, reset_total, repeat_monthly)
+
+    build = lambda: _build_and_save_starting_box(
+        customerID=customerID,
+        new_signup=new_signup,
+        repeat_customer=repeat_customer,
+        off_cycle=off_cycle,
+        is_reset_box=is_reset_box,
+        reset_total=reset_total,
+        monthly_draft_box_collection=monthly_draft_box_collection,
+        all_customers_collection=all_customers_collection,
+        all_snacks_collection=all_snacks_collection,
+        repeat_monthly=repeat_monthly,
+        trace=trace,
+        idempotency_key=request_key if idempotency_key else None,
+        profile=profile,
+    )
+    if profile is not None:
+        return await build()
+    return await box_build_flights.do((customerID, off_cycle, is_reset_box, request_key), build)
+
+
+def idempotent_build_filter(customerID, key):
+    """
+    Filter for a box saved under an Idempotency-Key within BOX_IDEMPOTENCY_WINDOW_SECONDS
+    (also explained at startup by check_query_plans).
+    """
+    return {
+        "customerID": customerID,
+        "idempotencyKey": key,
+        "createdAt": {"$gte": datetime.utcnow() - timedelta(seconds=BOX_IDEMPOTENCY_WINDOW_SECONDS)},
+    }
+
+
+async def _build_and_save_starting_box(
+    customerID: str,
+    new_signup: bool,
+    repeat_customer: bool,
+    off_cycle: bool,
+    is_reset_box: bool,
+    reset_total: int,
+    monthly_draft_box_collection,
+    all_customers_collection,
+    all_snacks_collection,
+    repeat_monthly: List[SnackItem],
+    trace: bool,
+    idempotency_key: Optional[str],
+    profile: Optional[BoxProfile] = None,
 ):
+    started = time.perf_counter()
+
+    key = idempotency_key if BOX_IDEMPOTENCY_WINDOW_SECONDS > 0 else None
+    if key and profile is None:
+        previous = box_idempotency_cache.get(key)
+        if previous is not None:
+            IDEMPOTENT_REPLAYS.inc(source="memory")
+            save_log.info("Returning the box already built for customer %s (idempotent retry)", customerID)
+            return previous["snacks"]
+
+        # Another worker may have built it
+        saved = await monthly_draft_box_collection.find_one(idempotent_build_filter(customerID, key), {"_id": 0, "snacks": 1})
+        if saved is not None:
+            IDEMPOTENT_REPLAYS.inc(source="mongo")
+            box_idempotency_cache.put(key, saved["snacks"], customerID)
+            save_log.info("Returning the box already saved for customer %s (idempotent retry)", customerID)
+            return saved["snacks"]
+
+    document = await build_starting_box_document(
+        customerID=customerID,
+        new_signup=new_signup,
+        repeat_customer=repeat_customer,
+        off_cycle=off_cycle,
+        is_reset_box=is_reset_box,
+        reset_total=reset_total,
+        monthly_draft_box_collection=monthly_draft_box_collection,
+        all_customers_collection=all_customers_collection,
+        all_snacks_collection=all_snacks_collection,
+        repeat_monthly=repeat_monthly,
+        trace=trace,
+        profile=profile,
+    )
+
+    if document:
+        if key:
+            document["idempotencyKey"] = key
+        with time_stage("save", profile):
+            await save_draft_box(monthly_draft_box_collection, document)
+        if key:
+            box_idempotency_cache.put(key, document["snacks"], customerID)
+        BUILD_SECONDS.observe(time.perf_counter() - started)
+        save_log.info("Box saved successfully for customer: %s", customerID)
+        return document["snacks"]  # Return only the snacks field
+    else:
+        if key:
+            box_idempotency_cache.put(key, None, customerID)
+        BUILD_SECONDS.observe(time.perf_counter() - started)
+        save_log.info("Box is empty. Nothing to save.")
+
+
+async def build_starting_boxes(
+    requests: List[BuildStartingBoxRequest],
+    monthly_draft_box_collection,
+    all_customers_collection,
+    all_snacks_collection,
+):
+    """
+    Build boxes for many customers in one call.
+
+    The snack catalog is loaded once, every customer is fetched with a single $in query,
+    and all non-empty boxes are written with one insert_many.
+
+    Args:
+        requests (List[BuildStartingBoxRequest]): One request per box to build.
+
+    Returns:
+        List[dict]: One result per request, in request order, with customerID, success and either data or error.
+    """
+    await get_snack_catalog(all_snacks_collection)
+
+    customer_ids = list({request.customerID for request in requests})
+    customer_documents = {}
+    uncached_ids = []
+    for customer_id in customer_ids:
+        customer_document = customer_profile_cache.get(customer_id)
+        if customer_document is None:
+            uncached_ids.append(customer_id)
+        else:
+            customer_documents[customer_id] = customer_document
+
+    if uncached_ids:
+        generations = {customer_id: customer_profile_cache.generation(customer_id) for customer_id in uncached_ids}
+        async for customer_document in all_customers_collection.find(
+            {"customerID": {"$in": uncached_ids}},
+            {**CUSTOMER_PROFILE_PROJECTION, "customerID": 1}
+        ):
+            customer_documents[customer_document["customerID"]] = customer_document
+            customer_profile_cache.put(customer_document["customerID"], customer_document, generations[customer_document["customerID"]])
+    save_log.info("Batch build: %s requests, %s/%s customers found", len(requests), len(customer_documents), len(customer_ids))
+
+    semaphore = asyncio.Semaphore(BATCH_BUILD_CONCURRENCY)
+
+    async def build_one(request):
+        customer_document = customer_documents.get(request.customerID)
+        if customer_document is None:
+            return {"customerID": request.customerID, "success": False, "error": f"No customer found with ID: {request.customerID}"}
+        async with semaphore:
+            try:
+                document = await build_starting_box_document(
+                    customerID=request.customerID,
+                    new_signup=request.new_signup,
+                    repeat_customer=request.repeat_customer,
+                    off_cycle=request.off_cycle,
+                    is_reset_box=request.is_reset_box,
+                    reset_total=request.reset_total,
+                    monthly_draft_box_collection=monthly_draft_box_collection,
+                    all_customers_collection=all_customers_collection,
+                    all_snacks_collection=all_snacks_collection,
+                    repeat_monthly=request.repeat_monthly,
+                    customer_document=customer_document,
+                )
+            except Exception as e:
+                return {"customerID": request.customerID, "success": False, "error": f"An error occurred: {str(e)}"}
+        return {"customerID": request.customerID, "success": True, "document": document}
+
+    results = await asyncio.gather(*(build_one(request) for request in requests))
+
+    # SAVE: one insert_many for every non-empty box
+    pending = [result for result in results if result.get("document")]
+    if pending:
+        try:
+            with time_stage("save_batch"):
+                await monthly_draft_box_collection.insert_many([result["document"] for result in pending], ordered=False)
+        except BulkWriteError as e:
+            for write_error in e.details.get("writeErrors", []):
+                failed = pending[write_error["index"]]
+                failed["success"] = False
+                failed["error"] = f"An error occurred while saving the box: {write_error.get('errmsg')}"
+        save_log.info("Batch build: saved %s boxes", sum(1 for result in pending if result['success']))
+
+    for result in results:
+        document = result.pop("document", None)
+        if result["success"]:
+            result["data"] = document["snacks"] if document else None
+    return results
+
+
+def apply_preference_change(customer_document, change, undo=False):
+    """
+    A copy of a customer profile with `change` applied (or, with undo=True, reverted).
+
+    Args:
+        customer_document (dict): Customer profile (CUSTOMER_PROFILE_PROJECTION).
+        change (PreferenceChange): The staple or allergen that changed.
+    """
+    customer_document = dict(customer_document)
+    if change.kind == "staple":
+        if not change.category:
+            raise ValueError("A staple change needs the category that changed.")
+        staples = dict(customer_document.get("staples") or {})
+        amount = change.previous_amount if undo else change.amount
+        if amount is not None and amount not in STAPLE_VALUES:
+            raise ValueError("Staples values must be 'one', 'a few', or 'many'.")
+        if amount is None:
+            staples.pop(change.category, None)
+        else:
+            staples[change.category] = amount
+        customer_document["staples"] = staples
+    elif change.kind == "allergen":
+        if not change.allergen:
+            raise ValueError("An allergen change needs the allergen that was added.")
+        allergens = [allergen for allergen in customer_document.get("allergens") or [] if allergen != change.allergen]
+        customer_document["allergens"] = allergens if undo else allergens + [change.allergen]
+    return customer_document
+
+
+async def rebuild_starting_box(
+    customerID: str,
+    change: PreferenceChange,
+    new_signup: bool,
+    repeat_customer: bool,
+    off_cycle: bool,
+    is_reset_box: bool,
+    reset_total: int,
+    monthly_draft_box_collection,
+    all_customers_collection,
+    all_snacks_collection,
+    repeat_monthly: List[SnackItem] = [],
+):
+    """
+    Rebuild a customer's draft box after one preference changed, re-selecting only what the
+    change affects.
+
+    An added allergen replaces the box's snacks containing it with add_snacks_loop picks from
+    the same categories; every other snack is kept. A staple change that leaves the quantity
+    plan (plan_staples) as it was keeps the box. Anything else (the plan changed, no draft box
+    for the month and order status a full build would produce, a different box size) falls
+    back to a full build.
+
+    The change is applied to the stored profile, so this works whether or not the customer
+    document has been updated yet. Afterwards the customer's cached profile and remembered
+    builds are dropped, so the next build doesn't undo the rebuild.
+
+    Returns:
+        dict: mode ("incremental" or "full"), reason, changed (whether a new box was saved) and snacks.
+    """
+    customer_document, (previous_snack_ids, latest_box) = await asyncio.gather(
+        fetch_customer_profile(customerID, all_customers_collection),
+        fetch_latest_draft_box(customerID, monthly_draft_box_collection),
+    )
+    if customer_document is None:
+        raise ValueError(f"No customer found with ID: {customerID}")
+    updated_document = apply_preference_change(customer_document, change)
+
+    async def finish(result):
+        # The next build must see the change, not the cached profile or a remembered box
+        customer_profile_cache.invalidate(customerID)
+        await forget_idempotent_builds(customerID, monthly_draft_box_collection)
+        return result
+
+    async def full_build(reason):
+        save_log.info("Full rebuild for customer %s: %s", customerID, reason)
+        REBUILDS.inc(mode="full", reason=reason)
+        document = await build_starting_box_document(
+            customerID=customerID,
+            new_signup=new_signup,
+            repeat_customer=repeat_customer,
+            off_cycle=off_cycle,
+            is_reset_box=is_reset_box,
+            reset_total=reset_total,
+            monthly_draft_box_collection=monthly_draft_box_collection,
+            all_customers_collection=all_customers_collection,
+            all_snacks_collection=all_snacks_collection,
+            repeat_monthly=repeat_monthly,
+            customer_document=updated_document,
+        )
+        if document:
+            with time_stage("save"):
+                await save_draft_box(monthly_draft_box_collection, document)
+        return await finish({"mode": "full", "reason": reason, "changed": bool(document), "snacks": document["snacks"] if document else None})
+
+    serialized_repeat_monthly = [snack.dict() for snack in repeat_monthly] if repeat_monthly is not None else []
+    subscription_type = reset_total if is_reset_box else updated_document.get("subscription_type")
+    month = draft_box_month(off_cycle)
+    order_status = draft_box_order_status(new_signup)
+    if latest_box is None or not latest_box.get("snacks"):
+        return await full_build("no_draft_box")
+    if latest_box.get("month") != month or latest_box.get("order_status") != order_status:
+        return await full_build("stale_draft_box")
+    if latest_box.get("size") != subscription_type:
+        return await full_build("box_size_changed")
+
+    adjusted_subscription_type = subscription_type - sum(item["count"] for item in serialized_repeat_monthly)
+    if adjusted_subscription_type < 0:
+        return await full_build("repeat_monthly_exceeds_box")
+    try:
+        previous_plan = plan_staples(apply_preference_change(customer_document, change, undo=True).get("staples"), subscription_type, updated_document.get("dislikes"), adjusted_subscription_type)
+        plan = plan_staples(updated_document.get("staples"), subscription_type, updated_document.get("dislikes"), adjusted_subscription_type)
+    except ValueError:
+        return await full_build("invalid_staples")
+    if plan != previous_plan:
+        return await full_build("staples_plan_changed")
+
+    catalog = await get_snack_catalog(all_snacks_collection)
+    snapshot = catalog.snapshot
+    box_snacks = latest_box["snacks"]
+    dropped_snack_ids = set()
+    if change.kind == "allergen":
+        # Repeat monthly snacks are added whatever the allergens, as in a full build
+        repeat_snack_ids = {snack["SnackID"] for snack in serialized_repeat_monthly}
+        dropped_snack_ids = snapshot.snack_ids_with_allergens(
+            [item["SnackID"] for item in box_snacks if item["SnackID"] not in repeat_snack_ids],
+            [change.allergen],
+        )
+
+    if not dropped_snack_ids:
+        REBUILDS.inc(mode="incremental", reason="unaffected")
+        save_log.info("Incremental rebuild for customer %s: no snacks affected", customerID)
+        return await finish({"mode": "incremental", "reason": "unaffected", "changed": False, "snacks": box_snacks})
+
+    context = {
+        "staples": updated_document.get("staples"),
+        "customer_allergens": updated_document.get("allergens"),
+        "vetoed_flavors": updated_document.get("vetoedFlavors"),
+        "priority_setting": updated_document.get("prioritySetting"),
+        "category_dislikes": updated_document.get("dislikes"),
+        "repeat_monthly": serialized_repeat_monthly,
+        "subscription_type": subscription_type,
+    }
+    stats = SelectionStats()
+    with trace_customer(customerID):
+        snacks = reselect_snacks(snapshot, context, off_cycle, previous_snack_ids, box_snacks, dropped_snack_ids, stats)
+    stats.record()
+
+    created_at = datetime.utcnow()
+    document = {
+        "boxID": f"box_{month}_{subscription_type}_{customerID}_{created_at.strftime('%Y%m%d%H%M%S')}",
+        "customerID": customerID,
+        "month": month,
+        "size": subscription_type,
+        "order_status": order_status,
+        "snacks": snacks,
+        "originalSnacks": snacks,
+        "popped": False,
+        "createdAt": created_at,
+    }
+    with time_stage("save"):
+        await save_draft_box(monthly_draft_box_collection, document)
+    REBUILDS.inc(mode="incremental", reason=change.kind)
+    save_log.info("Incremental rebuild for customer %s: replaced %s snacks", customerID, len(dropped_snack_ids))
+    return await finish({"mode": "incremental", "reason": change.kind, "changed": True, "snacks": snacks})
+
+
+async def fetch_customer_profile(customerID, all_customers_collection):
+    """
+    A customer's profile (CUSTOMER_PROFILE_PROJECTION), from the profile cache or Mongo.
+    """
+    customer_document = customer_profile_cache.get(customerID)
+    if customer_document is None:
+        generation = customer_profile_cache.generation(customerID)
+        customer_document = await all_customers_collection.find_one(
+            {"customerID": customerID},
+            CUSTOMER_PROFILE_PROJECTION
+        )
+        customer_profile_cache.put(customerID, customer_document, generation)
+    return customer_document
+
+
+def box_history_pipeline(customerID, most_recent_projection):
+    """
+    fetch_box_history's aggregation pipeline (also explained at startup by check_query_plans).
+    """
+    # One round trip: $facet runs both sub-pipelines over the customer's boxes.
+    # History is deduplicated server-side, so Mongo returns one set of SnackIDs
+    return [
+        {"$match": {"customerID": customerID}},
+        {"$facet": {
+            "history": [
+                {"$project": {"_id": 0, "snacks.SnackID": 1}},
+                {"$unwind": "$snacks"},
+                {"$group": {"_id": None, "snackIDs": {"$addToSet": "$snacks.SnackID"}}},
+            ],
+            "mostRecent": [
+                {"$sort": {"createdAt": -1}},
+                {"$limit": 1},
+                {"$project": most_recent_projection},
+            ],
+        }},
+    ]
+
+
+async def fetch_box_history(customerID, monthly_draft_box_collection, most_recent_projection):
+    """
+    Query monthly_draft_box_collection once for the SnackIDs of all of customerID's boxes and
+    for their most recent box (by createdAt).
+
+    Args:
+        most_recent_projection (dict): Projection of the most recent box.
+
+    Returns:
+        Tuple[List[str], dict]: Unique SnackIDs from all boxes, and the most recent box (None if there is none).
+    """
+    pipeline = box_history_pipeline(customerID, most_recent_projection)
+    result = await monthly_draft_box_collection.aggregate(pipeline).to_list(length=1)
+    facets = result[0] if result else {}
+    history = facets.get("history")
+    snack_ids = [snack_id for snack_id in history[0]["snackIDs"] if snack_id] if history else []
+    most_recent = facets.get("mostRecent") or [None]
+    return snack_ids, most_recent[0]
+
+
+async def fetch_latest_draft_box(customerID, monthly_draft_box_collection):
+    """
+    The SnackIDs of all of a customer's boxes and their most recent draft box, in one round trip.
+    """
+    return await fetch_box_history(customerID, monthly_draft_box_collection, {"_id": 0})
+
+
+def draft_box_month(off_cycle):
+    """
+    The month a box built now is for, as MMYY: next month, or the one after for an off-cycle box.
+    """
+    current_date = datetime.now()
+    months_to_add = 2 if off_cycle else 1
+    year = current_date.year + (current_date.month + months_to_add - 1) // 12
+    month = (current_date.month + months_to_add - 1) % 12 + 1
+    target_date = datetime(year, month, 1)
+    return int(target_date.strftime("%m%y"))
+
+
+def draft_box_order_status(new_signup):
+    return "firstbox" if new_signup else "Customize"
+
+
+async def build_starting_box_document(
+    customerID: str,
+    new_signup: bool,
+    repeat_customer: bool,
+    off_cycle: bool,
+    is_reset_box: bool,
+    reset_total: int,
+    monthly_draft_box_collection,
+    all_customers_collection,
+    all_snacks_collection,
+    repeat_monthly: List[SnackItem] = [],
+    customer_document: Optional[dict] = None,
+    trace: bool = False,
+    profile: Optional[BoxProfile] = None,
+):
+    """
+    Build a customer's draft box document without saving it.
+
+    Args:
+        customer_document (dict): Prefetched customer profile (CUSTOMER_PROFILE_PROJECTION). Fetched by customerID when omitted.
+        trace (bool): Log the full decision trace for this build regardless of log levels.
+        profile (BoxProfile): Time the stages and profile the selection of this build.
+
+    Returns:
+        dict: The draft box document, or None when the box is empty.
+    """
     
     # Convert repeat_monthly to list of dicts if provided
     serialized_repeat_monthly = (
@@ -39,20 +567,17 @@ async def build_starting_box(
 
 # ============================================================================================================== PREPARE: GET CUSTOMER INFO 
     
-    async def get_customer_by_customerID(customerID, is_reset_box, reset_total):
+    async def get_customer_by_customerID(customerID, is_reset_box, reset_total, customer_document=None):
         try:
-            customer_document = await all_customers_collection.find_one(
-                {"customerID": customerID},
-                {
-                    "_id": 0, 
-                    "allergens": 1, 
-                    "dislikes": 1, 
-                    "staples": 1, 
-                    "vetoedFlavors": 1,
-                    "prioritySetting": 1,
-                    "subscription_type": 1
-                }
-            )
+            if customer_document is None:
+                customer_document = customer_profile_cache.get(customerID)
+            if customer_document is None:
+                generation = customer_profile_cache.generation(customerID)
+                customer_document = await all_customers_collection.find_one(
+                    {"customerID": customerID},
+                    CUSTOMER_PROFILE_PROJECTION
+                )
+                customer_profile_cache.put(customerID, customer_document, generation)
 
             if customer_document:
                 context["customer_allergens"] = customer_document.get("allergens")
@@ -67,859 +592,58 @@ async def build_starting_box(
                 else:
                     context["subscription_type"] = customer_document.get("subscription_type")
 
-                print(f"CONTEXT: {context}")
-                print("\n")
-
-            else:
-                print(f"No customer found with ID: {customerID}")
-        except Exception as e:
-            print(f"An error occurred while retrieving the customer: {e}")
+                customer_log.debug("CONTEXT: %s", context)
 
-# ========================================================================================================================== 1. FILTER SNACKS
-    
-    async def fetch_snacks_filtered(allergens=None, vetoedFlavors=None, dislikedCategories=None, off_cycle=False, previous_snack_ids=None, repeat_monthly=None):
-        try:
-            print("FILTERING SNACKS")
-            # Initialize query conditions
-            query_conditions = {"replacementOnly": {"$ne": True}}  # Exclude snacks where replacementOnly is true
-
-            # Combine all SnackID exclusions
-            excluded_snack_ids = set()
-
-            # Add repeat_monthly SnackIDs to excluded list
-            if repeat_monthly and isinstance(repeat_monthly, list):
-                print("d. Adding Repeat Monthly SnackIDs to query conditions")
-                repeat_snack_ids = [str(item["SnackID"]).strip().upper() for item in repeat_monthly if isinstance(item, dict) and "SnackID" in item]
-                excluded_snack_ids.update(repeat_snack_ids)
-                print(f"Repeat SnackIDs: {repeat_snack_ids}")
             else:
-                print("repeat_monthly is empty or invalid")
-
-            # Add most_recent_snack_ids to excluded list
-            if previous_snack_ids:
-                print("d. Adding Most Recent SnackID exclusion to query conditions")
-                recent_snack_ids = [str(id).strip().upper() for id in previous_snack_ids]
-                excluded_snack_ids.update(recent_snack_ids)
-                print(f"Most Recent SnackIDs: {recent_snack_ids}")
-
-            # Apply combined SnackID filter
-            if excluded_snack_ids:
-                query_conditions["SnackID"] = {"$nin": list(excluded_snack_ids)}
-                print(f"Excluded SnackIDs: {excluded_snack_ids}")
-
-            # Filter by allergens if provided
-            if allergens:
-                print("a. Adding Allergens to query conditions")
-                query_conditions["allergens"] = {"$nin": allergens}
-
-            # Filter by vetoed flavors if provided
-            if vetoedFlavors:
-                print("b. Adding Vetoed Flavors to query conditions")
-                # Suffixes to handle stripping with transformations
-                suffixes_to_strip = ["ies", "s", "es", "ed", "ing", "y"]
-                suffixes_to_add = ["", "e", "y", "s", "es", "ed", "ing", "ies"]
-
-                def strip_suffix(word):
-                    """
-                    Remove the longest matching suffix from a word, based on suffixes_to_strip.
-                    """
-                    for suffix in sorted(suffixes_to_strip, key=len, reverse=True):  # Longest suffix first
-                        if word.endswith(suffix):
-                            if suffix == "ies" and len(word) > 3:  # Special handling for "ies"
-                                return word[:-3] + "y"
-                            return word[: -len(suffix)]
-                    return word
-
-                # Step 1: Generate base forms of words
-                base_flavors = [strip_suffix(flavor.lower()) for flavor in vetoedFlavors]
-
-                # Step 2: Expand the list with new forms
-                expanded_flavors = set()
-                for flavor in base_flavors:
-                    for suffix in suffixes_to_add:
-                        if suffix == "ies" and flavor.endswith("y"):
-                            expanded_flavors.add(flavor[:-1] + "ies")
-                        else:
-                            expanded_flavors.add(flavor + suffix)
-
-                # Step 3: Format the words with capitalized first letter and lowercase everything else
-                formatted_flavors = [flavor.capitalize() for flavor in sorted(expanded_flavors)]
-
-                # Add vetoed flavors condition to the query
-                query_conditions["flavorTags"] = {"$nin": formatted_flavors}
-
-            # Filter by disliked categories if provided
-            if dislikedCategories:
-                print("c. Adding Disliked Categories to query conditions")
-                query_conditions["primaryCategory"] = {"$nin": dislikedCategories}
-
-            # Filter by off-cycle if provided
-            if off_cycle:
-                print("c. Adding Off-Cycle to query conditions")
-                query_conditions["$or"] = [{"inStock": True}, {"approved": True}]
-
-            # Log final query conditions
-            print(f"Final query conditions: {query_conditions}")
-
-            # Query the collection with the combined filters
-            snacks = await all_snacks_collection.find(query_conditions).to_list(length=500)
-
-            # Log returned SnackIDs for debugging
-            returned_snack_ids = [snack["SnackID"] for snack in snacks]
-            print(f"Returned SnackIDs: {returned_snack_ids}")
-
-            # Check if any excluded SnackIDs are in results
-            if excluded_snack_ids and any(snack_id in excluded_snack_ids for snack_id in returned_snack_ids):
-                print(f"Warning: Excluded SnackIDs found in results: {set(returned_snack_ids) & excluded_snack_ids}")
-
-            # Print the count of snacks returned
-            print(f"e. Number of snacks returned: {len(snacks)}")
-
-            return snacks
-
+                customer_log.warning("No customer found with ID: %s", customerID)
         except Exception as e:
-            print(f"An error occurred while retrieving snacks: {e}")
-            return []
+            customer_log.error("An error occurred while retrieving the customer: %s", e)
 
-# ============================================================================================================================ 2. SCORE EACH SNACK
+# ============================================================================================================================ PREPARE: GET BOX HISTORY
 
-    async def get_previous_snack_ids(customerID):
-        
+    async def get_box_history(customerID):
         """
-        Query monthly_draft_box_collection for all SnackIDs associated with a customerID.
-
-        Args:
-            customer_id (str): The customer ID to query for
-
-        Returns:
-            List[str]: List of unique SnackIDs from all matching documents
-        """
-        try:
-            snack_ids = []
-            async for doc in monthly_draft_box_collection.find({"customerID": customerID}):
-                snacks = doc.get("snacks", [])
-                for snack in snacks:
-                    snack_id = snack.get("SnackID")
-                    if snack_id and snack_id not in snack_ids:
-                        snack_ids.append(snack_id)
-            print(f"Previous SnackIDs for customer {customerID}:")
-            for snack_id in snack_ids:
-                print(f" - {snack_id}")
-            print("\n")
-            return snack_ids
-        except Exception as e:
-            print(f"Error querying previous snacks: {e}")
-            return []
-
-    async def get_most_recent_box(customerID):
-        """
-        Query monthly_draft_box_collection for SnackIDs in customerID's most recent box based on createdAt.
+        Query monthly_draft_box_collection once for the SnackIDs of all of customerID's boxes
+        and of their most recent box (by createdAt).
 
         Args:
             customerID (str): The customer ID to query for
 
         Returns:
-            List[str]: List of unique SnackIDs from the most recent box
+            Tuple[List[str], List[str]]: Unique SnackIDs from all boxes, and from the most recent box
         """
         try:
-            # Find the most recent document for the customer, sorted by createdAt in descending order
-            doc = await monthly_draft_box_collection.find_one(
-                {"customerID": customerID},
-                sort=[("createdAt", -1)]
-            )
+            snack_ids, most_recent = await fetch_box_history(customerID, monthly_draft_box_collection, {"_id": 0, "snacks.SnackID": 1})
+            history_log.debug("Previous SnackIDs for customer %s: %s", customerID, snack_ids)
 
-            snack_ids = []
-            if doc:
-                snacks = doc.get("snacks", [])
-                for snack in snacks:
+            most_recent_snack_ids = []
+            if most_recent is not None:
+                for snack in most_recent.get("snacks", []):
                     snack_id = snack.get("SnackID")
-                    if snack_id and snack_id not in snack_ids:
-                        snack_ids.append(snack_id)
+                    if snack_id and snack_id not in most_recent_snack_ids:
+                        most_recent_snack_ids.append(snack_id)
 
-                print(f"Most recent SnackIDs for customer {customerID}:")
-                for snack_id in snack_ids:
-                    print(f" - {snack_id}")
-                print("\n")
+                history_log.debug("Most recent SnackIDs for customer %s: %s", customerID, most_recent_snack_ids)
 
-            return snack_ids
+            return snack_ids, most_recent_snack_ids
         except Exception as e:
-            print(f"Error querying most recent box: {e}")
-            return []
+            history_log.error("Error querying box history: %s", e)
+            return [], []
 
-    def get_score(snack, priority_setting, previous_snack_ids):
-        
-        total_score = snack.get("totalScore", 0)
-        protein_boost = snack.get("highProteinBoost", 0)
-        low_carb_boost = snack.get("lowCarbBoost", 0)
-        low_calorie_boost = snack.get("lowCalorieBoost", 0)
-
-        # 01. BOOST (PREFERENCE)
-        if priority_setting == 0:
-            score = total_score
-        elif priority_setting == 1:
-            score = total_score + protein_boost
-        elif priority_setting == 2:
-            score = total_score + low_carb_boost
-        elif priority_setting == 3:
-            score = total_score + low_calorie_boost
-        else:
-            score = total_score
-
-        # 02. PENALTY (PREVIOUSLY RECEIVED)
-        
-        snack_id = snack.get("SnackID")
-        if snack_id in previous_snack_ids:
-            print(f"Applying penalty to previously received snack: {snack_id}")
-            score -= 50
-
-        print(f"SnackID: {snack_id}, Priority: {priority_setting}, Score: {score}")
-        return score
-
-
-    
-# ============================================================================================ PREPARE: GROUP INTO CATEGORIES
-
-    def group_snacks_by_primary_category(snacks):
-        grouped_snacks = defaultdict(list)
-
-        for snack in snacks:
-            # Check if snack has a primaryCategory
-            primary_category = snack.get("primaryCategory")
-
-            if not primary_category:
-                print(f"Skipping snack with missing primaryCategory: {snack}")
-                continue
-
-            # Use the category as is (no normalization)
-            grouped_snacks[primary_category.strip()].append(snack)
-
-        # Convert defaultdict to dict for output
-        return dict(grouped_snacks)
-
-
-# ============================================================================================ PREPARE: ACTUAL COUNT FOR STAPLES
-    
-    def transform_staples_object(staples, subscription_type, category_dislikes, adjusted_subscription_type):
-        try:
-            print("Starting transform_staples_object function...")
-            print(f"Input staples: {staples}")
-            print(f"Subscription type: {subscription_type}")
-            print(f"Category dislikes: {category_dislikes}")
-            print(f"Adjusted subscription type: {adjusted_subscription_type}")
-            print("\n")
-
-            # Validate inputs
-            if not isinstance(staples, dict):
-                raise ValueError("Staples must be a dictionary.")
-            if not all(v in ["one", "a few", "many"] for v in staples.values()):
-                raise ValueError("Staples values must be 'one', 'a few', or 'many'.")
-            if not isinstance(subscription_type, int) or not isinstance(adjusted_subscription_type, int):
-                raise ValueError("Subscription types must be integers.")
-            if subscription_type < 0 or adjusted_subscription_type < 0:
-                raise ValueError("Subscription types cannot be negative.")
-
-            # COUNTS
-            staples_count = len(staples)
-            dislikes_count = len(category_dislikes) if category_dislikes is not None else 0
-            optional_categories = 10 - staples_count - dislikes_count
-            print(f"Staples count: {staples_count}, Dislikes count: {dislikes_count}, Optional categories: {optional_categories}")
-            print("\n")
-
-            if optional_categories < 0:
-                raise ValueError("Invalid inputs: staples and category dislikes exceed available categories (10).")
-
-            # Count occurrences of each value in staples
-            many_count = sum(1 for v in staples.values() if v == "many")
-            few_count = sum(1 for v in staples.values() if v == "a few")
-            one_count = sum(1 for v in staples.values() if v == "one")
-            print(f"Many count: {many_count}, Few count: {few_count}, One count: {one_count}")
-
-            # Initialize value mapping
-            # Calculate total for each condition
-            if many_count * 2 + few_count * 1 + one_count * 1 < adjusted_subscription_type:
-                value_mapping = {"many": 2, "a few": 1, "one": 1}
-                total = many_count * 2 + few_count * 1 + one_count * 1
-                print(f"Condition 1: Total={total}, value_mapping={value_mapping}")
-                remaining = adjusted_subscription_type - total
-                print(f"Remaining after Condition 1: {remaining}")
-                if remaining > 0 and few_count > 0:
-                    value_mapping["a few"] = min(2, 1 + remaining // few_count)
-                    print(f"Adjusted 'a few': {value_mapping['a few']}, new value_mapping={value_mapping}")
-            elif many_count * 2 + few_count * 2 + one_count * 1 < adjusted_subscription_type:
-                value_mapping = {"many": 2, "a few": 2, "one": 1}
-                total = many_count * 2 + few_count * 2 + one_count * 1
-                print(f"Condition 2: Total={total}, value_mapping={value_mapping}")
-                remaining = adjusted_subscription_type - total
-                print(f"Remaining after Condition 2: {remaining}")
-                if remaining > 0 and many_count > 0:
-                    value_mapping["many"] = min(3, 2 + remaining // many_count)
-                    print(f"Adjusted 'many': {value_mapping['many']}, new value_mapping={value_mapping}")
-            elif many_count * 3 + few_count * 2 + one_count * 1 < adjusted_subscription_type:
-                value_mapping = {"many": 3, "a few": 2, "one": 1}
-                total = many_count * 3 + few_count * 2 + one_count * 1
-                print(f"Condition 3: Total={total}, value_mapping={value_mapping}")
-                remaining = adjusted_subscription_type - total
-                print(f"Remaining after Condition 3: {remaining}")
-                if remaining > 0 and many_count > 0:
-                    value_mapping["many"] = min(4, 3 + remaining // many_count)
-                    print(f"Adjusted 'many': {value_mapping['many']}, new value_mapping={value_mapping}")
-            elif many_count * 4 + few_count * 2 + one_count * 1 < adjusted_subscription_type:
-                value_mapping = {"many": 4, "a few": 2, "one": 1}
-                total = many_count * 4 + few_count * 2 + one_count * 1
-                print(f"Condition 4: Total={total}, value_mapping={value_mapping}")
-                remaining = adjusted_subscription_type - total
-                print(f"Remaining after Condition 4: {remaining}")
-                if remaining > 0 and many_count > 0:
-                    value_mapping["many"] = min(5, 4 + remaining // many_count)
-                    print(f"Adjusted 'many': {value_mapping['many']}, new value_mapping={value_mapping}")
-            elif many_count * 5 + few_count * 2 + one_count * 1 < adjusted_subscription_type:
-                value_mapping = {"many": 5, "a few": 2, "one": 1}
-                total = many_count * 5 + few_count * 2 + one_count * 1
-                print(f"Condition 5: Total={total}, value_mapping={value_mapping}")
-                remaining = adjusted_subscription_type - total
-                print(f"Remaining after Condition 5: {remaining}")
-                if remaining > 0 and few_count > 0:
-                    value_mapping["a few"] = min(3, 2 + remaining // few_count)
-                    print(f"Adjusted 'a few': {value_mapping['a few']}, new value_mapping={value_mapping}")
-            elif many_count * 5 + few_count * 3 + one_count * 1 < adjusted_subscription_type:
-                value_mapping = {"many": 5, "a few": 3, "one": 1}
-                total = many_count * 5 + few_count * 3 + one_count * 1
-                print(f"Condition 6: Total={total}, value_mapping={value_mapping}")
-                remaining = adjusted_subscription_type - total
-                print(f"Remaining after Condition 6: {remaining}")
-                if remaining > 0 and many_count > 0:
-                    value_mapping["many"] = min(6, 5 + remaining // many_count)
-                    print(f"Adjusted 'many': {value_mapping['many']}, new value_mapping={value_mapping}")
-            else:
-                value_mapping = {"many": 1, "a few": 1, "one": 1}
-                total = many_count * 1 + few_count * 1 + one_count * 1
-                print(f"Else Condition: Total={total}, value_mapping={value_mapping}")
-                remaining = adjusted_subscription_type - total
-                print(f"Remaining in Else: {remaining}")
-                if remaining < 0:
-                    if many_count > 0:
-                        value_mapping["many"] = max(4, (adjusted_subscription_type - few_count * 3 - one_count * 1) // many_count)
-                        print(f"Adjusted 'many' in Else: {value_mapping['many']}, new value_mapping={value_mapping}")
-                    elif few_count > 0:
-                        value_mapping["a few"] = max(2, (adjusted_subscription_type - many_count * 5 - one_count * 1) // few_count)
-                        print(f"Adjusted 'a few' in Else: {value_mapping['a few']}, new value_mapping={value_mapping}")
-
-            # Apply the mapping to the staples
-            transformed_staples = {k: value_mapping[v] for k, v in staples.items()}
-            print(f"Transformed staples: {transformed_staples}")
-
-            # Calculate the total value after transformation
-            total_value = sum(transformed_staples.values())
-            print(f"Total value after transformation: {total_value}")
-
-            # Adjust values if the total exceeds the subscription_type
-            if total_value > subscription_type:
-                print(f"Total value ({total_value}) exceeds subscription type ({subscription_type}). Adjusting...")
-
-                # Sort items by their values in descending order to target the highest value first
-                sorted_items = sorted(transformed_staples.items(), key=lambda item: item[1], reverse=True)
-                print(f"Sorted items for adjustment: {sorted_items}")
-
-                for key, value in sorted_items:
-                    if total_value <= subscription_type:
-                        break
-                    if value > 1:  # Ensure the value doesn't drop below 1
-                        transformed_staples[key] -= 1
-                        total_value -= 1
-                        print(f"Adjusted {key} from {value} to {transformed_staples[key]}, new total: {total_value}")
-
-                print("Adjustment complete.")
-
-            print(f"Final transformed staples: {transformed_staples}")
-            return transformed_staples
-
-        except Exception as e:
-            print(f"Error occurred: {str(e)}")
-            raise
-
-# ============================================================================================ 3. ADD SNACKS
-
-    def add_snacks_loop(category, desired_count, grouped_snacks, context, previous_snack_ids):
-        """
-        Loops through the snacks in a single category and adds snacks to the context's month_start_box
-        until either the desired count is reached or the secondary category increment exceeds 5.
-
-        Parameters:
-        - category: The category of snacks to process (string).
-        - desired_count: Integer specifying the number of snacks to add for the category.
-        - grouped_snacks: Dict where keys are categories, and values are lists of snacks for the specific category.
-        - context: Dict to hold the output, specifically the 'month_start_box'.
-        - previous_snack_ids: Set of SnackIDs to avoid reusing.
-
-        Returns:
-        - None (modifies the context in place).
-        """
-
-        # Initialize counters and sets for tracking usage
-        brand_usage_count = Counter()
-        flavor_tag_usage_count = Counter()
-        form_usage_count = Counter()
-        next_snacks = []
-        secondary_category_increment = 0
-        most_recent_saved_secondary_category = 0
-
-        # Extract unique values for secondary categories, forms, brands, and flavor tags
-        secondary_category_values = list(set(snack["secondaryCategory"] for snack in grouped_snacks))
-        form_values = list(set(snack["form"] for snack in grouped_snacks))
-        brand_values = list(set(snack["brand"] for snack in grouped_snacks))
-        flavor_tag_values = list(set(tag for snack in grouped_snacks for tag in snack.get("flavorTags", [])))
-
-        # Print the unique values
-        print("Unique Secondary Categories:", secondary_category_values)
-        print("Unique Forms:", form_values)
-        print("Unique Brands:", brand_values)
-        print("Unique Flavor Tags:", flavor_tag_values)
-        print(f"\n")
-
-        # Initialize usage count
-        brand_usage_count.update({brand: 0 for brand in brand_values})
-        flavor_tag_usage_count.update({tag: 0 for tag in flavor_tag_values})
-        form_usage_count.update({form: 0 for form in form_values})
-
-        def get_least_used(usage_count):
-            """
-            Returns the keys with the least usage from the given usage_count dictionary.
-            """
-            min_usage = min(usage_count.values(), default=0)
-            return {key for key, count in usage_count.items() if count == min_usage}
-
-        # Build the box
-        while len(next_snacks) < desired_count:
-            if secondary_category_increment > 15:
-                print(f"Warning: Secondary category increment exceeded limit for category '{category}'. Breaking loop.")
-                break
-
-            # Determine the current category and form
-            current_category = secondary_category_values[(secondary_category_increment + most_recent_saved_secondary_category) % len(secondary_category_values)]
-
-            least_used_brands = get_least_used(brand_usage_count)
-            least_used_flavor_tags = get_least_used(flavor_tag_usage_count)
-            least_used_forms = get_least_used(form_usage_count)
-
-            # Print the least used values
-            print(f"\n")
-            print(f"Searching for:")
-            print(f"Current Category: {current_category}")
-            print(f"Least Used Brands: {least_used_brands}")
-            print(f"Least Used Forms: {least_used_forms}")
-            print(f"Least Used Flavor Tags: {least_used_flavor_tags}")
-            print(f"\n")
-
-            # Define priority condition based on context["priority_setting"]
-            priority_setting = context.get("priority_setting", 0)  # Default to 0 if not specified
-            priority_condition = lambda snack: (
-                priority_setting == 0 or
-                (priority_setting == 1 and (
-                    snack.get("protein", 0) > 7 or
-                    snack.get("carbs", float('inf')) < 10 or
-                    snack.get("primaryCategory") in ["Dried Fruit", "Fruit Gummies"]
-                )) or
-                (priority_setting == 2 and (
-                    snack.get("carbs", float('inf')) < 10 or
-                    snack.get("primaryCategory") in ["Dried Fruit", "Fruit Gummies"]
-                )) or
-                (priority_setting == 3 and snack.get("calories", float('inf')) < 150)
-            )
-
-            # Filter snacks based on criteria, including priority setting
-            matching_snacks = [
-                snack for snack in grouped_snacks
-                if snack["secondaryCategory"] == current_category and
-                   (secondary_category_increment >= 10 or snack["itemOfMonthBoost"] > 0) and
-                   snack["form"] in least_used_forms and
-                   snack["brand"] in least_used_brands and
-                   (secondary_category_increment >= 12 or snack["SnackID"] not in previous_snack_ids) and
-                   all(tag in least_used_flavor_tags for tag in snack.get("flavorTags", [])) and
-                   snack["inStock"] is True and  # Added inStock condition
-                   snack["active"] is True and   # Added active condition
-                   priority_condition(snack)     # Added priority condition
-            ]
-
-            # Relax criteria step-by-step if no matches
-            if not matching_snacks:
-                matching_snacks = [
-                    snack for snack in grouped_snacks
-                    if snack["secondaryCategory"] == current_category and
-                       (secondary_category_increment >= 10 or snack["itemOfMonthBoost"] > 0) and
-                       snack["form"] in least_used_forms and
-                       snack["brand"] in least_used_brands and
-                       (secondary_category_increment >= 12 or snack["SnackID"] not in previous_snack_ids) and
-                       snack["inStock"] is True and  # Added inStock condition
-                       snack["active"] is True and   # Added active condition
-                       priority_condition(snack)     # Added priority condition
-                ]
-
-            if not matching_snacks:
-                matching_snacks = [
-                    snack for snack in grouped_snacks
-                    if snack["secondaryCategory"] == current_category and
-                       (secondary_category_increment >= 10 or snack["itemOfMonthBoost"] > 0) and
-                       snack["form"] in least_used_forms and
-                       (secondary_category_increment >= 12 or snack["SnackID"] not in previous_snack_ids) and
-                       snack["inStock"] is True and  # Added inStock condition
-                       snack["active"] is True and   # Added active condition
-                       priority_condition(snack)     # Added priority condition
-                ]
-
-            if not matching_snacks:
-                matching_snacks = [
-                    snack for snack in grouped_snacks
-                    if snack["secondaryCategory"] == current_category and
-                       (secondary_category_increment >= 10 or snack["itemOfMonthBoost"] > 0) and
-                       (secondary_category_increment >= 12 or snack["SnackID"] not in previous_snack_ids) and
-                       snack["inStock"] is True and  # Added inStock condition
-                       snack["active"] is True and   # Added active condition
-                       priority_condition(snack)     # Added priority condition
-                ]
-
-            # If still no matches, increment secondary category and continue
-            if not matching_snacks:
-                print(f"No matches found for category '{category}', secondary category '{current_category}'. Incrementing.")
-                secondary_category_increment += 1
-                continue
-
-            # Print all matching snacks
-            print("ALL MATCHING SNACKS:")
-            for snack in matching_snacks:
-                print(
-                    f"SnackID: {snack.get('SnackID')}, "
-                    f"Item Of Month Boost: {snack.get('itemOfMonthBoost')}, "
-                    f"productLine: {snack.get('productLine')}, "
-                    f"ounces: {snack.get('ounces')}, "
-                    f"primaryCategory: {snack.get('primaryCategory')}, "
-                    f"secondaryCategory: {snack.get('secondaryCategory')}, "
-                    f"form: {snack.get('form')}, "
-                    f"brand: {snack.get('brand')}, "
-                    f"flavor: {snack.get('flavor')}, "
-                    f"protein: {snack.get('protein', 'N/A')}, "
-                    f"carbs: {snack.get('carbs', 'N/A')}, "
-                    f"calories: {snack.get('calories', 'N/A')}"
-                )
-
-            selected_snack = matching_snacks[0]
-            next_snacks.append(selected_snack)
-
-            # Log the SnackID of the added snack
-            print(f"\n")
-            print(f"Added to next_snacks: {selected_snack['SnackID']}")
-
-            # Print all SnackIDs in next_snacks, each on a new line
-            print(f"\n")
-            print("NEXT SNACKS:")
-            for snack in next_snacks:
-                print(snack["SnackID"])
-            print(f"\n")
-
-            # Update usage counts
-            brand_usage_count[selected_snack["brand"]] += 1
-            for tag in selected_snack.get("flavorTags", []):
-                flavor_tag_usage_count[tag] += 1
-            form_usage_count[selected_snack["form"]] += 1
-
-            # Remove selected snack from the category list
-            grouped_snacks.remove(selected_snack)
-
-            # Reset increment and rotate form
-            most_recent_saved_secondary_category += 1
-            secondary_category_increment = 0
-
-        # Add results to the context
-        context["month_start_box"].extend(
-            {
-                "SnackID": snack["SnackID"],
-                "primaryCategory": category,
-                "productLine": snack["productLine"],
-                "count": 1,
-                "premium": snack["premium"],
-            }
-            for snack in next_snacks
-        )
-
-        print(f"Final snacks added for category '{category}':")
-        print(context["month_start_box"])
-        print("\n")
-
-    ### STAPLES
-    
-    def process_staples(transformed_staples, grouped_snacks, context, previous_snack_ids):
-        """
-        Processes each category in transformed_staples by calling add_snacks_loop
-        to add snacks to the context's month_start_box.
-
-        Parameters:
-        - transformed_staples: Dict of staples with their respective counts.
-        - grouped_snacks: Dict where keys are categories, and values are lists of snacks.
-        - context: Dict to hold the output, specifically the 'month_start_box'.
-
-        Returns:
-        - None (modifies the context in place).
-        """
-        for category, count in transformed_staples.items():
-            print(f"Processing category: {category} with desired count: {count}")
-
-            # Pass only the snacks for the current category
-            snacks_for_category = grouped_snacks.get(category, [])
-
-            # Print the length of snacks for the current category
-            print(f"Number of snacks available for category '{category}': {len(snacks_for_category)}")
-
-            if not snacks_for_category:
-                print(f"Warning: No snacks found for category '{category}'. Skipping...")
-                continue
-
-            # Call add_snacks_loop with the filtered snacks
-            add_snacks_loop(
-                category=category,
-                desired_count=count,
-                grouped_snacks=snacks_for_category,
-                context=context,
-                previous_snack_ids=previous_snack_ids
-            )
-
-        print("\n")    
-
-    ### REMAINING CATEGORIES
-
-    def process_remaining_categories(remaining_categories, count_to_fill, grouped_snacks, context, previous_snack_ids):
-        """
-        Processes each category in remaining_categories by calling add_snacks_loop
-        to dynamically distribute snacks across categories and add them to the context's month_start_box.
-
-        Parameters:
-        - remaining_categories (list): A list of category names to process.
-        - count_to_fill (int): Total number of snacks to be added across all categories.
-        - grouped_snacks (dict): A dictionary where keys are category names and values are lists of snacks.
-        - context (dict): A dictionary to hold the output, specifically the 'month_start_box'.
-        - previous_snack_ids (list): List of previously selected snack IDs to avoid duplicates.
-
-        Returns:
-        - None: Modifies the context in place.
-        """
-        # Validate inputs
-        if not isinstance(remaining_categories, list):
-            raise ValueError("remaining_categories must be a list.")
-        if not isinstance(grouped_snacks, dict):
-            raise ValueError("grouped_snacks must be a dictionary.")
-        if not isinstance(count_to_fill, int) or count_to_fill <= 0:
-            raise ValueError("count_to_fill must be a positive integer.")
-
-        # Filter out categories in context["category_dislikes"]
-        disliked_categories = context.get("category_dislikes", [])
-        print(f"Disliked categories: {disliked_categories}")
-        valid_categories = [category for category in remaining_categories if category not in disliked_categories]
-
-        # Calculate the dynamic count for each category
-        num_categories = len(valid_categories)
-        if num_categories == 0:
-            print("No valid categories to process after filtering dislikes.")
-            return
-
-        # Distribute counts evenly and handle any remainder
-        base_count = count_to_fill // num_categories
-        remainder = count_to_fill % num_categories
-
-        for idx, category in enumerate(valid_categories):
-            # Get the snacks for the current category
-            snacks_for_category = grouped_snacks.get(category, [])
-
-            # Process only if snacks are available
-            if len(snacks_for_category) > 0:
-                # Add 1 to the base count for the first 'remainder' categories
-                dynamic_count = base_count + (1 if idx < remainder else 0)
-
-                print(f"** PROCESSING CATEGORY: {category}, Available: {len(snacks_for_category)}, Selecting: {dynamic_count}")
-                print("\n")
-
-                # Call add_snacks_loop with the calculated dynamic count
-                add_snacks_loop(
-                    category=category,
-                    desired_count=dynamic_count,
-                    grouped_snacks=snacks_for_category,
-                    context=context,
-                    previous_snack_ids=previous_snack_ids
-                )
-            else:
-                print(f"Skipping category '{category}' as no snacks are available.")
-
-        print("\n")
-        
-    # ========================================================================================================================== BUILD
-    
-    async def build_month_start_box(off_cycle):
-
-        context["month_start_box"].extend(context["repeat_monthly"] or [])
-
-        # LOGGING
-        print("===============")
-        print("START: BUILDING DRAFT BOX\n")
-        print(f'EXTEND 1: {context["month_start_box"]}')
-        print("--------------------------------------------------------------------------")
-        print("\n")
-
-        total_repeat_count = sum(item['count'] for item in context["repeat_monthly"])
-        print(f"REPEAT COUNT: {total_repeat_count}") 
-
-        adjusted_subscription_type = context["subscription_type"] - total_repeat_count
-
-        # Check if adjusted_subscription_type is negative
-        if adjusted_subscription_type < 0:
-            print(f"Adjusted subscription type is negative ({adjusted_subscription_type}). Skipping snack selection and proceeding to save.")
-            return  # Exit early to skip to saving
-                
-        transformed_staples = transform_staples_object(context["staples"], context["subscription_type"], context["category_dislikes"], adjusted_subscription_type)
-        print(f"Transformed Staples: {transformed_staples}")
-
-        # GET PREVIOUS SNACK IDS (PENALTY)
-        previous_snack_ids = await get_previous_snack_ids(customerID)
-        
-        # Fetch the safe snacks
-        most_recent_snack_ids = await get_most_recent_box(customerID)
-        
-        safe_snacks = await fetch_snacks_filtered(context["customer_allergens"], context["vetoed_flavors"], context["category_dislikes"], off_cycle, previous_snack_ids, context["repeat_monthly"])
-
-        # Get priority_setting from context
-        priority_setting = context.get("priority_setting", 0)  # Default to 0 if not set
-        print(f"PRIORITY SETTING: {priority_setting}")
-
-        # Validate the structure of safe_snacks
-        if not isinstance(safe_snacks, list):
-            raise ValueError("safe_snacks must be a list.")
-        
-        # CALCULATE SCORE
-        sorted_safe_snacks = sorted(
-            safe_snacks, 
-            key=lambda snack: get_score(snack, priority_setting, previous_snack_ids), 
-            reverse=True
-        )
-        
-        grouped_snacks = group_snacks_by_primary_category(sorted_safe_snacks)
-
-# ======= 2. ADD STAPLES
-        
-        # Call the function
-        process_staples(transformed_staples, grouped_snacks, context, previous_snack_ids)
-
-        # Print the remaining categories in the month_start_box
-        print("EXTEND 2 (REMAINING CATEGORIES):")
-        print("--------------------------------------------------------------------------")
-        print("\n")
-        for item in context["month_start_box"]:
-            print(item)
-        print("\n")
-        print("MOVING")
-
-# ======= 3. COMPLETE BOX WITH REMAINING CATEGORIES
-
-        # ADD REMAINING CATEGORIES
-        remaining_categories = [
-            cat for cat in grouped_snacks if cat not in transformed_staples and cat not in (context["category_dislikes"] or [])
-        ]
-
-        print(f"Remaining categories to fill: {remaining_categories}")
-        
-        # Calculate running tally of 'count' fields in month_start_box
-        month_start_box_count = sum(item.get('count', 0) for item in context["month_start_box"])
-        print(f"Running tally of count fields in month_start_box: {month_start_box_count}")
-
-        # Calculate count_to_fill using the sum of 'count' fields
-        count_to_fill = context["subscription_type"] - month_start_box_count
-        print(f"Count to fill: {count_to_fill}")
-
-
-        # Only process remaining categories if count_to_fill is greater than 0
-        if count_to_fill > 0:
-            process_remaining_categories(remaining_categories, count_to_fill, grouped_snacks, context, previous_snack_ids)
-
-        # CHECK: BOX IS FULL
-        if len(context["month_start_box"]) != context["subscription_type"]:
-            print(f"EXTEND 3 (REMAINING CATEGORIES): Box still not full: {len(context['month_start_box'])}/{context['subscription_type']}. Adding remaining snacks.")
-            
-            # RECALCULATE count_to_fill
-            month_start_box_count = sum(item.get('count', 0) for item in context["month_start_box"])
-            print(f"Running tally of count fields in month_start_box: {month_start_box_count}")
-            count_to_fill = context["subscription_type"] - month_start_box_count
-            print(f"Count to fill: {count_to_fill}")
-            
-            # Only process remaining categories if count_to_fill is greater than 0
-            if count_to_fill > 0:
-                process_remaining_categories(remaining_categories, count_to_fill, grouped_snacks, context, previous_snack_ids)
-
-        # Print the extended list
-        print("EXTEND 3 (REMAINING CATEGORIES):")
-        print("--------------------------------------------------------------------------")
-        print("\n")
-        for index, item in enumerate(context["month_start_box"], start=1):
-            print(f"{index}: {item}")
-        print("\n")
-
-        # NEW: EXTEND 4 (CATCH-ALL)
-        month_start_box_count = sum(item.get('count', 0) for item in context["month_start_box"])
-        if month_start_box_count != context["subscription_type"]:
-            count_to_fill = context["subscription_type"] - month_start_box_count
-            print(f"EXTEND 4 (CATCH-ALL): Box still not full: {month_start_box_count}/{context['subscription_type']}. Adding {count_to_fill} snacks with highest total score.")
-            print("--------------------------------------------------------------------------")
-    
-            # Get SnackIDs already in the box to avoid duplicates
-            current_snack_ids = {item["SnackID"] for item in context["month_start_box"]}
-    
-            # Filter sorted_safe_snacks to exclude already selected snacks and ensure inStock and active are True
-            available_snacks = [
-                snack for snack in sorted_safe_snacks 
-                if snack["SnackID"] not in current_snack_ids and
-                   snack["inStock"] is True and  # Added inStock condition
-                   snack["active"] is True       # Added active condition
-            ]
-    
-            print(f"Available snacks for EXTEND 4: {len(available_snacks)}")
-    
-            # Add highest-scoring snacks until the box is full or no snacks remain
-            added_snacks = 0
-            for snack in available_snacks:
-                if added_snacks >= count_to_fill:
-                    break
-                context["month_start_box"].append({
-                    "SnackID": snack["SnackID"],
-                    "primaryCategory": snack["primaryCategory"],
-                    "productLine": snack["productLine"],
-                    "count": 1,
-                    "premium": snack["premium"],
-                })
-                added_snacks += 1
-                print(f"Added snack in EXTEND 4: {snack['SnackID']} (Score: {snack.get('totalScore', 0)})")
-    
-            if added_snacks < count_to_fill:
-                print(f"Warning: Could only add {added_snacks} snacks in EXTEND 4. Insufficient snacks available.")
-    
-        print("EXTEND 4 (FINAL BOX):")
-        print("--------------------------------------------------------------------------")
-        for index, item in enumerate(context["month_start_box"], start=1):
-            print(f"{index}: {item}")
-        month_start_box_count = sum(item.get('count', 0) for item in context["month_start_box"])
-        print(f"Final box size: {month_start_box_count}/{context['subscription_type']}")
 
 # ========================================================================================================================== SAVE
             
-    async def save_month_start_box(new_signup):
-        print(f'Saving Box: {context["month_start_box"]}')
+    def prepare_month_start_box(new_signup):
+        save_log.debug("Preparing Box: %s", context["month_start_box"])
 
         # MONTH
-        current_date = datetime.now()
-        months_to_add = 2 if off_cycle else 1
-        year = current_date.year + (current_date.month + months_to_add - 1) // 12
-        month = (current_date.month + months_to_add - 1) % 12 + 1
-        target_date = datetime(year, month, 1)
-        month_as_int = int(target_date.strftime("%m%y"))
+        month_as_int = draft_box_month(off_cycle)
 
         # ORDER STATUS
-        print(f'NEW SIGNUP: {new_signup}')
-        order_status = "firstbox" if new_signup else "Customize"
+        save_log.debug("NEW SIGNUP: %s", new_signup)
+        order_status = draft_box_order_status(new_signup)
 
-        print(f'ORDER STATUS: {order_status}')
+        save_log.debug("ORDER STATUS: %s", order_status)
         
         created_at = datetime.utcnow()
         timestamp = created_at.strftime("%Y%m%d%H%M%S")
@@ -941,16 +665,44 @@ async def build_starting_box(
         
 
         if context["month_start_box"]:
-            await monthly_draft_box_collection.insert_one(document)
-            print(f"Box saved successfully for customer: {customerID}")
-            return document["snacks"]  # Return only the snacks field
-        else:
-            print("Box is empty. Nothing to save.")
+            return document
 
 
 # ========================================================================================================================== RUN
     
-    await get_customer_by_customerID(customerID, is_reset_box, reset_total)
-    await build_month_start_box(off_cycle)
-    snacks = await save_month_start_box(new_signup)  # Capture the snacks field
-    return snacks  # Return the snacks to the endpoint
\ No newline at end of file
+    with trace_customer(customerID, force=trace) as traced:
+        # PREFETCH: the customer profile and box history don't depend on each other
+        with time_stage("prefetch", profile):
+            _, (previous_snack_ids, most_recent_snack_ids) = await asyncio.gather(
+                get_customer_by_customerID(customerID, is_reset_box, reset_total, customer_document),
+                get_box_history(customerID),
+            )
+
+        # SELECT: pure CPU work on the catalog snapshot (inline or in the selection pool)
+        catalog = await get_snack_catalog(all_snacks_collection)
+        captured = build_capture.sample()
+        if captured:
+            # Selection fills the context's box in place: keep the inputs as they were
+            snapshot = catalog.snapshot
+            captured_context = {key: value for key, value in context.items() if key != "month_start_box"}
+        context["month_start_box"] = await run_box_selection(catalog, context, off_cycle, previous_snack_ids, customerID, traced, profile)
+        if profile is not None:
+            profile.box_size = len(context["month_start_box"])
+        if captured:
+            await build_capture.record(
+                snapshot,
+                all_snacks_collection.full_name,
+                {
+                    "customerID": customerID,
+                    "new_signup": new_signup,
+                    "repeat_customer": repeat_customer,
+                    "off_cycle": off_cycle,
+                    "is_reset_box": is_reset_box,
+                    "reset_total": reset_total,
+                    "repeat_monthly": serialized_repeat_monthly,
+                },
+                captured_context,
+                previous_snack_ids,
+                context["month_start_box"],
+            )
+        return prepare_month_start_box(new_signup)  # Saved by the caller
\ No newline at end of file
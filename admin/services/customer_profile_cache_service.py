@@ -0,0 +1,93 @@
+import os
+import time
+from collections import OrderedDict
+from admin.config.logging_config import get_stage_logger
+from admin.services.metrics_service import CUSTOMER_PROFILE_CACHE_REQUESTS, CUSTOMER_PROFILE_CACHE_SIZE
+
+# Seconds a cached customer profile stays valid (0 disables the cache)
+CUSTOMER_PROFILE_CACHE_TTL_SECONDS = float(os.environ.get("CUSTOMER_PROFILE_CACHE_TTL_SECONDS", "300"))
+
+# Maximum number of cached customer profiles (least recently used are evicted first)
+CUSTOMER_PROFILE_CACHE_MAX_SIZE = int(os.environ.get("CUSTOMER_PROFILE_CACHE_MAX_SIZE", "10000"))
+
+cache_log = get_stage_logger("customer_cache")
+
+
+class CustomerProfileCache:
+    """
+    LRU cache of projected customer profiles (CUSTOMER_PROFILE_PROJECTION) keyed by customerID.
+
+    Retries, off-cycle builds and reset boxes for the same customer reuse the profile instead
+    of querying customers again. Entries expire after `ttl` seconds and the web app calls
+    invalidate() when a customer edits their preferences. Cached profiles are shared between
+    builds and must not be modified.
+
+    invalidate() also bumps the customer's generation. Callers capture generation() before
+    querying customers and pass it to put(), so a query that was in flight during an
+    invalidation doesn't cache the profile from before the edit.
+    """
+
+    def __init__(self, ttl=CUSTOMER_PROFILE_CACHE_TTL_SECONDS, max_size=CUSTOMER_PROFILE_CACHE_MAX_SIZE):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.entries = OrderedDict()  # customerID -> (expires_at, profile)
+        self.generations = {}  # customerID -> number of invalidations
+
+    def get(self, customer_id):
+        """
+        Returns:
+            dict: The cached profile, or None on a miss or when it has expired.
+        """
+        entry = self.entries.get(customer_id)
+        if entry is not None:
+            expires_at, profile = entry
+            if expires_at > time.monotonic():
+                self.entries.move_to_end(customer_id)
+                CUSTOMER_PROFILE_CACHE_REQUESTS.inc(result="hit")
+                return profile
+            del self.entries[customer_id]
+            CUSTOMER_PROFILE_CACHE_SIZE.set(len(self.entries))
+        CUSTOMER_PROFILE_CACHE_REQUESTS.inc(result="miss")
+        return None
+
+    def generation(self, customer_id):
+        return self.generations.get(customer_id, 0)
+
+    def put(self, customer_id, profile, generation=None):
+        """
+        Cache a customer's profile.
+
+        Args:
+            generation (int): generation(customer_id) from before the profile was queried. The
+                profile is dropped if the customer was invalidated since.
+        """
+        if self.ttl <= 0 or self.max_size <= 0 or profile is None:
+            return
+        if generation is not None and generation != self.generation(customer_id):
+            cache_log.info("Not caching profile for customer %s: invalidated while it was queried", customer_id)
+            return
+        self.entries[customer_id] = (time.monotonic() + self.ttl, profile)
+        self.entries.move_to_end(customer_id)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+        CUSTOMER_PROFILE_CACHE_SIZE.set(len(self.entries))
+
+    def invalidate(self, customer_id):
+        """
+        Drop a customer's cached profile.
+
+        Returns:
+            bool: Whether a profile was cached.
+        """
+        self.generations[customer_id] = self.generation(customer_id) + 1
+        removed = self.entries.pop(customer_id, None) is not None
+        CUSTOMER_PROFILE_CACHE_SIZE.set(len(self.entries))
+        cache_log.info("Invalidated cached profile for customer %s (cached: %s)", customer_id, removed)
+        return removed
+
+    def clear(self):
+        self.entries.clear()
+        CUSTOMER_PROFILE_CACHE_SIZE.set(0)
+
+
+customer_profile_cache = CustomerProfileCache()
@@ -0,0 +1,280 @@
+import os
+import fcntl
+import asyncio
+from bson import ObjectId, json_util
+from pymongo import ReplaceOne, WriteConcern
+from pymongo.errors import BulkWriteError
+from admin.config.logging_config import get_stage_logger
+from admin.services.metrics_service import time_stage, DRAFT_BOX_WRITE_BATCH
+
+# How build_starting_box saves a draft box:
+#   "sync"    - insert_one per box before responding (default)
+#   "batched" - write-behind insert_many batches; respond once the box's batch is acknowledged
+#   "async"   - write-behind insert_many batches; respond without waiting for the write
+DRAFT_BOX_WRITE_MODE = os.environ.get("DRAFT_BOX_WRITE_MODE", "sync").lower()
+
+# Flush a batch once it holds this many boxes...
+DRAFT_BOX_WRITE_BATCH_SIZE = int(os.environ.get("DRAFT_BOX_WRITE_BATCH_SIZE", "100"))
+
+# ...or this many seconds after its first box arrived
+DRAFT_BOX_WRITE_INTERVAL_SECONDS = float(os.environ.get("DRAFT_BOX_WRITE_INTERVAL_SECONDS", "0.05"))
+
+# Write concern for write-behind batches, e.g. "1" or "majority"
+DRAFT_BOX_WRITE_CONCERN = os.environ.get("DRAFT_BOX_WRITE_CONCERN", "1")
+
+# Wait for the journal before a batch counts as acknowledged
+DRAFT_BOX_WRITE_JOURNAL = os.environ.get("DRAFT_BOX_WRITE_JOURNAL", "false").lower() == "true"
+
+# Seconds to flush queued boxes on shutdown before spooling the rest to disk
+DRAFT_BOX_SHUTDOWN_TIMEOUT_SECONDS = float(os.environ.get("DRAFT_BOX_SHUTDOWN_TIMEOUT_SECONDS", "10"))
+
+# Boxes that couldn't be written (unacknowledged failures, shutdown leftovers) are appended
+# here and replayed at the next startup
+DRAFT_BOX_SPOOL_PATH = os.environ.get("DRAFT_BOX_SPOOL_PATH", "draftboxes.spool.jsonl")
+
+writer_log = get_stage_logger("save")
+
+
+class DraftBoxWriteError(Exception):
+    """
+    A queued draft box could not be inserted.
+    """
+
+
+def _write_concern():
+    w = int(DRAFT_BOX_WRITE_CONCERN) if DRAFT_BOX_WRITE_CONCERN.isdigit() else DRAFT_BOX_WRITE_CONCERN
+    return WriteConcern(w=w, j=DRAFT_BOX_WRITE_JOURNAL)
+
+
+def spool_draft_boxes(documents, spool_path=DRAFT_BOX_SPOOL_PATH):
+    """
+    Append draft boxes to the spool file (Extended JSON, one per line) and fsync it.
+
+    Every box is spooled with its _id (insert_many already set it on boxes it sent), so the
+    replay can tell a box whose insert went through from another box with the same boxID.
+    """
+    if not documents:
+        return
+    for document in documents:
+        document.setdefault("_id", ObjectId())
+    with open(spool_path, "a") as spool_file:
+        spool_file.write("".join(json_util.dumps(document) + "\n" for document in documents))
+        spool_file.flush()
+        os.fsync(spool_file.fileno())
+    writer_log.warning("Spooled %s draft boxes to %s", len(documents), spool_path)
+
+
+async def replay_spooled_draft_boxes(monthly_draft_box_collection, spool_path=DRAFT_BOX_SPOOL_PATH):
+    """
+    Write spooled draft boxes to Mongo and remove the spool file.
+
+    Boxes are upserted by _id, so a box whose original insert did go through isn't duplicated.
+    (boxID only has one-second resolution: two boxes built for a customer in the same second
+    share it.) Lines spooled without an _id by older versions fall back to boxID.
+
+    The spool is taken by renaming it to `<spool>.replaying`, under an flock on `<spool>.lock`
+    so only one worker sharing the path replays it. A `.replaying` file left by a replay that
+    crashed is replayed first.
+
+    Returns:
+        int: Number of boxes replayed.
+    """
+    replaying_path = f"{spool_path}.replaying"
+    with open(f"{spool_path}.lock", "a") as lock_file:
+        try:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            writer_log.info("Spooled draft boxes in %s are being replayed by another worker", spool_path)
+            return 0
+
+        replayed = 0
+        if os.path.exists(replaying_path):
+            replayed = await _replay_spool_file(monthly_draft_box_collection, replaying_path, spool_path)
+            if replayed is None:
+                return 0
+        try:
+            os.replace(spool_path, replaying_path)
+        except FileNotFoundError:
+            return replayed  # Nothing spooled
+        return replayed + (await _replay_spool_file(monthly_draft_box_collection, replaying_path, spool_path) or 0)
+
+
+async def _replay_spool_file(monthly_draft_box_collection, replaying_path, spool_path):
+    """
+    Returns:
+        int: Number of boxes replayed, or None if they were spooled again for the next attempt.
+    """
+    with open(replaying_path) as spool_file:
+        documents = [json_util.loads(line) for line in spool_file if line.strip()]
+
+    try:
+        if documents:
+            await monthly_draft_box_collection.bulk_write(
+                [
+                    ReplaceOne({"_id": document["_id"]} if "_id" in document else {"boxID": document["boxID"]}, document, upsert=True)
+                    for document in documents
+                ],
+                ordered=False,
+            )
+    except Exception as e:
+        writer_log.error("An error occurred while replaying spooled draft boxes: %s", e)
+        # Keep them for the next attempt
+        spool_draft_boxes(documents, spool_path)
+        os.remove(replaying_path)
+        return None
+
+    os.remove(replaying_path)
+    writer_log.info("Replayed %s spooled draft boxes", len(documents))
+    return len(documents)
+
+
+class DraftBoxWriter:
+    """
+    Write-behind queue that groups draft box inserts into insert_many batches.
+
+    A batch is flushed when it reaches `batch_size` boxes or `interval` seconds after its first
+    box, whichever comes first. save() either waits for its batch to be acknowledged or returns
+    right away; boxes whose unawaited write fails are spooled to disk instead of being lost.
+    """
+
+    def __init__(self, collection, batch_size=DRAFT_BOX_WRITE_BATCH_SIZE, interval=DRAFT_BOX_WRITE_INTERVAL_SECONDS, write_concern=None):
+        self.collection = collection.with_options(write_concern=write_concern or _write_concern())
+        self.batch_size = batch_size
+        self.interval = interval
+        self.queue = asyncio.Queue()
+        self.in_flight = []
+        self.closed = False
+        self._task = None
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def save(self, document, wait=True):
+        """
+        Queue a draft box for insertion.
+
+        Args:
+            document (dict): The draft box; its boxID is already set, so it can be returned before the write.
+            wait (bool): Wait until the batch holding the box is acknowledged.
+        """
+        if self.closed:
+            # Shutting down: write directly
+            await self.collection.insert_one(document)
+            return
+
+        self.start()
+        future = asyncio.get_running_loop().create_future() if wait else None
+        self.queue.put_nowait((document, future))
+        if future is not None:
+            await future
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        stopping = False
+        while not stopping:
+            item = await self.queue.get()
+            if item is None:
+                break
+            batch = [item]
+            deadline = loop.time() + self.interval
+            while len(batch) < self.batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(self.queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+            await self._write(batch)
+
+    async def _write(self, batch):
+        self.in_flight = batch
+        errors = {}
+        try:
+            with time_stage("save_write_behind"):
+                await self.collection.insert_many([document for document, _ in batch], ordered=False)
+        except BulkWriteError as e:
+            errors = {write_error["index"]: write_error.get("errmsg") for write_error in e.details.get("writeErrors", [])}
+        except Exception as e:
+            errors = {index: str(e) for index in range(len(batch))}
+        finally:
+            self.in_flight = []
+        DRAFT_BOX_WRITE_BATCH.observe(len(batch))
+
+        unacknowledged = []
+        for index, (document, future) in enumerate(batch):
+            if index in errors:
+                if future is None:
+                    unacknowledged.append(document)
+                elif not future.done():
+                    future.set_exception(DraftBoxWriteError(f"An error occurred while saving the box: {errors[index]}"))
+            elif future is not None and not future.done():
+                future.set_result(None)
+
+        if errors:
+            writer_log.error("Draft box batch: %s/%s inserts failed", len(errors), len(batch))
+        if unacknowledged:
+            spool_draft_boxes(unacknowledged)
+
+    async def close(self, timeout=DRAFT_BOX_SHUTDOWN_TIMEOUT_SECONDS):
+        """
+        Flush everything queued. Whatever isn't written within `timeout` is spooled to disk.
+        """
+        self.closed = True
+        if self._task is None or self._task.done():
+            leftovers = []
+        else:
+            self.queue.put_nowait(None)
+            try:
+                await asyncio.wait_for(asyncio.shield(self._task), timeout)
+                leftovers = []
+            except asyncio.TimeoutError:
+                self._task.cancel()
+                leftovers = list(self.in_flight)
+                writer_log.error("Draft box writer didn't flush within %ss on shutdown", timeout)
+
+        while not self.queue.empty():
+            item = self.queue.get_nowait()
+            if item is not None:
+                leftovers.append(item)
+
+        for _, future in leftovers:
+            if future is not None and not future.done():
+                future.set_exception(DraftBoxWriteError("The service is shutting down"))
+        spool_draft_boxes([document for document, _ in leftovers])
+
+
+# One writer per draft box collection namespace
+_writers = {}
+
+
+def get_draft_box_writer(monthly_draft_box_collection):
+    writer = _writers.get(monthly_draft_box_collection.full_name)
+    if writer is None:
+        writer = DraftBoxWriter(monthly_draft_box_collection)
+        _writers[monthly_draft_box_collection.full_name] = writer
+    return writer
+
+
+async def save_draft_box(monthly_draft_box_collection, document):
+    """
+    Save a draft box according to DRAFT_BOX_WRITE_MODE.
+    """
+    if DRAFT_BOX_WRITE_MODE == "sync":
+        await monthly_draft_box_collection.insert_one(document)
+        return
+    await get_draft_box_writer(monthly_draft_box_collection).save(document, wait=DRAFT_BOX_WRITE_MODE != "async")
+
+
+async def close_draft_box_writers():
+    """
+    Lifespan shutdown step: flush (or spool) every write-behind queue.
+    """
+    for writer in list(_writers.values()):
+        await writer.close()
+    _writers.clear()
@@ -0,0 +1,90 @@
+from functools import lru_cache
+
+# Suffixes removed from a vetoed flavor to get its stem (longest first)
+SUFFIXES_TO_STRIP = sorted(["ies", "s", "es", "ed", "ing", "y"], key=len, reverse=True)
+
+# Suffixes added back to a stem to get every inflection it vetoes
+SUFFIXES_TO_ADD = ["", "e", "y", "s", "es", "ed", "ing", "ies"]
+
+# Maximum number of distinct customer flavors kept by the memoized stemmer
+FLAVOR_STEM_CACHE_SIZE = 4096
+
+
+def strip_suffix(word):
+    """
+    Remove the longest matching suffix from a word, based on SUFFIXES_TO_STRIP.
+    """
+    for suffix in SUFFIXES_TO_STRIP:
+        if word.endswith(suffix):
+            if suffix == "ies" and len(word) > 3:  # Special handling for "ies"
+                return word[:-3] + "y"
+            return word[: -len(suffix)]
+    return word
+
+
+@lru_cache(maxsize=FLAVOR_STEM_CACHE_SIZE)
+def flavor_stem(flavor):
+    """
+    Stem of a customer's vetoed flavor, e.g. "Cherries" -> "cherry".
+    """
+    return strip_suffix(flavor.lower())
+
+
+def expand_stem(stem):
+    """
+    The flavor tags (capitalized) a vetoed stem excludes.
+    """
+    expanded_flavors = set()
+    for suffix in SUFFIXES_TO_ADD:
+        if suffix == "ies" and stem.endswith("y"):
+            expanded_flavors.add(stem[:-1] + "ies")
+        else:
+            expanded_flavors.add(stem + suffix)
+    return {flavor.capitalize() for flavor in expanded_flavors}
+
+
+def tag_stems(tag):
+    """
+    Every stem whose expansion contains `tag`, i.e. the vetoed stems that exclude it.
+
+    Candidates come from removing each added suffix from the lowercased tag, then are
+    checked against expand_stem so a veto matches exactly the tags it used to.
+    """
+    if not isinstance(tag, str):
+        return set()
+    word = tag.lower()
+    candidates = set()
+    for suffix in SUFFIXES_TO_ADD:
+        if word.endswith(suffix):
+            candidates.add(word[: len(word) - len(suffix)])
+    if word.endswith("ies"):
+        candidates.add(word[:-3] + "y")
+    return {stem for stem in candidates if tag in expand_stem(stem)}
+
+
+class FlavorStemIndex:
+    """
+    Stem -> bitset of snacks with a flavor tag that the stem vetoes.
+
+    Built once per catalog load from the flavorTags bitsets, so vetoing a flavor is a
+    stem lookup instead of expanding it into every inflection on each request.
+    """
+
+    def __init__(self, tag_bits):
+        """
+        Args:
+            tag_bits (dict): Flavor tag -> bitset of catalog positions (SnackAttributeIndex.values["flavorTags"]).
+        """
+        self.stem_bits = {}
+        for tag, bits in tag_bits.items():
+            for stem in tag_stems(tag):
+                self.stem_bits[stem] = self.stem_bits.get(stem, 0) | bits
+
+    def vetoed(self, vetoed_flavors):
+        """
+        Bitset of snacks excluded by a customer's vetoed flavors.
+        """
+        bits = 0
+        for flavor in vetoed_flavors:
+            bits |= self.stem_bits.get(flavor_stem(flavor), 0)
+        return bits
@@ -0,0 +1,95 @@
+import os
+import json
+import time
+import hashlib
+from collections import OrderedDict
+
+# Seconds a built box is returned again for a request retried with the same Idempotency-Key (0 disables idempotency)
+BOX_IDEMPOTENCY_WINDOW_SECONDS = float(os.environ.get("BOX_IDEMPOTENCY_WINDOW_SECONDS", "300"))
+
+# Maximum number of recent builds remembered in memory
+BOX_IDEMPOTENCY_CACHE_MAX_SIZE = int(os.environ.get("BOX_IDEMPOTENCY_CACHE_MAX_SIZE", "10000"))
+
+
+def request_fingerprint(customerID, new_signup, repeat_customer, off_cycle, is_reset_box, reset_total, repeat_monthly):
+    """
+    Stable hash of a build request. Identical requests in flight at the same time share one
+    build; it isn't used to replay finished builds, since it doesn't cover the customer's profile.
+    """
+    payload = {
+        "customerID": customerID,
+        "new_signup": new_signup,
+        "repeat_customer": repeat_customer,
+        "off_cycle": off_cycle,
+        "is_reset_box": is_reset_box,
+        "reset_total": reset_total,
+        "repeat_monthly": [snack.dict() for snack in repeat_monthly or []],
+    }
+    return "fp:" + hashlib.sha256(json.dumps(payload, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def idempotency_key_for(customerID, client_key):
+    """
+    Idempotency key from the client's Idempotency-Key header, scoped to the customer.
+    """
+    return f"key:{customerID}:{client_key}"
+
+
+class IdempotencyCache:
+    """
+    Recently built boxes by idempotency key, kept for `window` seconds (LRU beyond `max_size`).
+
+    Values are wrapped in a dict so an empty box (None) is still a hit.
+    """
+
+    def __init__(self, window=BOX_IDEMPOTENCY_WINDOW_SECONDS, max_size=BOX_IDEMPOTENCY_CACHE_MAX_SIZE):
+        self.window = window
+        self.max_size = max_size
+        self.entries = OrderedDict()  # key -> (expires_at, {"snacks": ...}, customerID)
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        expires_at, result, _ = entry
+        if expires_at <= time.monotonic():
+            del self.entries[key]
+            return None
+        self.entries.move_to_end(key)
+        return result
+
+    def put(self, key, snacks, customer_id):
+        if self.window <= 0 or self.max_size <= 0:
+            return
+        self.entries[key] = (time.monotonic() + self.window, {"snacks": snacks}, customer_id)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def forget_customer(self, customer_id):
+        """
+        Drop every box remembered for a customer (their profile changed, so a retry must build again).
+
+        Returns:
+            int: The number of entries dropped.
+        """
+        keys = [key for key, (_, _, entry_customer_id) in self.entries.items() if entry_customer_id == customer_id]
+        for key in keys:
+            del self.entries[key]
+        return len(keys)
+
+
+box_idempotency_cache = IdempotencyCache()
+
+
+async def forget_idempotent_builds(customerID, monthly_draft_box_collection):
+    """
+    Stop replaying a customer's recent builds: drop them from this worker's cache and unmark
+    the saved boxes, so no worker finds them in Mongo. Other workers' in-memory entries still
+    run out with their window.
+    """
+    box_idempotency_cache.forget_customer(customerID)
+    await monthly_draft_box_collection.update_many(
+        {"customerID": customerID, "idempotencyKey": {"$exists": True}},
+        {"$unset": {"idempotencyKey": ""}},
+    )
@@ -0,0 +1,243 @@
+import time
+import asyncio
+from bisect import bisect_left
+
+# Upper bounds (seconds) for latency histograms
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Upper bounds for size histograms (catalog positions, candidates, ...)
+SIZE_BUCKETS = (10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 25000, 50000)
+
+# Seconds between event loop lag samples
+EVENT_LOOP_LAG_INTERVAL_SECONDS = 0.5
+
+_registry = []
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(labelnames, labelvalues, extra=()):
+    pairs = list(zip(labelnames, labelvalues)) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    """
+    Base for in-process metrics rendered in the Prometheus text exposition format.
+    Metrics are only updated from the event loop thread, so no locking is needed.
+    """
+
+    type_name = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+        _registry.append(self)
+
+    def _key(self, labels):
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type_name}"]
+        for labelvalues, value in sorted(self.values.items()):
+            lines.append(f"{self.name}{_format_labels(self.labelnames, labelvalues)} {_format_value(value)}")
+        return lines
+
+
+class Counter(_Metric):
+    type_name = "counter"
+
+    def __init__(self, name, documentation, labelnames=()):
+        super().__init__(name, documentation, labelnames)
+        if not self.labelnames:
+            # Unlabelled counters are exported from zero
+            self.values[()] = 0
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    type_name = "gauge"
+
+    def set(self, value, **labels):
+        self.values[self._key(labels)] = value
+
+
+class Histogram(_Metric):
+    type_name = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+        self.observers = []
+
+    def add_observer(self, callback):
+        """
+        Also pass every observation to callback(value, labels), e.g. to keep raw samples for percentiles.
+        """
+        self.observers.append(callback)
+
+    def remove_observer(self, callback):
+        self.observers.remove(callback)
+
+    def observe(self, value, **labels):
+        for observer in self.observers:
+            observer(value, labels)
+        key = self._key(labels)
+        state = self.values.get(key)
+        if state is None:
+            # Per-bucket (non-cumulative) counts, the +Inf bucket last, then sum and count
+            state = self.values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        state[0][bisect_left(self.buckets, value)] += 1
+        state[1] += value
+        state[2] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type_name}"]
+        for labelvalues, (bucket_counts, total, count) in sorted(self.values.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), bucket_counts):
+                cumulative += bucket_count
+                labels = _format_labels(self.labelnames, labelvalues, [("le", _format_value(bound))])
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self.labelnames, labelvalues)
+            lines.append(f"{self.name}_sum{labels} {_format_value(total)}")
+            lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+
+def render_metrics():
+    """
+    All registered metrics in the Prometheus text exposition format.
+    """
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+# ============================================================================================ BOX BUILD METRICS
+
+BUILD_STAGE_SECONDS = Histogram(
+    "box_build_stage_seconds",
+    "Time spent in each stage of build_starting_box.",
+    ["stage"],
+)
+BUILD_SECONDS = Histogram(
+    "box_build_seconds",
+    "End-to-end time to build (and save) one box.",
+)
+CATALOG_SIZE = Gauge(
+    "snack_catalog_size",
+    "Number of snacks in the loaded catalog.",
+)
+CATALOG_LOADS = Counter(
+    "snack_catalog_loads_total",
+    "Snack catalog loads by source (mongo, file, or unchanged when a reload matched the current snapshot).",
+    ["source"],
+)
+SAFE_SNACKS = Histogram(
+    "box_build_safe_snacks",
+    "Snacks left for a customer after allergen, flavor, category and history filters.",
+    buckets=SIZE_BUCKETS,
+)
+CANDIDATES_SCANNED = Histogram(
+    "box_build_candidates_scanned",
+    "Candidate snacks examined by add_snacks_loop per box.",
+    buckets=SIZE_BUCKETS,
+)
+RELAXATION_TIERS = Counter(
+    "box_build_relaxation_tier_total",
+    "Snacks picked by add_snacks_loop per relaxation tier (1 = all criteria, 4 = secondary category only).",
+    ["tier"],
+)
+SECONDARY_CATEGORY_MISSES = Counter(
+    "box_build_secondary_category_miss_total",
+    "Secondary categories skipped by add_snacks_loop because nothing matched.",
+)
+EXTEND4_FALLBACKS = Counter(
+    "box_build_extend4_fallbacks_total",
+    "Boxes that needed the EXTEND 4 highest-score catch-all to fill up.",
+)
+COALESCED_BUILDS = Counter(
+    "single_flight_coalesced_total",
+    "Calls that joined an identical computation already in flight instead of running their own.",
+    ["flight"],
+)
+IDEMPOTENT_REPLAYS = Counter(
+    "box_build_idempotent_replays_total",
+    "Retried build requests answered with an already built box, by where it was found.",
+    ["source"],
+)
+REBUILDS = Counter(
+    "box_rebuilds_total",
+    "Rebuilds after a preference change, by mode (incremental or full) and reason.",
+    ["mode", "reason"],
+)
+DRAFT_BOX_WRITE_BATCH = Histogram(
+    "draft_box_write_batch_size",
+    "Draft boxes per write-behind insert_many.",
+    buckets=SIZE_BUCKETS,
+)
+CUSTOMER_PROFILE_CACHE_REQUESTS = Counter(
+    "customer_profile_cache_requests_total",
+    "Customer profile cache lookups by result (hit or miss).",
+    ["result"],
+)
+CUSTOMER_PROFILE_CACHE_SIZE = Gauge(
+    "customer_profile_cache_size",
+    "Customer profiles currently cached.",
+)
+EVENT_LOOP_LAG_SECONDS = Gauge(
+    "event_loop_lag_seconds",
+    "How late the event loop ran the most recent lag probe.",
+)
+
+
+class time_stage:
+    """
+    Context manager recording the wall time of a build stage in box_build_stage_seconds (and
+    in the build's BoxProfile, when it's profiled).
+    """
+
+    __slots__ = ("stage", "profile", "started")
+
+    def __init__(self, stage, profile=None):
+        self.stage = stage
+        self.profile = profile
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        seconds = time.perf_counter() - self.started
+        BUILD_STAGE_SECONDS.observe(seconds, stage=self.stage)
+        if self.profile is not None:
+            self.profile.record_stage(self.stage, seconds)
+        return False
+
+
+async def monitor_event_loop_lag(interval=EVENT_LOOP_LAG_INTERVAL_SECONDS):
+    """
+    Sleep for `interval` in a loop and record how late each wake-up is.
+    """
+    loop = asyncio.get_running_loop()
+    while True:
+        expected = loop.time() + interval
+        await asyncio.sleep(interval)
+        EVENT_LOOP_LAG_SECONDS.set(max(0.0, loop.time() - expected))
@@ -0,0 +1,36 @@
+import asyncio
+from admin.services.metrics_service import COALESCED_BUILDS
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls with the same key into one in-flight computation.
+
+    The first caller starts the work as a task; callers arriving while it runs await the same
+    task and get its result (or exception). The key is forgotten as soon as the task finishes,
+    so later calls run again. The work is shielded, so a cancelled caller doesn't cancel it
+    for the others.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.calls = {}
+
+    async def do(self, key, fn):
+        """
+        Args:
+            key (hashable): Calls with equal keys share one computation.
+            fn (callable): Zero-argument coroutine function doing the work.
+        """
+        task = self.calls.get(key)
+        if task is None:
+            task = asyncio.ensure_future(fn())
+            self.calls[key] = task
+            task.add_done_callback(lambda done, key=key: self._forget(key, done))
+        else:
+            COALESCED_BUILDS.inc(flight=self.name)
+        return await asyncio.shield(task)
+
+    def _forget(self, key, task):
+        if self.calls.get(key) is task:
+            del self.calls[key]
@@ -0,0 +1,148 @@
+from collections import defaultdict
+
+# Primary categories that always satisfy the protein and low-carb priority settings
+PRIORITY_FRUIT_CATEGORIES = ["Dried Fruit", "Fruit Gummies"]
+
+# Relaxation tiers tried in order by add_snacks_loop
+TIER_ALL_CRITERIA = 1       # least used form, brand and flavor tags
+TIER_WITHOUT_FLAVORS = 2    # least used form and brand
+TIER_WITHOUT_BRAND = 3      # least used form
+TIER_WITHOUT_FORM = 4       # secondary category only
+
+
+def meets_priority(snack, priority_setting):
+    """
+    Whether a snack fits the customer's priority setting (protein, low carb or low calorie).
+    """
+    return (
+        priority_setting == 0 or
+        (priority_setting == 1 and (
+            snack.protein > 7 or
+            snack.carbs < 10 or
+            snack.primary_category in PRIORITY_FRUIT_CATEGORIES
+        )) or
+        (priority_setting == 2 and (
+            snack.carbs < 10 or
+            snack.primary_category in PRIORITY_FRUIT_CATEGORIES
+        )) or
+        (priority_setting == 3 and snack.calories < 150)
+    )
+
+
+class UsageTracker:
+    """
+    Usage counts with the set of least used keys maintained incrementally.
+    """
+
+    def __init__(self, keys):
+        self.counts = {key: 0 for key in keys}
+        self.by_count = {0: set(self.counts)}
+        self.min_count = 0
+
+    def least_used(self):
+        """
+        The keys with the lowest count (empty when there are no keys). Do not mutate.
+        """
+        return self.by_count.get(self.min_count, set())
+
+    def increment(self, key):
+        count = self.counts.get(key)
+        if count is None:
+            count = self.counts[key] = 0
+            self.by_count.setdefault(0, set()).add(key)
+            self.min_count = 0
+        self.by_count[count].discard(key)
+        self.by_count.setdefault(count + 1, set()).add(key)
+        self.counts[key] = count + 1
+        if count == self.min_count and not self.by_count[count]:
+            self.min_count += 1
+
+
+class CategoryCandidates:
+    """
+    The snacks still available in one primary category, bucketed by secondaryCategory,
+    then form, then brand.
+
+    Each leaf is an insertion-ordered dict keyed by score rank, so the best candidate in
+    a leaf is its first eligible entry and removing a picked snack is O(1).
+    candidates_scanned counts the entries examined by find() for metrics.
+    """
+
+    def __init__(self, ranked_snacks, priority_setting):
+        """
+        Args:
+            ranked_snacks (list): (rank, SnackRecord) pairs for this category, best rank first.
+            priority_setting (int): The customer's prioritySetting.
+        """
+        self.buckets = defaultdict(lambda: defaultdict(lambda: defaultdict(dict)))
+        self.remaining = {}
+        self.eligible = {}
+        self.candidates_scanned = 0
+        for rank, snack in ranked_snacks:
+            self.buckets[snack.secondary_category][snack.form][snack.brand][rank] = snack
+            self.remaining[rank] = snack
+            self.eligible[rank] = (
+                snack.in_stock and
+                snack.active and
+                meets_priority(snack, priority_setting)
+            )
+
+    def __len__(self):
+        return len(self.remaining)
+
+    def __iter__(self):
+        return iter(self.remaining.values())
+
+    def find(self, secondary_category, secondary_category_increment, least_used_forms, least_used_brands, least_used_flavor_tags, previous_snack_ids):
+        """
+        Find the best ranked snack in a secondary category, relaxing flavor tags, then brand,
+        then form when nothing matches.
+
+        Returns:
+            (int, int, dict): (tier, rank, snack) of the pick, or (None, None, None).
+        """
+        forms = self.buckets.get(secondary_category)
+        if not forms:
+            return None, None, None
+
+        require_boost = secondary_category_increment < 10
+        require_new = secondary_category_increment < 12
+
+        best = {}
+        for form, brands in forms.items():
+            form_matches = form in least_used_forms
+            for brand, entries in brands.items():
+                brand_matches = form_matches and brand in least_used_brands
+                found_base = False
+                for rank, snack in entries.items():
+                    self.candidates_scanned += 1
+                    if not self.eligible[rank]:
+                        continue
+                    if require_boost and not snack.item_of_month_boost > 0:
+                        continue
+                    if require_new and snack.snack_id in previous_snack_ids:
+                        continue
+                    if not found_base:
+                        found_base = True
+                        tier = TIER_WITHOUT_FLAVORS if brand_matches else TIER_WITHOUT_BRAND if form_matches else TIER_WITHOUT_FORM
+                        if rank < best.get(tier, (rank + 1,))[0]:
+                            best[tier] = (rank, snack)
+                    if not brand_matches:
+                        break
+                    if all(tag in least_used_flavor_tags for tag in snack.flavor_tags):
+                        if rank < best.get(TIER_ALL_CRITERIA, (rank + 1,))[0]:
+                            best[TIER_ALL_CRITERIA] = (rank, snack)
+                        break
+
+        # A pick in a stricter tier also qualifies for every looser tier
+        for tier in (TIER_ALL_CRITERIA, TIER_WITHOUT_FLAVORS, TIER_WITHOUT_BRAND, TIER_WITHOUT_FORM):
+            candidates = [best[t] for t in best if t <= tier]
+            if candidates:
+                rank, snack = min(candidates, key=lambda candidate: candidate[0])
+                return tier, rank, snack
+        return None, None, None
+
+    def remove(self, rank):
+        snack = self.remaining.pop(rank)
+        self.buckets[snack.secondary_category][snack.form][snack.brand].pop(rank)
+        return snack
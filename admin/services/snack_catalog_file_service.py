@@ -0,0 +1,514 @@
+import os
+import sys
+import json
+import mmap
+import fcntl
+import time
+import struct
+import hashlib
+import traceback
+import numpy as np
+from operator import attrgetter
+from bson import json_util
+from admin.models.snack_record_model import SnackRecord
+from admin.services.snack_index_service import SnackAttributeIndex, INDEXED_FIELDS, INDEXED_FLAGS
+from admin.services.snack_scoring_service import SnackScoreTable, PRIORITY_BOOST_ATTRIBUTES
+
+# Directory for memory-mapped catalog snapshot files shared by every worker on the host
+# (empty disables them: each worker loads the catalog from Mongo)
+SNACK_CATALOG_SNAPSHOT_DIR = os.environ.get("SNACK_CATALOG_SNAPSHOT_DIR", "")
+
+# Without a change stream resume token, a snapshot file older than this is ignored on cold start
+SNACK_CATALOG_SNAPSHOT_MAX_AGE_SECONDS = float(os.environ.get("SNACK_CATALOG_SNAPSHOT_MAX_AGE_SECONDS", "60"))
+
+# Snapshot files kept per namespace; older ones are deleted unless pinned (see CatalogFilePin)
+SNACK_CATALOG_SNAPSHOT_KEEP = 3
+
+MAGIC = b"SNACKCAT"
+FORMAT_VERSION = 1
+
+# SnackRecord slots holding tuples (stored as offsets + value ids); every other slot is one value id
+TUPLE_SLOTS = ("flavor_tags", "allergens")
+
+# Value table tags
+_NONE, _FALSE, _TRUE, _INT, _FLOAT, _STR = range(6)
+
+_ALIGNMENT = 8
+
+
+class CatalogFileError(Exception):
+    """
+    A catalog snapshot file can't be written (unsupported values) or read (corrupt, wrong format).
+    """
+
+
+# ============================================================================================ WRITING
+
+class _ValueTable:
+    """
+    Interned table of every distinct scalar in the catalog. Columns store indexes into it.
+
+    Values are keyed by type as well, so True, 1 and 1.0 round-trip as themselves.
+    """
+
+    def __init__(self):
+        self.value_ids = {}
+        self.values = []
+
+    def ids(self, values):
+        """
+        Value ids for a sequence of values, adding new values to the table.
+        """
+        ids = self.value_ids
+        result = []
+        append = result.append
+        for value in values:
+            cls = value.__class__
+            # Floats are keyed by their bits, keeping -0.0 apart from 0.0
+            key = (cls, struct.pack("<d", value)) if cls is float else (cls, value)
+            try:
+                value_id = ids.get(key)
+            except TypeError:
+                raise CatalogFileError(f"Unsupported catalog value {value!r} ({cls.__name__})")
+            if value_id is None:
+                if not (value is None or isinstance(value, (bool, int, float, str))):
+                    raise CatalogFileError(f"Unsupported catalog value {value!r} ({cls.__name__})")
+                value_id = ids[key] = len(self.values)
+                self.values.append(value)
+            append(value_id)
+        return result
+
+    def arrays(self):
+        count = len(self.values)
+        tags = np.zeros(count, dtype="<u1")
+        ints = np.zeros(count, dtype="<i8")
+        floats = np.zeros(count, dtype="<f8")
+        string_offsets = np.zeros(count + 1, dtype="<u4")
+        strings = bytearray()
+        for value_id, value in enumerate(self.values):
+            if value is None:
+                tags[value_id] = _NONE
+            elif value is True or value is False:
+                tags[value_id] = _TRUE if value else _FALSE
+            elif isinstance(value, int):
+                if not -2 ** 63 <= value < 2 ** 63:
+                    raise CatalogFileError(f"Integer {value} doesn't fit in 64 bits")
+                tags[value_id] = _INT
+                ints[value_id] = value
+            elif isinstance(value, float):
+                tags[value_id] = _FLOAT
+                floats[value_id] = value
+            else:
+                tags[value_id] = _STR
+                strings += value.encode("utf-8", "surrogatepass")
+            string_offsets[value_id + 1] = len(strings)
+        return {
+            "values.tags": tags,
+            "values.ints": ints,
+            "values.floats": floats,
+            "values.string_offsets": string_offsets,
+            "values.strings": np.frombuffer(bytes(strings), dtype="<u1"),
+        }
+
+
+def _postings_arrays(name, postings):
+    """
+    value id -> positions as three arrays: value ids, offsets into positions, positions.
+    """
+    value_ids = list(postings)
+    offsets = np.zeros(len(value_ids) + 1, dtype="<u4")
+    offsets[1:] = np.cumsum([len(postings[value_id]) for value_id in value_ids], dtype=np.int64)
+    positions = [position for value_id in value_ids for position in postings[value_id]]
+    return {
+        f"{name}.values": np.array(value_ids, dtype="<u4"),
+        f"{name}.offsets": offsets,
+        f"{name}.positions": np.array(positions, dtype="<u4"),
+    }
+
+
+def encode_catalog(snacks):
+    """
+    Columnar encoding of a catalog: one value id column per SnackRecord slot (offsets + ids for
+    tuples), the score table, and the attribute index as posting lists.
+
+    Returns:
+        dict: Array name -> little-endian numpy array.
+    """
+    table = _ValueTable()
+    arrays = {}
+    slot_ids = {}  # slot -> value id per snack (a list of ids per snack for tuple slots)
+
+    for slot in SnackRecord.__slots__:
+        get = attrgetter(slot)
+        if slot in TUPLE_SLOTS:
+            lengths = [0]
+            items = []
+            for snack in snacks:
+                value = get(snack)
+                if not isinstance(value, tuple):
+                    raise CatalogFileError(f"SnackRecord.{slot} must be a tuple, got {type(value).__name__}")
+                items.extend(value)
+                lengths.append(len(value))
+            offsets = np.cumsum(lengths, dtype=np.int64)
+            ids = table.ids(items)
+            arrays[f"column.{slot}.offsets"] = offsets.astype("<u4")
+            arrays[f"column.{slot}.ids"] = np.array(ids, dtype="<u4")
+            offsets = offsets.tolist()
+            slot_ids[slot] = [ids[offsets[position]:offsets[position + 1]] for position in range(len(snacks))]
+        else:
+            ids = table.ids(map(get, snacks))
+            arrays[f"column.{slot}"] = np.array(ids, dtype="<u4")
+            slot_ids[slot] = ids
+
+    # Same rules as SnackAttributeIndex: None scalars aren't indexed, every tuple item is
+    none_id = table.value_ids.get((type(None), None))
+    for field, attribute in INDEXED_FIELDS.items():
+        postings = {}
+        if attribute in TUPLE_SLOTS:
+            for position, ids in enumerate(slot_ids[attribute]):
+                for value_id in ids:
+                    postings.setdefault(value_id, []).append(position)
+        else:
+            for position, value_id in enumerate(slot_ids[attribute]):
+                if value_id != none_id:
+                    postings.setdefault(value_id, []).append(position)
+        arrays.update(_postings_arrays(f"index.{field}", postings))
+    for flag, attribute in INDEXED_FLAGS.items():
+        arrays[f"flag.{flag}"] = np.array([position for position, snack in enumerate(snacks) if getattr(snack, attribute)], dtype="<u4")
+
+    arrays["scores"] = np.ascontiguousarray(SnackScoreTable(snacks).variants, dtype="<f8").reshape(-1)
+    arrays.update(table.arrays())
+    return arrays
+
+
+def _layout(arrays):
+    """
+    Body bytes with every array 8-byte aligned, and name -> [offset, dtype, length].
+    """
+    body = bytearray()
+    layout = {}
+    for name, array in arrays.items():
+        body += b"\0" * (-len(body) % _ALIGNMENT)
+        layout[name] = [len(body), array.dtype.str, int(array.size)]
+        body += array.tobytes()
+    return bytes(body), layout
+
+
+def _namespace_prefix(namespace):
+    return namespace.replace(os.sep, "_")
+
+
+def _pointer_path(directory, namespace):
+    return os.path.join(directory, f"{_namespace_prefix(namespace)}.current")
+
+
+def _write_atomically(path, chunks):
+    temporary_path = f"{path}.{os.getpid()}.tmp"
+    with open(temporary_path, "wb") as snapshot_file:
+        for chunk in chunks:
+            snapshot_file.write(chunk)
+        snapshot_file.flush()
+        os.fsync(snapshot_file.fileno())
+    os.replace(temporary_path, path)
+
+
+def write_catalog_file(directory, namespace, snacks, version, resume_token=None, prune=True, make_current=True):
+    """
+    Write a catalog snapshot file and (by default) make it the current one for `namespace`.
+
+    Files are named after a hash of their content, so a worker that reloads an unchanged
+    catalog (or one another worker already wrote) reuses the existing file.
+
+    Args:
+        directory (str): Snapshot directory.
+        namespace (str): The snacks collection's full name.
+        snacks (List[SnackRecord]): The catalog in natural order.
+        version (int): Catalog version recorded in the file.
+        resume_token (dict): Change stream resume token the catalog is current as of.
+        prune (bool): Remove all but the SNACK_CATALOG_SNAPSHOT_KEEP newest files of `namespace`.
+        make_current (bool): Point `namespace`'s current file at it. Off for copies written
+            elsewhere (build captures), which must not move the pointer cold starts load from.
+
+    Returns:
+        str: Path of the snapshot file.
+    """
+    body, layout = _layout(encode_catalog(snacks))
+    fingerprint = hashlib.sha256(body).hexdigest()
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, f"{_namespace_prefix(namespace)}.{fingerprint[:16]}.catalog")
+
+    if os.path.exists(path):
+        # Already written (unchanged catalog, or by another worker): mark it as current as of now
+        if make_current:
+            os.utime(path)
+    else:
+        header = json.dumps({
+            "format_version": FORMAT_VERSION,
+            "namespace": namespace,
+            "version": version,
+            "count": len(snacks),
+            "fingerprint": fingerprint,
+            "written_at": time.time(),
+            "resume_token": json_util.dumps(resume_token) if resume_token is not None else None,
+            "arrays": layout,
+        }).encode()
+        header += b" " * (-(len(MAGIC) + 4 + len(header)) % _ALIGNMENT)
+        _write_atomically(path, [MAGIC, struct.pack("<I", len(header)), header, body])
+
+    if make_current:
+        _write_atomically(_pointer_path(directory, namespace), [os.path.basename(path).encode()])
+    if prune:
+        _remove_old_catalog_files(directory, namespace, keep=path)
+    return path
+
+
+def _catalog_files(directory, namespace):
+    prefix = f"{_namespace_prefix(namespace)}."
+    return [
+        os.path.join(directory, name)
+        for name in os.listdir(directory)
+        if name.startswith(prefix) and name.endswith(".catalog")
+    ]
+
+
+def _remove_old_catalog_files(directory, namespace, keep):
+    paths = sorted(_catalog_files(directory, namespace), key=_modified_time, reverse=True)
+    for path in paths[SNACK_CATALOG_SNAPSHOT_KEEP:]:
+        if path != keep:
+            _remove_unpinned(path)
+
+
+def _modified_time(path):
+    # Another worker may be pruning the same directory
+    try:
+        return os.path.getmtime(path)
+    except FileNotFoundError:
+        return 0.0
+
+
+def _remove_unpinned(path):
+    """
+    Delete a snapshot file unless a process holds a CatalogFilePin on it.
+    """
+    try:
+        with open(path, "rb") as snapshot_file:
+            try:
+                fcntl.flock(snapshot_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return
+            os.remove(path)
+    except OSError:
+        pass
+
+
+class CatalogFilePin:
+    """
+    Keeps a snapshot file from being pruned, by any process, while it's held: a shared flock
+    that _remove_old_catalog_files can't take an exclusive lock over.
+
+    Held by every mapped CatalogFile and by each selection pool until its workers have exited,
+    since a worker the pool spawns later maps the file by path.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, "rb")
+        try:
+            fcntl.flock(self._file.fileno(), fcntl.LOCK_SH)
+            # Pruned between open() and flock(): the path no longer leads to this file
+            if os.stat(path).st_ino != os.fstat(self._file.fileno()).st_ino:
+                raise FileNotFoundError(f"{path} was removed")
+        except BaseException:
+            self._file.close()
+            raise
+
+    def fileno(self):
+        return self._file.fileno()
+
+    def release(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+def remove_catalog_files(directory, namespace):
+    """
+    Delete every snapshot file for `namespace`, so the next cold start loads from Mongo.
+    """
+    if not os.path.isdir(directory):
+        return
+    for path in _catalog_files(directory, namespace) + [_pointer_path(directory, namespace)]:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+# ============================================================================================ READING
+
+class MappedSnackRecords:
+    """
+    Read-only sequence of SnackRecords backed by the columns of a mapped snapshot file.
+
+    A record is built the first time its position is read and cached, so opening a snapshot
+    doesn't materialize the whole catalog.
+    """
+
+    def __init__(self, values, columns, tuple_columns, size):
+        self.values = values
+        self.columns = columns
+        self.tuple_columns = tuple_columns
+        self.size = size
+        self._records = [None] * size
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, position):
+        record = self._records[position]
+        if record is None:
+            if position < 0:
+                position += self.size
+            values = self.values
+            fields = []
+            for slot in SnackRecord.__slots__:
+                if slot in self.tuple_columns:
+                    offsets, ids = self.tuple_columns[slot]
+                    fields.append(tuple(values[value_id] for value_id in ids[offsets[position]:offsets[position + 1]].tolist()))
+                else:
+                    fields.append(values[self.columns[slot][position]])
+            record = self._records[position] = SnackRecord(*fields)
+        return record
+
+    def __iter__(self):
+        for position in range(self.size):
+            yield self[position]
+
+    def __reduce__(self):
+        # Pickled (e.g. for a selection worker without the file) as a plain list
+        return (list, (list(self),))
+
+
+class CatalogFile:
+    """
+    An open, memory-mapped catalog snapshot file.
+
+    Columns, posting lists and scores are numpy views on the read-only mapping, so every
+    process mapping the same file shares those pages. The value table and index bitsets are
+    decoded per process.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.pin = CatalogFilePin(path)
+        try:
+            self._mmap = mmap.mmap(self.pin.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError as e:
+            self.pin.release()
+            raise CatalogFileError(f"{path} is empty") from e
+
+        try:
+            self._load()
+        except Exception as e:
+            # Don't leave a corrupt file mapped and pinned, where pruning can never remove it
+            traceback.clear_frames(e.__traceback__)
+            self._close()
+            raise
+
+    def _load(self):
+        path = self.path
+        if self._mmap[:len(MAGIC)] != MAGIC:
+            raise CatalogFileError(f"{path} is not a catalog snapshot file")
+        header_length, = struct.unpack_from("<I", self._mmap, len(MAGIC))
+        body_offset = len(MAGIC) + 4 + header_length
+        try:
+            header = json.loads(self._mmap[len(MAGIC) + 4:body_offset])
+        except ValueError as e:
+            raise CatalogFileError(f"{path} has a corrupt header") from e
+        if header.get("format_version") != FORMAT_VERSION:
+            raise CatalogFileError(f"{path} has format version {header.get('format_version')}, expected {FORMAT_VERSION}")
+
+        self.namespace = header["namespace"]
+        self.version = header["version"]
+        self.size = header["count"]
+        self.fingerprint = header["fingerprint"]
+        self.written_at = header["written_at"]
+        self.resume_token = json_util.loads(header["resume_token"]) if header["resume_token"] else None
+
+        self.arrays = {}
+        for name, (offset, dtype, length) in header["arrays"].items():
+            if body_offset + offset + np.dtype(dtype).itemsize * length > len(self._mmap):
+                raise CatalogFileError(f"{path} is truncated")
+            self.arrays[name] = np.frombuffer(self._mmap, dtype=dtype, count=length, offset=body_offset + offset)
+
+        self.values = self._decode_values()
+        self.snacks = MappedSnackRecords(
+            self.values,
+            {slot: self.arrays[f"column.{slot}"] for slot in SnackRecord.__slots__ if slot not in TUPLE_SLOTS},
+            {slot: (self.arrays[f"column.{slot}.offsets"], self.arrays[f"column.{slot}.ids"]) for slot in TUPLE_SLOTS},
+            self.size,
+        )
+        self.index = self._decode_index()
+        self.scores = SnackScoreTable.from_variants(self.arrays["scores"].reshape(len(PRIORITY_BOOST_ATTRIBUTES) + 1, self.size))
+
+    def _close(self):
+        # The numpy views must go before the mapping can be closed
+        self.arrays = self.values = self.snacks = self.index = self.scores = None
+        try:
+            self._mmap.close()
+        except BufferError:
+            pass  # Still referenced; unmapped when the last view is collected
+        self.pin.release()
+
+    def _decode_values(self):
+        tags = self.arrays["values.tags"].tolist()
+        ints = self.arrays["values.ints"]
+        floats = self.arrays["values.floats"]
+        offsets = self.arrays["values.string_offsets"].tolist()
+        strings = self.arrays["values.strings"].tobytes()
+        values = []
+        for value_id, tag in enumerate(tags):
+            if tag == _STR:
+                values.append(sys.intern(strings[offsets[value_id]:offsets[value_id + 1]].decode("utf-8", "surrogatepass")))
+            elif tag == _INT:
+                values.append(int(ints[value_id]))
+            elif tag == _FLOAT:
+                values.append(float(floats[value_id]))
+            else:
+                values.append({_NONE: None, _FALSE: False, _TRUE: True}[tag])
+        return values
+
+    def _decode_postings(self, name):
+        value_ids = self.arrays[f"{name}.values"].tolist()
+        offsets = self.arrays[f"{name}.offsets"].tolist()
+        positions = self.arrays[f"{name}.positions"]
+        return [
+            (self.values[value_id], positions[offsets[i]:offsets[i + 1]].tolist())
+            for i, value_id in enumerate(value_ids)
+        ]
+
+    def _decode_index(self):
+        snack_positions = {}
+        for position, value_id in enumerate(self.arrays["column.snack_id"].tolist()):
+            snack_id = self.values[value_id]
+            if snack_id is not None:
+                snack_positions.setdefault(snack_id, []).append(position)
+        return SnackAttributeIndex.from_postings(
+            self.size,
+            snack_positions,
+            {field: self._decode_postings(f"index.{field}") for field in INDEXED_FIELDS},
+            {flag: self.arrays[f"flag.{flag}"].tolist() for flag in INDEXED_FLAGS},
+        )
+
+
+def current_catalog_file(directory, namespace):
+    """
+    Path of the current snapshot file for `namespace`, or None if there isn't one.
+    """
+    try:
+        with open(_pointer_path(directory, namespace)) as pointer_file:
+            name = pointer_file.read().strip()
+    except FileNotFoundError:
+        return None
+    path = os.path.join(directory, name)
+    return path if name and os.path.exists(path) else None
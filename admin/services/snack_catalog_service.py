@@ -0,0 +1,312 @@
+import os
+import time
+import asyncio
+from pymongo.errors import OperationFailure
+from admin.models.snack_record_model import SnackRecord
+from admin.config.logging_config import get_stage_logger
+from admin.services.metrics_service import time_stage, CATALOG_SIZE, CATALOG_LOADS
+from admin.services.snack_index_service import SnackAttributeIndex
+from admin.services.flavor_stem_service import FlavorStemIndex
+from admin.services.snack_scoring_service import SnackScoreTable
+from admin.services.snack_catalog_file_service import (
+    CatalogFile,
+    CatalogFileError,
+    current_catalog_file,
+    write_catalog_file,
+    SNACK_CATALOG_SNAPSHOT_DIR,
+    SNACK_CATALOG_SNAPSHOT_MAX_AGE_SECONDS,
+)
+
+# Mongo used to return at most this many snacks per query (to_list(length=500))
+SNACK_QUERY_LIMIT = 500
+
+# Seconds between full reloads when change streams are unavailable (standalone servers)
+CATALOG_POLL_INTERVAL_SECONDS = float(os.environ.get("SNACK_CATALOG_POLL_INTERVAL_SECONDS", "60"))
+
+# Seconds to wait after a change event so a burst of edits triggers a single reload
+CATALOG_CHANGE_DEBOUNCE_SECONDS = float(os.environ.get("SNACK_CATALOG_CHANGE_DEBOUNCE_SECONDS", "1"))
+
+catalog_log = get_stage_logger("catalog")
+
+
+class CatalogSnapshot:
+    """
+    One immutable load of the snacks collection as SnackRecords, with its filter index, flavor stem
+    index and score table.
+
+    A request works against a single snapshot, so a reload mid-request can't mix catalog versions.
+    """
+
+    def __init__(self, snacks, version, index=None, scores=None, path=None, resume_token=None, pin=None):
+        """
+        Args:
+            snacks (List[SnackRecord]): The catalog in natural order.
+            version (int): Catalog version, bumped on every load.
+            index (SnackAttributeIndex): Prebuilt index (built from snacks when omitted).
+            scores (SnackScoreTable): Prebuilt score table (built from snacks when omitted).
+            path (str): Snapshot file the catalog is mapped from, if any.
+            resume_token (dict): Change stream resume token the catalog is current as of, if known.
+            pin (CatalogFilePin): Keeps the snapshot file from being pruned while the snapshot is in use.
+        """
+        self.snacks = snacks
+        self.version = version
+        self.index = index if index is not None else SnackAttributeIndex(snacks)
+        self.flavor_stems = FlavorStemIndex(self.index.values["flavorTags"])
+        self.scores = scores if scores is not None else SnackScoreTable(snacks)
+        self.path = path
+        self.resume_token = resume_token
+        self.pin = pin
+
+    @classmethod
+    def from_file(cls, path, version=None):
+        """
+        Map a catalog snapshot file (see snack_catalog_file_service).
+
+        Args:
+            path (str): The snapshot file.
+            version (int): Version to publish it as (defaults to the version recorded in the file).
+        """
+        catalog_file = CatalogFile(path)
+        return cls(
+            catalog_file.snacks,
+            catalog_file.version if version is None else version,
+            index=catalog_file.index,
+            scores=catalog_file.scores,
+            path=path,
+            resume_token=catalog_file.resume_token,
+            pin=catalog_file.pin,
+        )
+
+    def filter_positions(self, allergens=None, vetoed_flavors=None, disliked_categories=None, off_cycle=False, excluded_snack_ids=None):
+        """
+        Apply the customer filters that used to be sent to Mongo as a find() query.
+
+        Args:
+            allergens (list): Snacks containing any of these allergens are excluded.
+            vetoed_flavors (list): Snacks tagged with any inflection of these flavors are excluded.
+            disliked_categories (list): Snacks in any of these primary categories are excluded.
+            off_cycle (bool): When True, only snacks that are in stock or approved are kept.
+            excluded_snack_ids (set): SnackIDs to exclude.
+
+        Returns:
+            List[int]: Positions of matching snacks in catalog order, capped at SNACK_QUERY_LIMIT.
+        """
+        index = self.index
+
+        safe = index.all_bits & ~index.flag("replacementOnly")
+        if excluded_snack_ids:
+            safe &= ~index.snack_ids(excluded_snack_ids)
+        if allergens:
+            safe &= ~index.any_of("allergens", allergens)
+        if vetoed_flavors:
+            safe &= ~self.flavor_stems.vetoed(vetoed_flavors)
+        if disliked_categories:
+            safe &= ~index.any_of("primaryCategory", disliked_categories)
+        if off_cycle:
+            safe &= index.flag("inStock") | index.flag("approved")
+
+        return index.positions(safe, limit=SNACK_QUERY_LIMIT)
+
+    def snack_ids_with_allergens(self, snack_ids, allergens):
+        """
+        The given SnackIDs whose snacks contain any of `allergens`.
+        """
+        bits = self.index.snack_ids(snack_ids) & self.index.any_of("allergens", allergens)
+        return {self.snacks[position].snack_id for position in self.index.positions(bits)}
+
+    def rank_positions(self, positions, priority_setting, previous_snack_ids):
+        """
+        Order positions by score (highest first), penalizing snacks in previous_snack_ids.
+        """
+        penalized_positions = [
+            position
+            for snack_id in previous_snack_ids or []
+            for position in self.index.snack_positions.get(snack_id, ())
+        ]
+        return self.scores.rank(positions, priority_setting, penalized_positions)
+
+
+class SnackCatalog:
+    """
+    Process-wide, versioned copy of the snacks collection.
+
+    The full catalog is loaded once, kept fresh by a change stream on the collection
+    (falling back to polling when change streams are unavailable), and published as a new
+    CatalogSnapshot on every load. Snacks are held as immutable SnackRecords, so they are
+    shared between requests without copying.
+
+    With SNACK_CATALOG_SNAPSHOT_DIR set, every load is also written to a snapshot file that
+    the catalog then maps, and a worker starting up maps the current file instead of scanning
+    the collection. Workers on one host share the file's pages. A file written while a change
+    stream was open carries its resume token, so the new worker resumes the stream from there
+    and misses no changes; files without one are only used while younger than
+    SNACK_CATALOG_SNAPSHOT_MAX_AGE_SECONDS.
+    """
+
+    def __init__(self, collection):
+        self.collection = collection
+        self.snapshot = CatalogSnapshot([], 0)
+        self._load_lock = asyncio.Lock()
+        self._watch_task = None
+
+    async def ensure_loaded(self):
+        """
+        Load the catalog on first use and start watching the collection for changes.
+        """
+        if self.version:
+            return
+        async with self._load_lock:
+            if self.version:
+                return
+            if not self._load_snapshot_file():
+                await self.refresh()
+            self.start_watching()
+
+    def _load_snapshot_file(self):
+        """
+        Cold start from the current snapshot file, if there is a usable one.
+
+        Returns:
+            bool: Whether the catalog was loaded from a file.
+        """
+        if not SNACK_CATALOG_SNAPSHOT_DIR:
+            return False
+        path = current_catalog_file(SNACK_CATALOG_SNAPSHOT_DIR, self.collection.full_name)
+        if path is None:
+            return False
+        with time_stage("catalog_load"):
+            try:
+                snapshot = CatalogSnapshot.from_file(path)
+            except (CatalogFileError, OSError) as e:
+                catalog_log.warning("Could not map snack catalog snapshot %s: %s", path, e)
+                return False
+        age = time.time() - os.path.getmtime(path)
+        if snapshot.resume_token is None and age > SNACK_CATALOG_SNAPSHOT_MAX_AGE_SECONDS:
+            catalog_log.info("Snack catalog snapshot %s is %.0fs old; loading from Mongo instead", path, age)
+            return False
+
+        self.snapshot = snapshot
+        CATALOG_SIZE.set(len(snapshot.snacks))
+        CATALOG_LOADS.inc(source="file")
+        catalog_log.info("Snack catalog mapped from %s: version %s, %s snacks", path, self.version, len(snapshot.snacks))
+        return True
+
+    async def refresh(self, resume_token=None):
+        """
+        Reload the full catalog in natural order and bump the version.
+
+        Args:
+            resume_token (dict): Change stream resume token the reload is current as of.
+        """
+        with time_stage("catalog_load"):
+            documents = await self.collection.find({}).to_list(length=None)
+            snacks = [SnackRecord.from_document(document) for document in documents]
+            if SNACK_CATALOG_SNAPSHOT_DIR:
+                # Encoding, fsync and mapping take a while for a large catalog
+                snapshot = await asyncio.to_thread(self._write_snapshot_file, snacks, resume_token)
+            else:
+                snapshot = None
+            if snapshot is self.snapshot:
+                # Same content as the mapped file: keep the version (and the selection pool)
+                CATALOG_LOADS.inc(source="unchanged")
+                catalog_log.debug("Snack catalog unchanged: version %s", self.version)
+                return
+            self.snapshot = snapshot or CatalogSnapshot(snacks, self.version + 1)
+        CATALOG_SIZE.set(len(snacks))
+        CATALOG_LOADS.inc(source="mongo")
+        catalog_log.info("Snack catalog loaded: version %s, %s snacks", self.version, len(snacks))
+
+    def _write_snapshot_file(self, snacks, resume_token):
+        """
+        Write the reloaded catalog to a snapshot file and map it (blocking: runs in a thread).
+
+        Returns:
+            CatalogSnapshot: The mapped snapshot (the current one if the content hasn't changed),
+            or None if the file couldn't be written or mapped.
+        """
+        try:
+            path = write_catalog_file(SNACK_CATALOG_SNAPSHOT_DIR, self.collection.full_name, snacks, self.version + 1, resume_token)
+            if path == self.snapshot.path:
+                return self.snapshot
+            return CatalogSnapshot.from_file(path, version=self.version + 1)
+        except (CatalogFileError, OSError) as e:
+            catalog_log.warning("Could not write the snack catalog snapshot file: %s", e)
+            return None
+
+    @property
+    def version(self):
+        return self.snapshot.version
+
+    def start_watching(self):
+        if self._watch_task is None or self._watch_task.done():
+            self._watch_task = asyncio.create_task(self._watch())
+
+    async def stop_watching(self):
+        if self._watch_task is not None:
+            self._watch_task.cancel()
+            try:
+                await self._watch_task
+            except asyncio.CancelledError:
+                pass
+            self._watch_task = None
+
+    async def _watch(self):
+        resume_token = self.snapshot.resume_token
+        try:
+            try:
+                await self._follow_changes(resume_token)
+            except OperationFailure as e:
+                if resume_token is None:
+                    raise
+                # Most likely the token has rolled off the oplog
+                catalog_log.warning("Could not resume the snack catalog change stream from the snapshot file (%s). Reloading.", e)
+                await self._follow_changes(None)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            catalog_log.warning("Snack catalog change stream unavailable (%s). Polling every %ss instead.", e, CATALOG_POLL_INTERVAL_SECONDS)
+            await self._poll()
+
+    async def _follow_changes(self, resume_token):
+        async with self.collection.watch(resume_after=resume_token) as stream:
+            if resume_token is None:
+                # Pick up anything that changed between the initial load and opening the stream
+                await self.refresh(stream.resume_token)
+            async for _change in stream:
+                await asyncio.sleep(CATALOG_CHANGE_DEBOUNCE_SECONDS)
+                # Drain the rest of the burst without blocking
+                while await stream.try_next() is not None:
+                    pass
+                await self.refresh(stream.resume_token)
+
+    async def _poll(self):
+        while True:
+            await asyncio.sleep(CATALOG_POLL_INTERVAL_SECONDS)
+            try:
+                await self.refresh()
+            except Exception as e:
+                catalog_log.error("An error occurred while refreshing the snack catalog: %s", e)
+
+
+# One catalog per snacks collection namespace
+_catalogs = {}
+
+
+async def get_snack_catalog(all_snacks_collection):
+    """
+    Return the loaded, process-wide catalog for the given snacks collection.
+    """
+    catalog = _catalogs.get(all_snacks_collection.full_name)
+    if catalog is None:
+        catalog = SnackCatalog(all_snacks_collection)
+        _catalogs[all_snacks_collection.full_name] = catalog
+    await catalog.ensure_loaded()
+    return catalog
+
+
+async def stop_snack_catalog_watchers():
+    """
+    Stop every catalog's change stream watcher (before the Mongo client is closed).
+    """
+    for catalog in _catalogs.values():
+        await catalog.stop_watching()
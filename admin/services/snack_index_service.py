@@ -0,0 +1,139 @@
+from collections import defaultdict
+
+# Snack fields with a bitset per value, mapped to their SnackRecord attribute
+# (tuple-valued attributes index each element)
+INDEXED_FIELDS = {
+    "allergens": "allergens",
+    "flavorTags": "flavor_tags",
+    "primaryCategory": "primary_category",
+    "secondaryCategory": "secondary_category",
+    "brand": "brand",
+    "form": "form",
+}
+
+# Boolean fields with a bitset of the snacks where they are True
+INDEXED_FLAGS = {
+    "replacementOnly": "replacement_only",
+    "inStock": "in_stock",
+    "approved": "approved",
+    "active": "active",
+}
+
+
+def bitset_from_positions(positions, size):
+    """
+    Build an int bitset with the given catalog positions set, in O(size / 8).
+    """
+    bitmap = bytearray((size + 7) // 8)
+    for position in positions:
+        bitmap[position >> 3] |= 1 << (position & 7)
+    return int.from_bytes(bitmap, "little")
+
+
+class SnackAttributeIndex:
+    """
+    Inverted index from snack attribute values to bitsets of catalog positions.
+
+    Bit i of every bitset refers to snacks[i], so a customer's safe set is a few bitwise
+    AND-NOT operations over Python ints and iterating its set bits keeps catalog order.
+    SnackIDs are unique, so they map to positions instead of one bitset each.
+    """
+
+    def __init__(self, snacks):
+        """
+        Args:
+            snacks (List[SnackRecord]): The catalog, in catalog order.
+        """
+        self.size = len(snacks)
+        self.all_bits = (1 << self.size) - 1
+        self.snack_positions = defaultdict(list)
+
+        field_positions = {field: defaultdict(list) for field in INDEXED_FIELDS}
+        flag_positions = {flag: [] for flag in INDEXED_FLAGS}
+
+        for position, snack in enumerate(snacks):
+            if snack.snack_id is not None:
+                self.snack_positions[snack.snack_id].append(position)
+            for field, attribute in INDEXED_FIELDS.items():
+                value = getattr(snack, attribute)
+                if value is None:
+                    continue
+                if isinstance(value, tuple):
+                    for item in value:
+                        field_positions[field][item].append(position)
+                else:
+                    field_positions[field][value].append(position)
+            for flag, attribute in INDEXED_FLAGS.items():
+                if getattr(snack, attribute):
+                    flag_positions[flag].append(position)
+
+        self.snack_positions = dict(self.snack_positions)
+        self.values = {
+            field: {value: bitset_from_positions(positions, self.size) for value, positions in by_value.items()}
+            for field, by_value in field_positions.items()
+        }
+        self.flags = {flag: bitset_from_positions(positions, self.size) for flag, positions in flag_positions.items()}
+
+    @classmethod
+    def from_postings(cls, size, snack_positions, field_postings, flag_positions):
+        """
+        Rebuild an index from posting lists instead of SnackRecords (e.g. from a catalog snapshot file).
+
+        Args:
+            size (int): Number of snacks in the catalog.
+            snack_positions (dict): SnackID -> catalog positions.
+            field_postings (dict): Indexed field -> list of (value, ascending positions).
+            flag_positions (dict): Indexed flag -> positions where it is True.
+        """
+        index = cls.__new__(cls)
+        index.size = size
+        index.all_bits = (1 << size) - 1
+        index.snack_positions = snack_positions
+        index.values = {field: {} for field in INDEXED_FIELDS}
+        for field, postings in field_postings.items():
+            field_bits = index.values[field]
+            for value, positions in postings:
+                # Values that compare equal (True and 1) share a bitset, as in __init__
+                field_bits[value] = field_bits.get(value, 0) | bitset_from_positions(positions, size)
+        index.flags = {flag: bitset_from_positions(flag_positions.get(flag, ()), size) for flag in INDEXED_FLAGS}
+        return index
+
+    def any_of(self, field, values):
+        """
+        Bitset of snacks whose `field` equals (or, for list fields, contains) any of `values`.
+        """
+        field_bits = self.values[field]
+        bits = 0
+        for value in values:
+            bits |= field_bits.get(value, 0)
+        return bits
+
+    def snack_ids(self, snack_ids):
+        """
+        Bitset of snacks with any of the given SnackIDs.
+        """
+        positions = []
+        for snack_id in snack_ids:
+            positions.extend(self.snack_positions.get(snack_id, ()))
+        return bitset_from_positions(positions, self.size) if positions else 0
+
+    def flag(self, flag):
+        return self.flags[flag]
+
+    def positions(self, bits, limit=None):
+        """
+        Catalog positions of the set bits in ascending order, stopping after `limit`.
+        """
+        positions = []
+        if not bits:
+            return positions
+        for byte_index, byte in enumerate(bits.to_bytes((self.size + 7) // 8, "little")):
+            if not byte:
+                continue
+            base = byte_index << 3
+            for bit in range(8):
+                if byte >> bit & 1:
+                    positions.append(base + bit)
+                    if limit is not None and len(positions) >= limit:
+                        return positions
+        return positions
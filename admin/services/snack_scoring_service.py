@@ -0,0 +1,65 @@
+import numpy as np
+
+# Score variant per prioritySetting; any other value scores on totalScore alone
+PRIORITY_VARIANTS = {0: 0, 1: 1, 2: 2, 3: 3}
+
+# Boost added to totalScore for each variant (variant 0 has no boost)
+PRIORITY_BOOST_ATTRIBUTES = ["high_protein_boost", "low_carb_boost", "low_calorie_boost"]
+
+# Subtracted from the score of snacks the customer has received before
+REPEAT_PENALTY = 50
+
+
+def _score_column(snacks, attribute):
+    return np.fromiter((getattr(snack, attribute) for snack in snacks), dtype=np.float64, count=len(snacks))
+
+
+class SnackScoreTable:
+    """
+    Column-oriented scores for every snack in a catalog.
+
+    All four priority variants are computed in one vectorized pass when the catalog loads,
+    so ranking a customer's safe snacks is a gather, a penalty mask and a stable argsort.
+    """
+
+    def __init__(self, snacks):
+        self.size = len(snacks)
+        total_score = _score_column(snacks, "total_score")
+        boosts = np.vstack([_score_column(snacks, attribute) for attribute in PRIORITY_BOOST_ATTRIBUTES]) if snacks else np.zeros((3, 0))
+        # Row 0: totalScore, rows 1-3: totalScore + protein / low-carb / low-calorie boost
+        self.variants = np.vstack([total_score, total_score + boosts])
+
+    @classmethod
+    def from_variants(cls, variants):
+        """
+        Wrap precomputed score variants (e.g. a read-only view on a catalog snapshot file).
+        """
+        table = cls.__new__(cls)
+        table.size = variants.shape[1]
+        table.variants = variants
+        return table
+
+    def rank(self, positions, priority_setting, penalized_positions=()):
+        """
+        Order catalog positions by score, highest first.
+
+        Matches sorted(..., key=get_score, reverse=True): ties keep their input order.
+
+        Args:
+            positions (list): Catalog positions to rank.
+            priority_setting (int): The customer's prioritySetting (0-3, anything else means no boost).
+            penalized_positions (iterable): Catalog positions of previously received snacks.
+
+        Returns:
+            List[int]: The ranked positions.
+        """
+        positions = np.asarray(positions, dtype=np.intp)
+        variant = PRIORITY_VARIANTS.get(priority_setting, 0)
+        scores = self.variants[variant, positions]
+
+        penalized_positions = np.fromiter(penalized_positions, dtype=np.intp)
+        if penalized_positions.size:
+            scores = scores - REPEAT_PENALTY * np.isin(positions, penalized_positions)
+
+        order = np.argsort(-scores, kind="stable")
+        return positions[order].tolist()
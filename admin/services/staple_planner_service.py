@@ -0,0 +1,112 @@
+from functools import lru_cache
+from admin.config.logging_config import get_stage_logger
+
+# Staple preferences a customer can pick per category
+STAPLE_VALUES = ("many", "a few", "one")
+
+# Categories a box is planned over (staples + dislikes can't exceed this)
+TOTAL_CATEGORIES = 10
+
+# Maximum number of (counts, box size) plans kept by the memoized planner
+STAPLE_PLAN_CACHE_SIZE = 16384
+
+# Quantity tiers, tried in order: the first whose total fits under the adjusted box size wins.
+# Each row is ((many, a few, one) base quantities, value topped up with the remainder, its cap).
+STAPLE_TIERS = (
+    ((2, 1, 1), "a few", 2),
+    ((2, 2, 1), "many", 3),
+    ((3, 2, 1), "many", 4),
+    ((4, 2, 1), "many", 5),
+    ((5, 2, 1), "a few", 3),
+    ((5, 3, 1), "many", 6),
+)
+
+staples_log = get_stage_logger("staples")
+
+
+@lru_cache(maxsize=STAPLE_PLAN_CACHE_SIZE)
+def plan_value_mapping(many_count, few_count, one_count, adjusted_subscription_type):
+    """
+    Quantity per staple value for a box, given how many staples have each value.
+
+    Args:
+        many_count (int): Staples marked "many".
+        few_count (int): Staples marked "a few".
+        one_count (int): Staples marked "one".
+        adjusted_subscription_type (int): Box size left after repeat monthly snacks.
+
+    Returns:
+        Tuple[int, int, int]: Quantities for "many", "a few" and "one".
+    """
+    counts = {"many": many_count, "a few": few_count, "one": one_count}
+
+    for base, topped_up_value, cap in STAPLE_TIERS:
+        total = many_count * base[0] + few_count * base[1] + one_count * base[2]
+        if total < adjusted_subscription_type:
+            value_mapping = dict(zip(STAPLE_VALUES, base))
+            remaining = adjusted_subscription_type - total
+            if remaining > 0 and counts[topped_up_value] > 0:
+                value_mapping[topped_up_value] = min(cap, value_mapping[topped_up_value] + remaining // counts[topped_up_value])
+            return tuple(value_mapping[value] for value in STAPLE_VALUES)
+
+    # Nothing fits: one of each, unless even that overflows the box
+    value_mapping = {"many": 1, "a few": 1, "one": 1}
+    if many_count + few_count + one_count > adjusted_subscription_type:
+        if many_count > 0:
+            value_mapping["many"] = max(4, (adjusted_subscription_type - few_count * 3 - one_count * 1) // many_count)
+        elif few_count > 0:
+            value_mapping["a few"] = max(2, (adjusted_subscription_type - many_count * 5 - one_count * 1) // few_count)
+    return tuple(value_mapping[value] for value in STAPLE_VALUES)
+
+
+def plan_staples(staples, subscription_type, category_dislikes, adjusted_subscription_type):
+    """
+    Number of snacks to pick for each staple category.
+
+    Args:
+        staples (dict): Primary category -> "many", "a few" or "one".
+        subscription_type (int): Box size.
+        category_dislikes (list): Disliked primary categories.
+        adjusted_subscription_type (int): Box size left after repeat monthly snacks.
+
+    Returns:
+        dict: Primary category -> quantity, trimmed so the total doesn't exceed subscription_type.
+    """
+    try:
+        # Validate inputs
+        if not isinstance(staples, dict):
+            raise ValueError("Staples must be a dictionary.")
+        if not all(v in STAPLE_VALUES for v in staples.values()):
+            raise ValueError("Staples values must be 'one', 'a few', or 'many'.")
+        if not isinstance(subscription_type, int) or not isinstance(adjusted_subscription_type, int):
+            raise ValueError("Subscription types must be integers.")
+        if subscription_type < 0 or adjusted_subscription_type < 0:
+            raise ValueError("Subscription types cannot be negative.")
+
+        dislikes_count = len(category_dislikes) if category_dislikes is not None else 0
+        if TOTAL_CATEGORIES - len(staples) - dislikes_count < 0:
+            raise ValueError("Invalid inputs: staples and category dislikes exceed available categories (10).")
+
+        values = list(staples.values())
+        counts = (values.count("many"), values.count("a few"), values.count("one"))
+        value_mapping = dict(zip(STAPLE_VALUES, plan_value_mapping(*counts, adjusted_subscription_type)))
+        staples_log.debug("Staple counts (many, a few, one): %s, box size: %s/%s, value_mapping=%s", counts, adjusted_subscription_type, subscription_type, value_mapping)
+
+        transformed_staples = {k: value_mapping[v] for k, v in staples.items()}
+
+        # Trim the highest quantities first (never below 1) if the total exceeds the box
+        total_value = sum(transformed_staples.values())
+        if total_value > subscription_type:
+            for key, value in sorted(transformed_staples.items(), key=lambda item: item[1], reverse=True):
+                if total_value <= subscription_type:
+                    break
+                if value > 1:
+                    transformed_staples[key] -= 1
+                    total_value -= 1
+            staples_log.debug("Trimmed staples to the box size: %s", transformed_staples)
+
+        return transformed_staples
+
+    except Exception as e:
+        staples_log.error("Error occurred: %s", str(e))
+        raise
@@ -0,0 +1,230 @@
+"""
+Check that plan_staples matches the if/elif cascade it replaced, case by case.
+
+    python -m benchmarks.check_staple_planner
+    python -m benchmarks.check_staple_planner --max-staples 6 --max-size 24 --shuffled-size 44
+
+transform_staples_object below is the original cascade from build_starting_box_document,
+minus its debug logging, kept as the reference. Every case compares the returned dict
+(including key order) or the raised exception's type and message:
+
+- every sequence of up to --max-staples staple values, for every box size up to --max-size
+  and every adjusted size up to the box size
+- a shuffled order of every ("many", "a few", "one") mix of more staples (up to the 10
+  categories), for box sizes up to --shuffled-size
+- staples plus dislikes around the 10 categories limit, and the invalid-input errors
+
+Exits with 1 when any case differs.
+"""
+import sys
+import json
+import time
+import random
+import logging
+import argparse
+import itertools
+from admin.services.staple_planner_service import plan_staples, STAPLE_VALUES, TOTAL_CATEGORIES
+
+# Differences listed in the report (all of them are counted)
+DEFAULT_MAX_DIFFS = 20
+
+CATEGORIES = [f"Category{number}" for number in range(TOTAL_CATEGORIES + 2)]
+
+
+def transform_staples_object(staples, subscription_type, category_dislikes, adjusted_subscription_type):
+    # Validate inputs
+    if not isinstance(staples, dict):
+        raise ValueError("Staples must be a dictionary.")
+    if not all(v in ["one", "a few", "many"] for v in staples.values()):
+        raise ValueError("Staples values must be 'one', 'a few', or 'many'.")
+    if not isinstance(subscription_type, int) or not isinstance(adjusted_subscription_type, int):
+        raise ValueError("Subscription types must be integers.")
+    if subscription_type < 0 or adjusted_subscription_type < 0:
+        raise ValueError("Subscription types cannot be negative.")
+
+    # COUNTS
+    staples_count = len(staples)
+    dislikes_count = len(category_dislikes) if category_dislikes is not None else 0
+    optional_categories = 10 - staples_count - dislikes_count
+
+    if optional_categories < 0:
+        raise ValueError("Invalid inputs: staples and category dislikes exceed available categories (10).")
+
+    # Count occurrences of each value in staples
+    many_count = sum(1 for v in staples.values() if v == "many")
+    few_count = sum(1 for v in staples.values() if v == "a few")
+    one_count = sum(1 for v in staples.values() if v == "one")
+
+    # Initialize value mapping
+    # Calculate total for each condition
+    if many_count * 2 + few_count * 1 + one_count * 1 < adjusted_subscription_type:
+        value_mapping = {"many": 2, "a few": 1, "one": 1}
+        total = many_count * 2 + few_count * 1 + one_count * 1
+        remaining = adjusted_subscription_type - total
+        if remaining > 0 and few_count > 0:
+            value_mapping["a few"] = min(2, 1 + remaining // few_count)
+    elif many_count * 2 + few_count * 2 + one_count * 1 < adjusted_subscription_type:
+        value_mapping = {"many": 2, "a few": 2, "one": 1}
+        total = many_count * 2 + few_count * 2 + one_count * 1
+        remaining = adjusted_subscription_type - total
+        if remaining > 0 and many_count > 0:
+            value_mapping["many"] = min(3, 2 + remaining // many_count)
+    elif many_count * 3 + few_count * 2 + one_count * 1 < adjusted_subscription_type:
+        value_mapping = {"many": 3, "a few": 2, "one": 1}
+        total = many_count * 3 + few_count * 2 + one_count * 1
+        remaining = adjusted_subscription_type - total
+        if remaining > 0 and many_count > 0:
+            value_mapping["many"] = min(4, 3 + remaining // many_count)
+    elif many_count * 4 + few_count * 2 + one_count * 1 < adjusted_subscription_type:
+        value_mapping = {"many": 4, "a few": 2, "one": 1}
+        total = many_count * 4 + few_count * 2 + one_count * 1
+        remaining = adjusted_subscription_type - total
+        if remaining > 0 and many_count > 0:
+            value_mapping["many"] = min(5, 4 + remaining // many_count)
+    elif many_count * 5 + few_count * 2 + one_count * 1 < adjusted_subscription_type:
+        value_mapping = {"many": 5, "a few": 2, "one": 1}
+        total = many_count * 5 + few_count * 2 + one_count * 1
+        remaining = adjusted_subscription_type - total
+        if remaining > 0 and few_count > 0:
+            value_mapping["a few"] = min(3, 2 + remaining // few_count)
+    elif many_count * 5 + few_count * 3 + one_count * 1 < adjusted_subscription_type:
+        value_mapping = {"many": 5, "a few": 3, "one": 1}
+        total = many_count * 5 + few_count * 3 + one_count * 1
+        remaining = adjusted_subscription_type - total
+        if remaining > 0 and many_count > 0:
+            value_mapping["many"] = min(6, 5 + remaining // many_count)
+    else:
+        value_mapping = {"many": 1, "a few": 1, "one": 1}
+        total = many_count * 1 + few_count * 1 + one_count * 1
+        remaining = adjusted_subscription_type - total
+        if remaining < 0:
+            if many_count > 0:
+                value_mapping["many"] = max(4, (adjusted_subscription_type - few_count * 3 - one_count * 1) // many_count)
+            elif few_count > 0:
+                value_mapping["a few"] = max(2, (adjusted_subscription_type - many_count * 5 - one_count * 1) // few_count)
+
+    # Apply the mapping to the staples
+    transformed_staples = {k: value_mapping[v] for k, v in staples.items()}
+
+    # Calculate the total value after transformation
+    total_value = sum(transformed_staples.values())
+
+    # Adjust values if the total exceeds the subscription_type
+    if total_value > subscription_type:
+        # Sort items by their values in descending order to target the highest value first
+        sorted_items = sorted(transformed_staples.items(), key=lambda item: item[1], reverse=True)
+
+        for key, value in sorted_items:
+            if total_value <= subscription_type:
+                break
+            if value > 1:  # Ensure the value doesn't drop below 1
+                transformed_staples[key] -= 1
+                total_value -= 1
+
+    return transformed_staples
+
+
+def _outcome(function, staples, subscription_type, category_dislikes, adjusted_subscription_type):
+    try:
+        result = function(staples, subscription_type, category_dislikes, adjusted_subscription_type)
+        return ("result", list(result.items()))
+    except Exception as e:
+        return ("error", type(e).__name__, str(e))
+
+
+def _staples(values):
+    return dict(zip(CATEGORIES, values))
+
+
+def generate_cases(max_staples, max_size, shuffled_size, seed):
+    """
+    Yield (staples, subscription_type, category_dislikes, adjusted_subscription_type) cases.
+    """
+    # Every value sequence, every box size and adjusted size
+    for length in range(max_staples + 1):
+        for values in itertools.product(STAPLE_VALUES, repeat=length):
+            staples = _staples(values)
+            for subscription_type in range(max_size + 1):
+                for adjusted_subscription_type in range(subscription_type + 1):
+                    yield staples, subscription_type, [], adjusted_subscription_type
+
+    # Larger staple counts: every value mix once, in a shuffled order
+    rng = random.Random(seed)
+    for length in range(max_staples + 1, TOTAL_CATEGORIES + 1):
+        for mix in itertools.combinations_with_replacement(STAPLE_VALUES, length):
+            values = list(mix)
+            rng.shuffle(values)
+            staples = _staples(values)
+            for subscription_type in range(shuffled_size + 1):
+                for adjusted_subscription_type in range(subscription_type + 1):
+                    yield staples, subscription_type, [], adjusted_subscription_type
+
+    # The 10 categories limit, from both sides
+    for length in range(TOTAL_CATEGORIES + 2):
+        staples = _staples(["one"] * length)
+        for dislikes_count in range(TOTAL_CATEGORIES + 2 - length):
+            for category_dislikes in ([f"Disliked{number}" for number in range(dislikes_count)], None):
+                yield staples, 20, category_dislikes, 15
+
+    # Invalid inputs
+    yield ["many"], 10, [], 10
+    yield {"Chips": "lots"}, 10, [], 10
+    yield {"Chips": "many"}, 10.0, [], 10
+    yield {"Chips": "many"}, 10, [], "10"
+    yield {"Chips": "many"}, -1, [], 0
+    yield {"Chips": "many"}, 10, [], -1
+
+
+def check(max_staples, max_size, shuffled_size, seed=0, max_diffs=DEFAULT_MAX_DIFFS):
+    """
+    Returns:
+        dict: Report with the number of cases, differences and the first `max_diffs` of them.
+    """
+    started = time.perf_counter()
+    cases = 0
+    diffs = []
+    diff_count = 0
+    for staples, subscription_type, category_dislikes, adjusted_subscription_type in generate_cases(max_staples, max_size, shuffled_size, seed):
+        cases += 1
+        expected = _outcome(transform_staples_object, staples, subscription_type, category_dislikes, adjusted_subscription_type)
+        actual = _outcome(plan_staples, staples, subscription_type, category_dislikes, adjusted_subscription_type)
+        if actual != expected:
+            diff_count += 1
+            if len(diffs) < max_diffs:
+                diffs.append({
+                    "staples": staples,
+                    "subscription_type": subscription_type,
+                    "category_dislikes": category_dislikes,
+                    "adjusted_subscription_type": adjusted_subscription_type,
+                    "expected": expected,
+                    "actual": actual,
+                })
+    return {
+        "cases": cases,
+        "differences": diff_count,
+        "elapsed_seconds": round(time.perf_counter() - started, 3),
+        "diffs": diffs,
+    }
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Check plan_staples against the original staple cascade.")
+    parser.add_argument("--max-staples", type=int, default=5, help="Longest staple sequence checked exhaustively.")
+    parser.add_argument("--max-size", type=int, default=24, help="Largest box size for the exhaustive sequences.")
+    parser.add_argument("--shuffled-size", type=int, default=44, help="Largest box size for the shuffled larger mixes.")
+    parser.add_argument("--seed", type=int, default=0, help="Seed for the shuffled orders.")
+    parser.add_argument("--max-diffs", type=int, default=DEFAULT_MAX_DIFFS, help="Differences listed in the report.")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    # The invalid-input cases make plan_staples log an error each
+    logging.getLogger("admin.box.staples").disabled = True
+    report = check(args.max_staples, args.max_size, args.shuffled_size, args.seed, args.max_diffs)
+    print(json.dumps(report, indent=2, default=str))
+    return 1 if report["differences"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,365 @@
+import asyncio
+import itertools
+import bson
+from bson import ObjectId
+from pymongo import InsertOne, ReplaceOne
+from pymongo.errors import BulkWriteError, OperationFailure
+
+# Collections build_starting_box and the admin app use (see admin/config/database.py)
+BOX_COLLECTIONS = ("snacks", "customers", "draftboxes", "monthly_base_box")
+
+_MISSING = object()
+
+
+def _get_path(document, path):
+    value = document
+    for part in path.split("."):
+        if isinstance(value, dict):
+            value = value.get(part, _MISSING)
+        else:
+            return _MISSING
+        if value is _MISSING:
+            return _MISSING
+    return value
+
+
+def _values(value):
+    # A list field matches when the field or any of its elements matches
+    return [value] + value if isinstance(value, list) else [value]
+
+
+def _matches_operator(value, operator, operand):
+    if operator == "$exists":
+        return (value is not _MISSING) == bool(operand)
+    if operator == "$in":
+        return value is not _MISSING and any(candidate in operand for candidate in _values(value))
+    if operator == "$nin":
+        return value is _MISSING or not any(candidate in operand for candidate in _values(value))
+    if operator == "$ne":
+        return value is _MISSING or all(candidate != operand for candidate in _values(value))
+    if operator == "$eq":
+        return value is not _MISSING and any(candidate == operand for candidate in _values(value))
+    comparisons = {
+        "$gt": lambda a, b: a > b,
+        "$gte": lambda a, b: a >= b,
+        "$lt": lambda a, b: a < b,
+        "$lte": lambda a, b: a <= b,
+    }
+    if operator in comparisons:
+        if value is _MISSING:
+            return False
+        for candidate in _values(value):
+            try:
+                if comparisons[operator](candidate, operand):
+                    return True
+            except TypeError:
+                continue
+        return False
+    raise NotImplementedError(f"Query operator {operator} is not supported by the in-memory collections")
+
+
+def matches(document, query):
+    """
+    Whether `document` matches a Mongo query (equality, $in, $nin, $ne, $exists, $gt/$gte/$lt/$lte).
+    """
+    for path, condition in (query or {}).items():
+        value = _get_path(document, path)
+        if isinstance(condition, dict) and condition and all(key.startswith("$") for key in condition):
+            if not all(_matches_operator(value, operator, operand) for operator, operand in condition.items()):
+                return False
+        elif not _matches_operator(value, "$eq", condition):
+            return False
+    return True
+
+
+def _round_trip(documents):
+    # Documents go through BSON like they would over the wire: callers get their own copies
+    # and pay a realistic decoding cost
+    return [bson.decode(bson.encode(document)) for document in documents]
+
+
+def _project(document, projection):
+    # Shares values with `document`; results are copied by _round_trip before they're returned
+    if not projection:
+        return document
+    include_id = projection.get("_id", 1)
+    included = [path for path, flag in projection.items() if flag and path != "_id"]
+    if not included:
+        result = dict(document)
+        for path, flag in projection.items():
+            if not flag:
+                result.pop(path, None)
+        return result
+
+    result = {}
+    if include_id and "_id" in document:
+        result["_id"] = document["_id"]
+    for path in included:
+        _copy_path(document, result, path.split("."))
+    return result
+
+
+def _copy_path(source, target, parts):
+    head, rest = parts[0], parts[1:]
+    if head not in source:
+        return
+    value = source[head]
+    if not rest:
+        target[head] = value
+    elif isinstance(value, list):
+        items = target.setdefault(head, [{} for _ in value])
+        for item, element in zip(items, value):
+            if isinstance(element, dict):
+                _copy_path(element, item, rest)
+    elif isinstance(value, dict):
+        _copy_path(value, target.setdefault(head, {}), rest)
+
+
+def _sort(documents, sort):
+    # Stable sort from the last key to the first; missing fields sort lowest, as in Mongo
+    for key, direction in reversed(list(sort)):
+        present = [document for document in documents if _get_path(document, key) is not _MISSING]
+        missing = [document for document in documents if _get_path(document, key) is _MISSING]
+        present.sort(key=lambda document: _get_path(document, key), reverse=direction < 0)
+        documents = missing + present if direction > 0 else present + missing
+    return documents
+
+
+def _normalize_sort(key_or_list, direction=None):
+    if isinstance(key_or_list, str):
+        return [(key_or_list, direction if direction is not None else 1)]
+    return list(key_or_list)
+
+
+class InMemoryCursor:
+    """
+    Async stand-in for a Motor find() cursor.
+    """
+
+    def __init__(self, collection, query, projection):
+        self.collection = collection
+        self.query = query
+        self.projection = projection
+        self._sort = None
+        self._limit = 0
+        self._results = None
+
+    def sort(self, key_or_list, direction=None):
+        self._sort = _normalize_sort(key_or_list, direction)
+        return self
+
+    def limit(self, limit):
+        self._limit = limit
+        return self
+
+    async def _load(self):
+        if self._results is None:
+            await self.collection.round_trip()
+            documents = [document for document in self.collection.documents if matches(document, self.query)]
+            if self._sort:
+                documents = _sort(documents, self._sort)
+            if self._limit:
+                documents = documents[:self._limit]
+            self._results = iter(_round_trip([_project(document, self.projection) for document in documents]))
+        return self._results
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        results = await self._load()
+        try:
+            return next(results)
+        except StopIteration:
+            raise StopAsyncIteration
+
+    async def to_list(self, length=None):
+        results = await self._load()
+        return list(results) if length is None else list(itertools.islice(results, length))
+
+    async def explain(self):
+        return {"queryPlanner": {"winningPlan": {"stage": "COLLSCAN"}}}
+
+
+class InMemoryAggregateCursor:
+    """
+    Async stand-in for a Motor aggregate() cursor ($match, $project, $unwind, $group with
+    $addToSet/$sum, $sort, $limit and $facet).
+    """
+
+    def __init__(self, collection, pipeline):
+        self.collection = collection
+        self.pipeline = pipeline
+
+    async def to_list(self, length=None):
+        await self.collection.round_trip()
+        results = run_pipeline(self.collection.documents, self.pipeline)
+        return _round_trip(results if length is None else results[:length])
+
+
+def run_pipeline(documents, pipeline):
+    for stage in pipeline:
+        (operator, spec), = stage.items()
+        if operator == "$match":
+            documents = [document for document in documents if matches(document, spec)]
+        elif operator == "$project":
+            documents = [_project(document, spec) for document in documents]
+        elif operator == "$unwind":
+            path = spec.lstrip("$")
+            unwound = []
+            for document in documents:
+                for element in _get_path(document, path) if isinstance(_get_path(document, path), list) else []:
+                    unwound.append({**document, path: element})
+            documents = unwound
+        elif operator == "$group":
+            documents = _group(documents, spec)
+        elif operator == "$sort":
+            documents = _sort(documents, spec.items())
+        elif operator == "$limit":
+            documents = documents[:spec]
+        elif operator == "$facet":
+            documents = [{name: run_pipeline(documents, sub_pipeline) for name, sub_pipeline in spec.items()}]
+        else:
+            raise NotImplementedError(f"Aggregation stage {operator} is not supported by the in-memory collections")
+    return documents
+
+
+def _group(documents, spec):
+    if spec["_id"] is not None:
+        raise NotImplementedError("Only $group with _id: None is supported by the in-memory collections")
+    group = {"_id": None}
+    for field, accumulator in spec.items():
+        if field == "_id":
+            continue
+        (operator, expression), = accumulator.items()
+        if operator == "$addToSet":
+            values = []
+            for document in documents:
+                value = _get_path(document, expression.lstrip("$"))
+                if value is not _MISSING and value not in values:
+                    values.append(value)
+            group[field] = values
+        elif operator == "$sum":
+            group[field] = sum(expression if isinstance(expression, (int, float)) else _get_path(document, expression.lstrip("$")) or 0 for document in documents)
+        else:
+            raise NotImplementedError(f"Accumulator {operator} is not supported by the in-memory collections")
+    return [group] if documents else []
+
+
+class InMemoryCollection:
+    """
+    Async, in-memory stand-in for the parts of a Motor collection the service uses.
+
+    Every read or write awaits `latency` seconds to model a Mongo round trip. Change streams
+    aren't available (watch() raises OperationFailure), so the snack catalog polls, as on a
+    standalone server.
+    """
+
+    def __init__(self, database_name, name, latency=0.0):
+        self.name = name
+        self.full_name = f"{database_name}.{name}"
+        self.latency = latency
+        self.documents = []
+        self.indexes = {}
+
+    async def round_trip(self):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        else:
+            await asyncio.sleep(0)
+
+    def with_options(self, **kwargs):
+        return self
+
+    def find(self, filter=None, projection=None, sort=None, batch_size=None, **kwargs):
+        cursor = InMemoryCursor(self, filter, projection)
+        if sort:
+            cursor.sort(sort)
+        return cursor
+
+    async def find_one(self, filter=None, projection=None, sort=None, **kwargs):
+        results = await self.find(filter, projection, sort=sort).limit(1).to_list(1)
+        return results[0] if results else None
+
+    async def count_documents(self, filter=None):
+        await self.round_trip()
+        return sum(1 for document in self.documents if matches(document, filter))
+
+    def aggregate(self, pipeline, **kwargs):
+        return InMemoryAggregateCursor(self, pipeline)
+
+    async def insert_one(self, document):
+        await self.round_trip()
+        document.setdefault("_id", ObjectId())
+        self.documents.extend(_round_trip([document]))
+
+    async def insert_many(self, documents, ordered=True):
+        await self.round_trip()
+        for document in documents:
+            document.setdefault("_id", ObjectId())
+        self.documents.extend(_round_trip(documents))
+
+    async def bulk_write(self, requests, ordered=True):
+        await self.round_trip()
+        write_errors = []
+        for index, request in enumerate(requests):
+            if isinstance(request, InsertOne):
+                document = request._doc
+                document.setdefault("_id", ObjectId())
+                self.documents.extend(_round_trip([document]))
+            elif isinstance(request, ReplaceOne):
+                existing = next((i for i, document in enumerate(self.documents) if matches(document, request._filter)), None)
+                replacement, = _round_trip([request._doc])
+                if existing is not None:
+                    replacement["_id"] = self.documents[existing]["_id"]
+                    self.documents[existing] = replacement
+                elif request._upsert:
+                    replacement.setdefault("_id", ObjectId())
+                    self.documents.append(replacement)
+            else:
+                write_errors.append({"index": index, "errmsg": f"{type(request).__name__} is not supported"})
+        if write_errors:
+            raise BulkWriteError({"writeErrors": write_errors})
+
+    async def update_many(self, filter, update):
+        await self.round_trip()
+        for document in self.documents:
+            if not matches(document, filter):
+                continue
+            for operator, fields in update.items():
+                if operator == "$set":
+                    document.update(_round_trip([fields])[0])
+                elif operator == "$unset":
+                    for field in fields:
+                        document.pop(field, None)
+                else:
+                    raise OperationFailure(f"{operator} is not supported")
+
+    async def create_indexes(self, indexes):
+        names = []
+        for index in indexes:
+            document = index.document
+            self.indexes[document["name"]] = document
+            names.append(document["name"])
+        return names
+
+    def watch(self, *args, **kwargs):
+        raise OperationFailure("The $changeStream stage is only supported on replica sets")
+
+
+class InMemoryDatabase:
+    """
+    Dict of InMemoryCollections, created on first access like a Motor database.
+    """
+
+    def __init__(self, name="Boxes", latency=0.0):
+        self.name = name
+        self.latency = latency
+        self.collections = {}
+        for collection_name in BOX_COLLECTIONS:
+            self[collection_name]
+
+    def __getitem__(self, name):
+        if name not in self.collections:
+            self.collections[name] = InMemoryCollection(self.name, name, self.latency)
+        return self.collections[name]
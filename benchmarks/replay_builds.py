@@ -0,0 +1,278 @@
+"""
+Replay captured builds through the box selection engine, offline and as fast as possible.
+
+    PYTHONHASHSEED=0 BOX_CAPTURE_DIR=captures uvicorn admin.main:app
+    python -m benchmarks.replay_builds captures --workers 8
+    python -m benchmarks.replay_builds captures --workers 0 --limit 500 --output replay.json
+
+Builds are captured by admin/services/build_capture_service.py: the request, the customer
+context, the previous SnackIDs, the catalog snapshot file and the SnackIDs that were chosen.
+Replay reads and writes no database: every build runs select_month_start_box on the snapshot
+it was captured with, in worker processes started with the capture's PYTHONHASHSEED (set
+iteration order breaks ties, so another seed can pick different snacks).
+
+Reports boxes per second, per-stage and selection latency, and every build whose SnackIDs
+differ from the captured ones. Exits with 1 when a build differs or fails. Builds captured
+without PYTHONHASHSEED can't be reproduced exactly: their differences are listed as unpinned
+and don't fail the replay.
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import multiprocessing
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from bson import json_util
+from benchmarks.run_benchmarks import summarize
+from admin.config.logging_config import configure_logging
+from admin.services.snack_catalog_service import CatalogSnapshot
+from admin.services.box_selection_engine import select_month_start_box, SelectionStats
+from admin.services.build_capture_service import CAPTURE_FILE_NAME
+
+# Differences listed in the report (all of them are counted)
+DEFAULT_MAX_DIFFS = 20
+
+# Catalog snapshots mapped by this process, by file name
+_snapshots = {}
+
+
+def read_capture(path):
+    """
+    Captured builds from a capture directory or a builds JSONL file.
+
+    Returns:
+        Tuple[str, List[dict]]: The directory holding the catalog files, and the records in capture order.
+    """
+    if os.path.isdir(path):
+        directory, path = path, os.path.join(path, CAPTURE_FILE_NAME)
+    else:
+        directory = os.path.dirname(path) or "."
+    records = []
+    with open(path) as capture_file:
+        for line_number, line in enumerate(capture_file, 1):
+            if not line.strip():
+                continue
+            try:
+                records.append(json_util.loads(line))
+            except ValueError as e:
+                # A partial last line from a process that was killed mid-write
+                print(f"Skipping line {line_number} of {path}: {e}", file=sys.stderr)
+    return directory, records
+
+
+def _snapshot(directory, catalog_file):
+    snapshot = _snapshots.get(catalog_file)
+    if snapshot is None:
+        snapshot = _snapshots[catalog_file] = CatalogSnapshot.from_file(os.path.join(directory, catalog_file))
+    return snapshot
+
+
+def _init_worker(directory, catalog_files):
+    """
+    Worker initializer: map the capture's catalogs and build their records up front, so the
+    first builds of each worker aren't slowed down by it.
+    """
+    configure_logging()
+    for catalog_file in catalog_files:
+        for _ in _snapshot(directory, catalog_file).snacks:
+            pass
+
+
+def _ready(_):
+    return os.getpid()
+
+
+def replay_builds(directory, records):
+    """
+    Select every record's box again. Runs in the replay workers (or inline with --workers 0).
+
+    Returns:
+        List[dict]: Per record: selection seconds, stage seconds, the SnackIDs chosen and any error.
+    """
+    results = []
+    for record in records:
+        stats = SelectionStats()
+        started = time.perf_counter()
+        try:
+            snapshot = _snapshot(directory, record["catalog"])
+            context = {**record["context"], "month_start_box": []}
+            month_start_box = select_month_start_box(snapshot, context, record["request"]["off_cycle"], record["previousSnackIDs"], stats)
+            snack_ids, error = [snack["SnackID"] for snack in month_start_box], None
+        except Exception as e:
+            snack_ids, error = None, f"{type(e).__name__}: {e}"
+        results.append({
+            "seconds": time.perf_counter() - started,
+            "stages": stats.stage_seconds,
+            "snackIDs": snack_ids,
+            "error": error,
+        })
+    return results
+
+
+def _chunks(items, size):
+    return [items[start:start + size] for start in range(0, len(items), size)]
+
+
+def _run_with_seed(directory, records, workers, seed):
+    """
+    Replay `records` in `workers` processes started with PYTHONHASHSEED=`seed` (unset for None).
+
+    Returns:
+        Tuple[List[dict], float]: The replay_builds results in record order, and the seconds
+        taken once the workers were started.
+    """
+    previous_seed = os.environ.get("PYTHONHASHSEED")
+    if seed is None:
+        os.environ.pop("PYTHONHASHSEED", None)
+    else:
+        os.environ["PYTHONHASHSEED"] = seed
+    try:
+        # Several chunks per worker, so one slow chunk doesn't leave the others idle
+        chunk_size = max(1, -(-len(records) // (workers * 4)))
+        catalog_files = sorted({record["catalog"] for record in records})
+        with ProcessPoolExecutor(
+            max_workers=workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_worker,
+            initargs=(directory, catalog_files),
+        ) as executor:
+            # Process startup and catalog mapping aren't part of the throughput
+            list(executor.map(_ready, range(workers)))
+            started = time.perf_counter()
+            futures = [executor.submit(replay_builds, directory, chunk) for chunk in _chunks(records, chunk_size)]
+            results = [result for future in futures for result in future.result()]
+            return results, time.perf_counter() - started
+    finally:
+        if previous_seed is None:
+            os.environ.pop("PYTHONHASHSEED", None)
+        else:
+            os.environ["PYTHONHASHSEED"] = previous_seed
+
+
+def diff_snack_ids(captured, replayed):
+    """
+    How the replayed SnackIDs differ from the captured ones.
+    """
+    return {
+        "missing": [snack_id for snack_id in captured if snack_id not in replayed],
+        "added": [snack_id for snack_id in replayed if snack_id not in captured],
+        "reordered": sorted(captured) == sorted(replayed),
+    }
+
+
+def run_replay(path, workers=1, limit=None, repeat=1, max_diffs=DEFAULT_MAX_DIFFS):
+    """
+    Replay a capture and compare every box with the captured one.
+
+    Returns:
+        dict: Throughput, latency, errors and differences.
+    """
+    directory, records = read_capture(path)
+    if limit:
+        records = records[:limit]
+    records = records * repeat
+    current_seed = os.environ.get("PYTHONHASHSEED")
+
+    results = [None] * len(records)
+    pinned = [False] * len(records)
+    if workers <= 0:
+        # In this process, e.g. under a profiler: only builds captured with our seed are pinned
+        _init_worker(directory, sorted({record["catalog"] for record in records}))
+        started = time.perf_counter()
+        for index, result in enumerate(replay_builds(directory, records)):
+            results[index] = result
+            pinned[index] = records[index].get("pythonHashSeed") is not None and records[index].get("pythonHashSeed") == current_seed
+        wall_seconds = time.perf_counter() - started
+    else:
+        by_seed = defaultdict(list)
+        for index, record in enumerate(records):
+            by_seed[record.get("pythonHashSeed")].append(index)
+        wall_seconds = 0.0
+        for seed, indexes in by_seed.items():
+            seed_results, seconds = _run_with_seed(directory, [records[index] for index in indexes], workers, seed)
+            wall_seconds += seconds
+            for index, result in zip(indexes, seed_results):
+                results[index] = result
+                pinned[index] = seed is not None
+
+    stage_samples = defaultdict(list)
+    errors = []
+    diffs = []
+    unpinned_diffs = 0
+    for record, result, is_pinned in zip(records, results, pinned):
+        for stage, seconds in result["stages"]:
+            stage_samples[stage].append(seconds)
+        request = record["request"]
+        if result["error"]:
+            errors.append({"customerID": request["customerID"], "capturedAt": record["capturedAt"].isoformat(), "error": result["error"]})
+        elif result["snackIDs"] != record["snackIDs"]:
+            if not is_pinned:
+                unpinned_diffs += 1
+                continue
+            diffs.append({
+                "customerID": request["customerID"],
+                "capturedAt": record["capturedAt"].isoformat(),
+                "catalog": record["catalog"],
+                **diff_snack_ids(record["snackIDs"], result["snackIDs"]),
+            })
+
+    return {
+        "meta": {
+            "capture": path,
+            "builds": len(records),
+            "workers": workers,
+            "repeat": repeat,
+            "catalogs": len({record["catalog"] for record in records}),
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        },
+        "wall_seconds": round(wall_seconds, 3),
+        "boxes_per_second": round(len(records) / wall_seconds, 2) if wall_seconds else None,
+        "selection": summarize([result["seconds"] for result in results]),
+        "stages": {stage: summarize(samples) for stage, samples in sorted(stage_samples.items())},
+        "errors": len(errors),
+        "diffs": len(diffs),
+        "unpinned_diffs": unpinned_diffs,
+        "error_examples": errors[:max_diffs],
+        "diff_examples": diffs[:max_diffs],
+    }
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Replay captured box builds through the selection engine.")
+    parser.add_argument("capture", help="Capture directory (BOX_CAPTURE_DIR) or its builds JSONL file.")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="Replay processes (0 replays in this process).")
+    parser.add_argument("--limit", type=int, help="Replay only the first N captured builds.")
+    parser.add_argument("--repeat", type=int, default=1, help="Replay every build this many times.")
+    parser.add_argument("--max-diffs", type=int, default=DEFAULT_MAX_DIFFS, help="Differences and errors listed in the report.")
+    parser.add_argument("--output", help="Write the report to this file.")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    configure_logging()
+    report = run_replay(args.capture, workers=args.workers, limit=args.limit, repeat=args.repeat, max_diffs=args.max_diffs)
+
+    if args.output:
+        os.makedirs(os.path.dirname(args.output) or ".", exist_ok=True)
+        with open(args.output, "w") as report_file:
+            json.dump(report, report_file, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+    print(
+        f"{report['meta']['builds']} builds in {report['wall_seconds']:.2f}s ({report['boxes_per_second']} boxes/s), "
+        f"selection p50 {report['selection']['p50_ms']}ms p99 {report['selection']['p99_ms']}ms, "
+        f"{report['diffs']} differing, {report['unpinned_diffs']} unpinned, {report['errors']} failed",
+        file=sys.stderr,
+    )
+    return 1 if report["diffs"] or report["errors"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
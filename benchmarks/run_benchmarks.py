@@ -0,0 +1,385 @@
+"""
+Benchmark build_starting_box against seeded synthetic catalogs, without a Mongo server.
+
+    python -m benchmarks.run_benchmarks --sizes 500,5000,50000 --customers 200
+    PYTHONHASHSEED=0 python -m benchmarks.run_benchmarks --save-baseline benchmarks/baselines/local.json
+    PYTHONHASHSEED=0 python -m benchmarks.run_benchmarks --compare benchmarks/baselines/local.json
+
+The four collections are in-memory stand-ins (benchmarks/memory_collections.py) with an
+optional simulated round trip, so the numbers are the service's own CPU and scheduling cost.
+For every catalog size it reports the cold catalog load (and, with SNACK_CATALOG_SNAPSHOT_DIR
+set, a cold start from the snapshot file), p50/p99 of each build stage and of the whole
+build, and memory (catalog bytes, traced peak while building, max RSS).
+
+--compare exits with 1 when a p50/p99 or memory figure grew by more than the tolerance, or
+when the selected boxes differ from the baseline's (only checked when PYTHONHASHSEED is set
+and matches the baseline's, since set ordering feeds into tie-breaks).
+Baselines are machine-specific: save one on the machine that compares against it.
+"""
+import os
+
+# Every request is built for real: no idempotent replays of earlier rounds
+os.environ.setdefault("BOX_IDEMPOTENCY_WINDOW_SECONDS", "0")
+# Relaxation warnings would otherwise flood the output
+os.environ.setdefault("BOX_LOG_LEVEL", "ERROR")
+
+import sys
+import json
+import time
+import asyncio
+import hashlib
+import argparse
+import gc
+import platform
+import resource
+import tracemalloc
+from collections import defaultdict
+from admin.config.logging_config import configure_logging
+from admin.models.customers_model import SnackItem
+from admin.services import snack_catalog_service
+from admin.models.snack_record_model import SnackRecord
+from admin.services.snack_catalog_service import get_snack_catalog, SnackCatalog, CatalogSnapshot
+from admin.services.snack_catalog_file_service import remove_catalog_files, SNACK_CATALOG_SNAPSHOT_DIR
+from admin.services.customer_profile_cache_service import customer_profile_cache
+from admin.services.build_starting_box_service import build_starting_box
+from admin.services.metrics_service import BUILD_STAGE_SECONDS
+from benchmarks.memory_collections import InMemoryDatabase
+from benchmarks.synthetic import generate_dataset
+
+DEFAULT_SIZES = (500, 5000, 50000)
+
+# Allowed relative growth of a timing or memory figure before --compare fails
+DEFAULT_TOLERANCE = 0.25
+
+# Timing differences below this many milliseconds are noise, whatever the ratio
+DEFAULT_MIN_DELTA_MS = 1.0
+
+# Each size is run this many times on fresh data and the best figures are kept
+DEFAULT_REPEAT = 3
+
+
+def percentile(samples, fraction):
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+def summarize(samples):
+    """
+    count, p50, p99 and mean (ms) of a list of durations in seconds.
+    """
+    return {
+        "count": len(samples),
+        "p50_ms": round(percentile(samples, 0.50) * 1000, 3) if samples else None,
+        "p99_ms": round(percentile(samples, 0.99) * 1000, 3) if samples else None,
+        "mean_ms": round(sum(samples) / len(samples) * 1000, 3) if samples else None,
+    }
+
+
+def boxes_digest(results):
+    """
+    Hash of the SnackIDs selected for every request, to spot selection changes.
+    """
+    payload = [[customer_id, [snack["SnackID"] for snack in snacks or []]] for customer_id, snacks in results]
+    return hashlib.sha256(json.dumps(payload).encode()).hexdigest()
+
+
+async def load_database(dataset, name, latency):
+    database = InMemoryDatabase(name, latency=latency)
+    for collection_name in ("snacks", "customers", "draftboxes"):
+        await database[collection_name].insert_many(dataset[collection_name])
+    return database
+
+
+async def run_scenario(snack_count, customer_count, seed, rounds=1, concurrency=1, latency=0.0, memory_sample=20):
+    """
+    Build a box for every generated request against a catalog of `snack_count` snacks.
+
+    Returns:
+        dict: Timings (cold catalog load, per stage, end to end), memory and the boxes digest.
+    """
+    dataset = generate_dataset(seed, snack_count, customer_count, rounds=rounds)
+    database = await load_database(dataset, f"Bench{snack_count}", latency)
+    collections = {
+        "monthly_draft_box_collection": database["draftboxes"],
+        "all_customers_collection": database["customers"],
+        "all_snacks_collection": database["snacks"],
+    }
+    customer_profile_cache.clear()
+
+    if SNACK_CATALOG_SNAPSHOT_DIR:
+        # Start from Mongo, not from a file left by the previous run
+        remove_catalog_files(SNACK_CATALOG_SNAPSHOT_DIR, database["snacks"].full_name)
+
+    # Cold start: load and index the catalog
+    load_started = time.perf_counter()
+    catalog = await get_snack_catalog(database["snacks"])
+    catalog_load_seconds = time.perf_counter() - load_started
+
+    # What an in-memory snapshot of the catalog holds on to
+    documents = await database["snacks"].find({}).to_list(length=None)
+    tracemalloc.start()
+    snapshot = CatalogSnapshot([SnackRecord.from_document(document) for document in documents], 0)
+    catalog_bytes, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del snapshot, documents
+
+    catalog_file_open_seconds = mapped_catalog_bytes = None
+    if SNACK_CATALOG_SNAPSHOT_DIR:
+        # Cold start of another worker from the snapshot file the load above wrote
+        open_started = time.perf_counter()
+        mapped_catalog = SnackCatalog(database["snacks"])
+        await mapped_catalog.ensure_loaded()
+        catalog_file_open_seconds = time.perf_counter() - open_started
+        await mapped_catalog.stop_watching()
+
+        # Per-process memory of a mapped snapshot (the file's pages are shared)
+        tracemalloc.start()
+        snapshot = CatalogSnapshot.from_file(catalog.snapshot.path)
+        mapped_catalog_bytes, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        # Don't keep the file pinned against pruning for the rest of the run
+        snapshot.pin.release()
+
+    stage_samples = defaultdict(list)
+
+    def collect_stage(value, labels):
+        stage_samples[labels["stage"]].append(value)
+
+    requests = dataset["requests"]
+    build_samples = []
+    results = [None] * len(requests)
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def build(index, request):
+        async with semaphore:
+            started = time.perf_counter()
+            snacks = await build_starting_box(
+                **{**request, "repeat_monthly": [SnackItem(**snack) for snack in request["repeat_monthly"]]},
+                **collections,
+            )
+            build_samples.append(time.perf_counter() - started)
+            results[index] = (request["customerID"], snacks)
+
+    gc.collect()
+    BUILD_STAGE_SECONDS.add_observer(collect_stage)
+    try:
+        run_started = time.perf_counter()
+        await asyncio.gather(*(build(index, request) for index, request in enumerate(requests)))
+        run_seconds = time.perf_counter() - run_started
+    finally:
+        BUILD_STAGE_SECONDS.remove_observer(collect_stage)
+
+    # Memory pass: tracemalloc slows allocation down, so it is kept out of the timed run
+    tracemalloc.start()
+    for request in requests[:memory_sample]:
+        await build_starting_box(
+            **{**request, "repeat_monthly": [SnackItem(**snack) for snack in request["repeat_monthly"]]},
+            **collections,
+        )
+    _, peak_build_bytes = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    await catalog.stop_watching()
+    # Drop the catalog so the next size starts cold and isn't counted in its memory
+    snack_catalog_service._catalogs.pop(database["snacks"].full_name, None)
+
+    return {
+        "snacks": snack_count,
+        "customers": customer_count,
+        "requests": len(requests),
+        "empty_boxes": sum(1 for _, snacks in results if not snacks),
+        "catalog_load_ms": round(catalog_load_seconds * 1000, 3),
+        "catalog_file_open_ms": round(catalog_file_open_seconds * 1000, 3) if catalog_file_open_seconds is not None else None,
+        "boxes_per_second": round(len(requests) / run_seconds, 2) if run_seconds else None,
+        "end_to_end": summarize(build_samples),
+        "stages": {stage: summarize(samples) for stage, samples in sorted(stage_samples.items())},
+        "memory": {
+            "catalog_bytes": catalog_bytes,
+            "mapped_catalog_bytes": mapped_catalog_bytes,
+            "peak_build_bytes": peak_build_bytes,
+            "max_rss_bytes": max_rss_bytes(),
+        },
+        "boxes_digest": boxes_digest(results),
+    }
+
+
+def best_of(results):
+    """
+    Merge repeated runs of one scenario, keeping the lowest timings and memory (the least
+    disturbed by GC pauses and other processes), so comparisons aren't dominated by noise.
+    """
+    best = dict(results[0])
+    best["repeat"] = len(results)
+    best["catalog_load_ms"] = min(result["catalog_load_ms"] for result in results)
+    if best["catalog_file_open_ms"] is not None:
+        best["catalog_file_open_ms"] = min(result["catalog_file_open_ms"] for result in results)
+    best["boxes_per_second"] = max(result["boxes_per_second"] or 0 for result in results)
+
+    def best_summary(summaries):
+        return {
+            field: summaries[0][field] if field == "count" else min(summary[field] for summary in summaries)
+            for field in summaries[0]
+        }
+
+    best["end_to_end"] = best_summary([result["end_to_end"] for result in results])
+    best["stages"] = {
+        stage: best_summary([result["stages"][stage] for result in results if stage in result["stages"]])
+        for stage in results[0]["stages"]
+    }
+    best["memory"] = {
+        "catalog_bytes": min(result["memory"]["catalog_bytes"] for result in results),
+        "mapped_catalog_bytes": min((result["memory"]["mapped_catalog_bytes"] for result in results), default=None)
+        if results[0]["memory"]["mapped_catalog_bytes"] is not None else None,
+        "peak_build_bytes": min(result["memory"]["peak_build_bytes"] for result in results),
+        "max_rss_bytes": max(result["memory"]["max_rss_bytes"] for result in results),
+    }
+    if len({result["boxes_digest"] for result in results}) > 1:
+        best["boxes_digest"] = None  # Not reproducible, nothing to compare
+    return best
+
+
+def max_rss_bytes():
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and kilobytes on Linux
+    return max_rss if sys.platform == "darwin" else max_rss * 1024
+
+
+async def run_benchmarks(sizes=DEFAULT_SIZES, customers=200, seed=7, rounds=1, concurrency=1, latency=0.0, memory_sample=20, repeat=DEFAULT_REPEAT):
+    """
+    Run every catalog size in turn, `repeat` times each.
+
+    Returns:
+        dict: Run settings under "meta" and one result per size under "scenarios".
+    """
+    report = {
+        "meta": {
+            "seed": seed,
+            "customers": customers,
+            "rounds": rounds,
+            "concurrency": concurrency,
+            "repeat": repeat,
+            "latency_ms": latency * 1000,
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "pythonhashseed": os.environ.get("PYTHONHASHSEED"),
+            "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        },
+        "scenarios": {},
+    }
+    for size in sizes:
+        result = best_of([
+            await run_scenario(size, customers, seed, rounds, concurrency, latency, memory_sample)
+            for _ in range(repeat)
+        ])
+        report["scenarios"][f"snacks_{size}"] = result
+        print(
+            f"{size:>6} snacks: load {result['catalog_load_ms']:.1f}ms"
+            + (f" (file {result['catalog_file_open_ms']:.1f}ms)" if result["catalog_file_open_ms"] is not None else "")
+            + ", "
+            f"build p50 {result['end_to_end']['p50_ms']:.2f}ms p99 {result['end_to_end']['p99_ms']:.2f}ms, "
+            f"{result['boxes_per_second']} boxes/s, catalog {result['memory']['catalog_bytes'] / 1e6:.1f}MB",
+            file=sys.stderr,
+        )
+    return report
+
+
+def compare_reports(baseline, current, tolerance=DEFAULT_TOLERANCE, min_delta_ms=DEFAULT_MIN_DELTA_MS):
+    """
+    Regressions of `current` against `baseline`.
+
+    Returns:
+        List[str]: One line per regression (empty when there are none).
+    """
+    regressions = []
+
+    def check_timing(label, old, new, allowed=tolerance):
+        if old is None or new is None:
+            return
+        if new > old * (1 + allowed) and new - old > min_delta_ms:
+            regressions.append(f"{label}: {old:.3f}ms -> {new:.3f}ms (+{(new / old - 1) * 100 if old else float('inf'):.0f}%)")
+
+    compare_digests = (
+        baseline["meta"].get("pythonhashseed") is not None
+        and baseline["meta"].get("pythonhashseed") == current["meta"].get("pythonhashseed")
+        and baseline["meta"].get("seed") == current["meta"].get("seed")
+    )
+
+    for name, old in baseline["scenarios"].items():
+        new = current["scenarios"].get(name)
+        if new is None:
+            continue
+        check_timing(f"{name} catalog_load", old["catalog_load_ms"], new["catalog_load_ms"])
+        check_timing(f"{name} catalog_file_open", old.get("catalog_file_open_ms"), new.get("catalog_file_open_ms"))
+        # Tails move more between runs than medians, so p99 gets twice the tolerance
+        for percentile_name, allowed in (("p50_ms", tolerance), ("p99_ms", tolerance * 2)):
+            check_timing(f"{name} end_to_end {percentile_name}", old["end_to_end"][percentile_name], new["end_to_end"][percentile_name], allowed)
+            for stage, old_stage in old["stages"].items():
+                new_stage = new["stages"].get(stage)
+                if new_stage is not None:
+                    check_timing(f"{name} {stage} {percentile_name}", old_stage[percentile_name], new_stage[percentile_name], allowed)
+        for field in ("catalog_bytes", "mapped_catalog_bytes", "peak_build_bytes"):
+            if old["memory"].get(field) is None or new["memory"].get(field) is None:
+                continue
+            if new["memory"][field] > old["memory"][field] * (1 + tolerance):
+                regressions.append(f"{name} {field}: {old['memory'][field]} -> {new['memory'][field]}")
+        if compare_digests and old["requests"] == new["requests"] and old["boxes_digest"] and old["boxes_digest"] != new["boxes_digest"]:
+            regressions.append(f"{name}: selected boxes differ from the baseline")
+    return regressions
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark build_starting_box on synthetic catalogs.")
+    parser.add_argument("--sizes", default=",".join(str(size) for size in DEFAULT_SIZES), help="Comma-separated catalog sizes.")
+    parser.add_argument("--customers", type=int, default=200, help="Customers (one build each per round).")
+    parser.add_argument("--rounds", type=int, default=1, help="Builds per customer.")
+    parser.add_argument("--seed", type=int, default=7, help="Seed for the synthetic data.")
+    parser.add_argument("--concurrency", type=int, default=1, help="Builds in flight at the same time.")
+    parser.add_argument("--latency-ms", type=float, default=0.0, help="Simulated Mongo round trip per query.")
+    parser.add_argument("--repeat", type=int, default=DEFAULT_REPEAT, help="Runs per size; the best figures are kept.")
+    parser.add_argument("--memory-sample", type=int, default=20, help="Builds traced with tracemalloc for the peak memory figure.")
+    parser.add_argument("--output", help="Write the report to this file.")
+    parser.add_argument("--save-baseline", metavar="PATH", help="Write the report as the new baseline.")
+    parser.add_argument("--compare", metavar="PATH", help="Fail if the report regresses against this baseline.")
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE, help="Allowed relative growth before --compare fails.")
+    parser.add_argument("--min-delta-ms", type=float, default=DEFAULT_MIN_DELTA_MS, help="Ignore timing changes smaller than this.")
+    return parser.parse_args(argv)
+
+
+async def main(argv=None):
+    args = parse_args(argv)
+    configure_logging()
+    report = await run_benchmarks(
+        sizes=[int(size) for size in args.sizes.split(",") if size],
+        customers=args.customers,
+        seed=args.seed,
+        rounds=args.rounds,
+        concurrency=args.concurrency,
+        latency=args.latency_ms / 1000,
+        memory_sample=args.memory_sample,
+        repeat=args.repeat,
+    )
+
+    for path in (args.output, args.save_baseline):
+        if path:
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+            with open(path, "w") as report_file:
+                json.dump(report, report_file, indent=2)
+    if not (args.output or args.save_baseline):
+        print(json.dumps(report, indent=2))
+
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            baseline = json.load(baseline_file)
+        regressions = compare_reports(baseline, report, args.tolerance, args.min_delta_ms)
+        for regression in regressions:
+            print(f"REGRESSION {regression}", file=sys.stderr)
+        if regressions:
+            return 1
+        print(f"No regressions against {args.compare}", file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main()))
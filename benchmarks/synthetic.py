@@ -0,0 +1,184 @@
+"""
+Seeded synthetic data for the box build benchmarks: a snack catalog, customers and their
+draft box histories, shaped like the documents in the Boxes database.
+
+The same seed always produces the same data, so timings and selected boxes can be compared
+between runs.
+"""
+import random
+import uuid
+from datetime import datetime, timedelta
+
+PRIMARY_CATEGORIES = {
+    "Chips": ["Potato", "Tortilla", "Veggie", "Kettle", "Pita"],
+    "Bars": ["Protein", "Granola", "Fruit", "Nut"],
+    "Jerky": ["Beef", "Turkey", "Pork", "Plant Based"],
+    "Nuts": ["Almonds", "Cashews", "Mixed", "Pistachios"],
+    "Cookies": ["Chocolate Chip", "Oatmeal", "Sandwich", "Shortbread"],
+    "Crackers": ["Cheese", "Whole Grain", "Rice", "Seed"],
+    "Popcorn": ["Kettle", "Butter", "Cheddar", "Caramel"],
+    "Dried Fruit": ["Mango", "Apricot", "Berry", "Mixed"],
+    "Fruit Gummies": ["Sour", "Classic", "Vitamin"],
+    "Candy": ["Chocolate", "Hard", "Chewy", "Mint"],
+    "Pretzels": ["Twists", "Rods", "Filled", "Thins"],
+    "Seaweed": ["Sheets", "Crisps"],
+}
+FORMS = ["Bag", "Bar", "Stick", "Cup", "Pouch", "Box"]
+FLAVOR_TAGS = [
+    "Salt", "Salted", "Sea Salt", "Spicy", "Spice", "Spiced", "Berry", "Berries", "Cheese", "Cheesy",
+    "Smoked", "Smoky", "Chocolate", "Chocolatey", "BBQ", "Barbecue", "Honey", "Sour", "Lime", "Limes",
+    "Baking", "Baked", "Vanilla", "Caramel", "Cinnamon", "Garlic", "Ranch", "Jalapeno", "Maple", "Peanut Butter",
+]
+VETOED_FLAVORS = ["salt", "spicy", "berry", "cheeses", "smoking", "bbq", "limes", "bake", "garlic", "cinnamon"]
+ALLERGENS = ["Peanuts", "Tree Nuts", "Dairy", "Soy", "Gluten", "Eggs", "Sesame"]
+STAPLE_AMOUNTS = ["one", "a few", "many"]
+SUBSCRIPTION_TYPES = [8, 12, 16, 20, 24, 30]
+
+
+def snack_id(index):
+    return f"SN{index:06d}"
+
+
+def generate_snacks(rng, count):
+    """
+    `count` snack documents. Brands and product lines grow with the catalog, so larger
+    catalogs aren't just more copies of the same few brands.
+    """
+    categories = list(PRIMARY_CATEGORIES)
+    brands = [f"Brand {i}" for i in range(max(12, count // 40))]
+    product_lines = max(40, count // 12)
+    snacks = []
+    for index in range(count):
+        primary_category = rng.choice(categories)
+        snack = {
+            "SnackID": snack_id(index),
+            "primaryCategory": primary_category,
+            "secondaryCategory": rng.choice(PRIMARY_CATEGORIES[primary_category]),
+            "form": rng.choice(FORMS),
+            "brand": rng.choice(brands),
+            "flavorTags": rng.sample(FLAVOR_TAGS, rng.randint(0, 3)),
+            "allergens": rng.sample(ALLERGENS, rng.randint(0, 2)),
+            "inStock": rng.random() < 0.9,
+            "active": rng.random() < 0.92,
+            "approved": rng.random() < 0.5,
+            "itemOfMonthBoost": rng.choice([0, 0, 0, 1, 2]),
+            "totalScore": rng.randint(0, 100),
+            "highProteinBoost": rng.choice([0, 5, 10]),
+            "lowCarbBoost": rng.choice([0, 5]),
+            "lowCalorieBoost": rng.choice([0, 3, 7]),
+            "protein": rng.randint(0, 20),
+            "carbs": rng.randint(0, 40),
+            "calories": rng.randint(50, 350),
+            "productLine": f"PL{rng.randrange(product_lines)}",
+            "premium": rng.random() < 0.2,
+            "ounces": rng.choice([1.0, 1.5, 2.0, 3.0]),
+            "flavor": rng.choice(FLAVOR_TAGS),
+        }
+        if rng.random() < 0.05:
+            snack["replacementOnly"] = True
+        if rng.random() < 0.05:
+            del snack["flavorTags"]
+        snacks.append(snack)
+    return snacks
+
+
+def generate_customers(rng, count):
+    """
+    `count` active customer documents with allergens, category dislikes, staples and vetoed flavors.
+    """
+    categories = list(PRIMARY_CATEGORIES)
+    customers = []
+    for index in range(count):
+        picked = rng.sample(categories, 6)
+        customers.append({
+            "customerID": f"C{index:06d}",
+            "allergens": rng.sample(ALLERGENS, rng.randint(0, 2)),
+            "dislikes": picked[4:4 + rng.randint(0, 2)],
+            "staples": {category: rng.choice(STAPLE_AMOUNTS) for category in picked[:rng.randint(0, 4)]},
+            "vetoedFlavors": rng.sample(VETOED_FLAVORS, rng.randint(0, 2)),
+            "prioritySetting": rng.choice([0, 1, 2, 3, None]),
+            "subscription_type": rng.choice(SUBSCRIPTION_TYPES),
+            "stripe_status": "active",
+            "repeatMonthly": [],
+        })
+    return customers
+
+
+def generate_box_histories(rng, customers, snacks, max_boxes=6, now=None):
+    """
+    Past draft boxes: up to `max_boxes` monthly boxes per customer, one month apart.
+    """
+    now = now or datetime(2024, 1, 1)
+    boxes = []
+    for customer in customers:
+        for months_ago in range(1, rng.randint(0, max_boxes) + 1):
+            created_at = now - timedelta(days=30 * months_ago)
+            picked = rng.sample(snacks, min(len(snacks), customer["subscription_type"]))
+            box_snacks = [
+                {
+                    "SnackID": snack["SnackID"],
+                    "count": 1,
+                    "primaryCategory": snack["primaryCategory"],
+                    "premium": snack["premium"],
+                }
+                for snack in picked
+            ]
+            boxes.append({
+                "boxID": str(uuid.UUID(int=rng.getrandbits(128))),
+                "customerID": customer["customerID"],
+                "month": int(created_at.strftime("%Y%m")),
+                "size": customer["subscription_type"],
+                "order_status": "delivered",
+                "snacks": box_snacks,
+                "originalSnacks": box_snacks,
+                "popped": False,
+                "createdAt": created_at,
+            })
+    return boxes
+
+
+def generate_build_requests(rng, customers, snacks, rounds=1):
+    """
+    Keyword arguments for build_starting_box (minus the collections): every customer once per
+    round, with a mix of new signups, off-cycle boxes and repeat-monthly snacks.
+    """
+    requests = []
+    for round_index in range(rounds):
+        for customer in customers:
+            repeat_monthly = []
+            if rng.random() < 0.3:
+                snack = rng.choice(snacks)
+                repeat_monthly.append({
+                    "SnackID": snack["SnackID"],
+                    "count": rng.randint(1, 2),
+                    "primaryCategory": snack["primaryCategory"],
+                    "premium": snack["premium"],
+                })
+            requests.append({
+                "customerID": customer["customerID"],
+                "new_signup": round_index == 0 and rng.random() < 0.5,
+                "repeat_customer": round_index > 0,
+                "off_cycle": rng.random() < 0.3,
+                "is_reset_box": False,
+                "reset_total": 0,
+                "repeat_monthly": repeat_monthly,
+            })
+    return requests
+
+
+def generate_dataset(seed, snack_count, customer_count, max_boxes=6, rounds=1):
+    """
+    Everything a benchmark run needs, from one seed.
+
+    Returns:
+        dict: snacks, customers, draftboxes (histories) and requests.
+    """
+    rng = random.Random(seed)
+    snacks = generate_snacks(rng, snack_count)
+    customers = generate_customers(rng, customer_count)
+    return {
+        "snacks": snacks,
+        "customers": customers,
+        "draftboxes": generate_box_histories(rng, customers, snacks, max_boxes),
+        "requests": generate_build_requests(rng, customers, snacks, rounds),
+    }